@@ -27,14 +27,46 @@ import urllib2
 import urlparse
 import base64
 import md5
+import hashlib
+import hmac
 from Queue import Queue, Empty
 import threading
 import ast
+import importlib
 import itertools
 import MySQLdb.cursors
 import cPickle
+import anydbm
+import mmap
+import glob
+import tempfile
 import logging
+import atexit
+from contextlib import contextmanager
 import korp_config as config
+import korp_lemgram_index
+import korp_registry
+import korp_info_snapshot
+import korp_auth
+import korp_json
+import korp_count_cache
+
+# Optional modules imported on first use by import_optional: numpy
+# (loglike computes the log-likelihoods without it) and the output
+# compressors brotli and zstandard (see config.OUTPUT_COMPRESSION)
+_optional_modules = {}
+
+
+def import_optional(name):
+    """Return the optional module name, imported when first needed so
+    that the commands not using it do not pay for importing it, or
+    None if it is not installed."""
+    if name not in _optional_modules:
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
 
 ################################################################################
 # Nothing needs to be changed in this file. Use korp_config.py for configuration.
@@ -105,9 +137,14 @@ SPECIAL_CHAR_DECODE_MAP = [(repl[-1], c[-1])
                            if c != "\\\\" and repl != "\\\\"]
 
 # The regexp for the names of the corpora whose sentences should never
-# be shown in corpus order; initialized in main()
+# be shown in corpus order; initialized in init()
 RESTRICTED_SENTENCES_CORPORA_REGEXP = None
 
+# Whether anti_timeout_loop prints progress messages and whitespace to
+# keep the connection alive; False while running a command with
+# run_command
+_anti_timeout_output = True
+
 
 # KLUDGE: A global variable for calculating the output JSON size for
 # logging. This simpler to implement because of incremental output.
@@ -115,6 +152,17 @@ RESTRICTED_SENTENCES_CORPORA_REGEXP = None
 # information.
 _result_json_size = 0
 
+# The catalogue of the tables in the database and the time when it was
+# read from the database, read by get_db_catalogue
+_db_catalogue = None
+
+# The connection pool of get_db_connection: lists of idle connections
+# by their connection options, the options of each open connection
+# and a lock for accessing them
+_db_pool = {}
+_db_pool_keys = {}
+_db_pool_lock = threading.Lock()
+
 
 ################################################################################
 # And now the functions corresponding to the CGI commands
@@ -131,94 +179,72 @@ def main():
      - debug: if set, return some extra information (for debugging)
     """
     starttime = time.time()
-    sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)  # Open unbuffered stdout
-    print_header()
-
-    if config.CACHE_DIR and not os.path.exists(config.CACHE_DIR):
-        os.makedirs(config.CACHE_DIR)
-    
-    # Convert form fields to regular dictionary
-    form_raw = cgi.FieldStorage()
-    form = dict((field, form_raw.getvalue(field)) for field in form_raw.keys())
-    form = decompress_params(form)
+    # Open unbuffered stdout, compressed if the client accepts it; the
+    # header is printed when the first output is written
+    sys.stdout = ResponseOutput(os.fdopen(sys.stdout.fileno(), 'w', 0),
+                                choose_content_encoding())
 
-    # Configure logging
-    loglevel = logging.DEBUG if "debug" in form else config.LOG_LEVEL
-    logging.basicConfig(filename=config.LOG_FILE,
-                        format=('[%(filename)s %(process)d' +
-                                ' %(levelname)s @ %(asctime)s]' +
-                                ' %(message)s'),
-                        level=loglevel)
-
-    global RESTRICTED_SENTENCES_CORPORA_REGEXP
-    RESTRICTED_SENTENCES_CORPORA_REGEXP = read_corpora_regexp_file(
-        config.RESTRICTED_SENTENCES_CORPORA_FILE)
-
-    incremental = form.get("incremental", "").lower() == "true"
-    callback = form.get("callback")
-    if callback:
-        print callback + "(",
+    # The header and the buffered output are written by finish, so
+    # call it also if an exception is raised outside the command
+    try:
+        # Convert form fields to regular dictionary
+        form_raw = cgi.FieldStorage()
+        form = dict((field, form_raw.getvalue(field)) for field in form_raw.keys())
+        form = decompress_params(form)
+
+        # Configure logging
+        loglevel = logging.DEBUG if "debug" in form else config.LOG_LEVEL
+        logging.basicConfig(filename=config.LOG_FILE,
+                            format=('[%(filename)s %(process)d' +
+                                    ' %(levelname)s @ %(asctime)s]' +
+                                    ' %(message)s'),
+                            level=loglevel)
+
+        incremental = form.get("incremental", "").lower() == "true"
+        callback = form.get("callback")
+        if callback:
+            print callback + "(",
     
-    if incremental:
-        print "{"
+        if incremental:
+            print "{"
             
-    command = form.get("command")
-    if not command:
-        command = default_command(form)
-
-    # Log remote IP address, HTTP refer(r)er and CGI parameters
-    logging.info('IP: %s', cgi.os.environ.get('REMOTE_ADDR'))
-    logging.info('User-agent: %s', cgi.os.environ.get('HTTP_USER_AGENT'))
-    logging.info('Referer: %s', cgi.os.environ.get('HTTP_REFERER'))
-    logging.info('Script: %s', cgi.os.environ.get('SCRIPT_NAME'))
-    logging.info('Loginfo: %s', form.get('loginfo', ''))
-    logging.info('Command: %s', command)
-    logging.info('Params: %s', form)
-    # Log user information (Shibboleth authentication only)
-    remote_user = cgi.os.environ.get('REMOTE_USER')
-    if remote_user:
-        auth_domain = remote_user.partition('@')[2]
-        auth_user = md5.new(remote_user).hexdigest()
-    else:
-        auth_domain = auth_user = None
-    logging.info('Auth-domain: %s', auth_domain)
-    logging.info('Auth-user: %s', auth_user)
-    logging.debug('Env: %s', cgi.os.environ)
+        command = form.get("command")
+        if not command:
+            command = default_command(form)
+
+        # Log remote IP address, HTTP refer(r)er and CGI parameters
+        logging.info('IP: %s', cgi.os.environ.get('REMOTE_ADDR'))
+        logging.info('User-agent: %s', cgi.os.environ.get('HTTP_USER_AGENT'))
+        logging.info('Referer: %s', cgi.os.environ.get('HTTP_REFERER'))
+        logging.info('Script: %s', cgi.os.environ.get('SCRIPT_NAME'))
+        logging.info('Loginfo: %s', form.get('loginfo', ''))
+        logging.info('Command: %s', command)
+        logging.info('Params: %s', form)
+        # Log user information (Shibboleth authentication only)
+        remote_user = cgi.os.environ.get('REMOTE_USER')
+        if remote_user:
+            auth_domain = remote_user.partition('@')[2]
+            auth_user = md5.new(remote_user).hexdigest()
+        else:
+            auth_domain = auth_user = None
+        logging.info('Auth-domain: %s', auth_domain)
+        logging.info('Auth-user: %s', auth_user)
+        logging.debug('Env: %s', cgi.os.environ)
 
-    try:
-        if command not in COMMANDS:
-            raise ValueError("'%s' is not a permitted command, try these instead: '%s'" % (command, "', '".join(COMMANDS)))
-        assert_key("callback", form, IS_IDENT)
-        assert_key("encoding", form, IS_IDENT)
-        assert_key("indent", form, IS_NUMBER)
-
-        # Here we call the command function:
-        result = globals()[command](form)
-        result["time"] = time.time() - starttime
-        print_object(result, form)
-    except:
-        import traceback
-        exc = sys.exc_info()
-        if isinstance(exc[1], CustomTracebackException):
-            exc = exc[1].exception
-        error = {"ERROR": {"type": exc[0].__name__,
-                           "value": str(exc[1])
-                           },
-                 "time": time.time() - starttime}
-        trace = "".join(traceback.format_exception(*exc)).splitlines()
-        if "debug" in form:
-            error["ERROR"]["traceback"] = trace
-        print_object(error, form)
-        # Traceback for logging
-        error["ERROR"]["traceback"] = trace
-        # Log error message with traceback
-        logging.error("%s", error["ERROR"])
+        try:
+            init()
+            result = call_command(command, form, starttime)
+            print_object(result, form)
+        except:
+            print_object(make_error_result(form, starttime), form)
 
-    if incremental:
-        print "}"
+        if incremental:
+            print "}"
 
-    if callback:
-        print ")",
+        if callback:
+            print ")",
+    finally:
+        sys.stdout.finish()
 
     logging.info('Content-length: %d', _result_json_size)
     logging.info('CPU-load: %s', ' '.join(str(val) for val in os.getloadavg()))
@@ -227,6 +253,82 @@ def main():
     logging.info("Elapsed: %s", str(time.time() - starttime))
 
 
+def init():
+    """Initialize the cache directory and the global variables read
+    from files, before running commands."""
+    if config.CACHE_DIR and not os.path.exists(config.CACHE_DIR):
+        os.makedirs(config.CACHE_DIR)
+
+    global RESTRICTED_SENTENCES_CORPORA_REGEXP
+    RESTRICTED_SENTENCES_CORPORA_REGEXP = read_corpora_regexp_file(
+        config.RESTRICTED_SENTENCES_CORPORA_FILE)
+
+
+def call_command(command, form, starttime):
+    """Check the global parameters in form, call the function of
+    command with form and return its result with the elapsed time
+    since starttime."""
+    if command not in COMMANDS:
+        raise ValueError("'%s' is not a permitted command, try these instead: '%s'" % (command, "', '".join(COMMANDS)))
+    assert_key("callback", form, IS_IDENT)
+    assert_key("encoding", form, IS_IDENT)
+    assert_key("indent", form, IS_NUMBER)
+
+    # Here we call the command function:
+    result = globals()[command](form)
+    result["time"] = time.time() - starttime
+    return result
+
+
+def make_error_result(form, starttime, exc=None):
+    """Return the result for the exception being handled (or for the
+    exception info triple exc) and log the error with its traceback.
+    The traceback is included in the result only if form has the
+    parameter debug."""
+    import traceback
+    exc = exc or sys.exc_info()
+    if isinstance(exc[1], CustomTracebackException):
+        exc = exc[1].exception
+    error = {"ERROR": {"type": exc[0].__name__,
+                       "value": str(exc[1])
+                       },
+             "time": time.time() - starttime}
+    trace = "".join(traceback.format_exception(*exc)).splitlines()
+    if "debug" in form:
+        error["ERROR"]["traceback"] = trace
+    # Log error message with traceback
+    logging.error("%s", dict(error["ERROR"], traceback=trace))
+    return error
+
+
+def run_command(form):
+    """Run the command specified in form in the calling process and
+    return its result (or an ERROR result) as a dict, instead of
+    printing it as JSON.
+
+    This allows korp_download.cgi (korpexport) to call the commands
+    directly when it runs on the same host as korp.cgi, with the same
+    environment (and thus authentication information). The values in
+    form are UTF-8 strings as in the CGI form of main. Incremental
+    output and the whitespace printed to keep the connection alive are
+    suppressed, so nothing is written to the standard output.
+    """
+    global _anti_timeout_output
+    starttime = time.time()
+    init()
+    form = decompress_params(dict(form))
+    form.pop("incremental", None)
+    command = form.get("command") or default_command(form)
+    logging.info('Command (in-process): %s', command)
+    _anti_timeout_output = False
+    try:
+        return call_command(command, form, starttime)
+    except:
+        return make_error_result(form, starttime)
+    finally:
+        _anti_timeout_output = True
+
+
 ################################################################################
 # INFO
 ################################################################################
@@ -245,17 +347,31 @@ def general_info(form):
     """Return information about the available corpora.
     """
     strict = (form.get("strict", "").lower() != "false")
-    corpora = runCQP("show corpora;", form)
-    version = corpora.next()
-    # CQP "show corpora" lists all corpora in the registry, but some
-    # of them might nevertheless cause a "corpus undefined" error in
-    # CQP, for example, because of missing data, so filter them out.
-    # However, with a large number of corpora, filtering slows down
-    # the info command, so it can be disabled with the parameter
-    # strict=false. Caching the results of filter_undefined_corpora
-    # helps, though. (Jyrki Niemi 2017-12-13)
-    if strict:
-        corpora, _ = filter_undefined_corpora(list(corpora), form)
+    snapshot = get_info_snapshot(form)
+    if snapshot:
+        corpora = sorted(snapshot["corpora"])
+        if not strict:
+            corpora = sorted(corpora + snapshot["undefined_corpora"])
+        return {"cqp-version": snapshot["cqp-version"], "corpora": corpora,
+                "protected_corpora": snapshot["protected_corpora"]}
+    if config.CORPUS_INFO_FROM_REGISTRY:
+        # Read the registry directly instead of running CQP (twice)
+        version = get_cqp_version(form)
+        corpora = korp_registry.list_corpora()
+        if strict:
+            corpora, _ = korp_registry.filter_undefined_corpora(corpora)
+    else:
+        corpora = runCQP("show corpora;", form)
+        version = corpora.next()
+        # CQP "show corpora" lists all corpora in the registry, but some
+        # of them might nevertheless cause a "corpus undefined" error in
+        # CQP, for example, because of missing data, so filter them out.
+        # However, with a large number of corpora, filtering slows down
+        # the info command, so it can be disabled with the parameter
+        # strict=false. Caching the results of filter_undefined_corpora
+        # helps, though. (Jyrki Niemi 2017-12-13)
+        if strict:
+            corpora, _ = filter_undefined_corpora(list(corpora), form)
     protected = []
     
     if config.PROTECTED_FILE:
@@ -277,6 +393,15 @@ def corpus_info(form):
     report_undefined_corpora = (
         form.get("report_undefined_corpora", "").lower() == "true")
 
+    # Take the information from the snapshot if it covers all the
+    # corpora
+    snapshot = get_info_snapshot(form)
+    if snapshot and all(corpus in snapshot["corpora"]
+                        or corpus in snapshot["undefined_corpora"]
+                        for corpus in corpora):
+        return corpus_info_from_snapshot(snapshot, corpora,
+                                         report_undefined_corpora, form)
+
     use_cache = bool(not form.get("cache", "").lower() == "false" and config.CACHE_DIR)
     
     # Caching
@@ -286,7 +411,7 @@ def corpus_info(form):
         cachefilename = os.path.join(config.CACHE_DIR, "info_" + checksum)
         if os.path.exists(cachefilename):
             with open(cachefilename, "r") as cachefile:
-                result = json.load(cachefile)
+                result = korp_json.load(cachefile)
                 if "debug" in form:
                     result.setdefault("DEBUG", {})
                     result["DEBUG"]["cache_read"] = True
@@ -299,41 +424,58 @@ def corpus_info(form):
     
     cmd = []
 
-    if report_undefined_corpora:
-        corpora, undefined_corpora = filter_undefined_corpora(corpora, form)
+    if config.CORPUS_INFO_FROM_REGISTRY:
+        undefined_corpora = []
+        for corpus in corpora:
+            try:
+                result["corpora"][corpus] = korp_registry.get_corpus_info(corpus)
+            except korp_registry.RegistryError, e:
+                if not report_undefined_corpora:
+                    raise CQPError(str(e))
+                undefined_corpora.append(corpus)
+                continue
+            info = result["corpora"][corpus]["info"]
+            total_size += int(info["Size"])
+            if info.get("Sentences", "").isdigit():
+                total_sentences += int(info["Sentences"])
+        corpora = [corpus for corpus in corpora
+                   if corpus not in undefined_corpora]
+    else:
+        if report_undefined_corpora:
+            corpora, undefined_corpora = filter_undefined_corpora(corpora, form)
 
-    for corpus in corpora:
-        cmd += ["%s;" % corpus]
-        cmd += show_attributes()
-        cmd += ["info; .EOL.;"]
+        for corpus in corpora:
+            cmd += ["%s;" % corpus]
+            cmd += show_attributes()
+            cmd += ["info; .EOL.;"]
 
-    cmd += ["exit;"]
+        cmd += ["exit;"]
 
-    # call the CQP binary
-    lines = runCQP(cmd, form)
+        # call the CQP binary
+        lines = runCQP(cmd, form)
 
-    # skip CQP version
-    lines.next()
+        # skip CQP version
+        lines.next()
     
-    for corpus in corpora:
-        # read attributes
-        attrs = read_attributes(lines)
+        for corpus in corpora:
+            # read attributes
+            attrs = read_attributes(lines)
 
-        # corpus information
-        info = {}
+            # corpus information
+            info = {}
         
-        for line in lines:
-            if line == END_OF_LINE:
-                break
-            if ":" in line and not line.endswith(":"):
-                infokey, infoval = (x.strip() for x in line.split(":", 1))
-                info[infokey] = infoval
-                if infokey == "Size":
-                    total_size += int(infoval)
-                elif infokey == "Sentences" and infoval.isdigit():
-                    total_sentences += int(infoval)
+            for line in lines:
+                if line == END_OF_LINE:
+                    break
+                if ":" in line and not line.endswith(":"):
+                    infokey, infoval = (x.strip() for x in line.split(":", 1))
+                    info[infokey] = infoval
+                    if infokey == "Size":
+                        total_size += int(infoval)
+                    elif infokey == "Sentences" and infoval.isdigit():
+                        total_sentences += int(infoval)
 
-        result["corpora"][corpus] = {"attrs": attrs, "info": info}
+            result["corpora"][corpus] = {"attrs": attrs, "info": info}
 
     if config.DB_HAS_CORPUSINFO:
         add_corpusinfo_from_database(result, corpora)
@@ -350,7 +492,7 @@ def corpus_info(form):
             tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
 
             with open(tmpfile, "w") as cachefile:
-                json.dump(result, cachefile)
+                korp_json.dump(result, cachefile)
             os.rename(tmpfile, cachefilename)
             
             if "debug" in form:
@@ -364,6 +506,81 @@ def corpus_info(form):
     return result
 
 
+def get_info_snapshot(form):
+    """Return the corpus metadata snapshot built with
+    korp_info_snapshot.py, or None if it is not in use or is not
+    available."""
+    if not config.INFO_SNAPSHOT_FILE or form.get("cache", "").lower() == "false":
+        return None
+    return korp_info_snapshot.load_snapshot()
+
+
+def corpus_info_from_snapshot(snapshot, corpora, report_undefined_corpora,
+                              form):
+    """Return the result of corpus_info for corpora, taken from
+    snapshot."""
+    result = {"corpora": {}}
+    total_size = 0
+    total_sentences = 0
+    undefined_corpora = [corpus for corpus in corpora
+                         if corpus not in snapshot["corpora"]]
+    if undefined_corpora and not report_undefined_corpora:
+        raise CQPError("Corpus ``%s'' is undefined" % undefined_corpora[0])
+
+    for corpus in corpora:
+        if corpus in undefined_corpora:
+            continue
+        corpus_data = snapshot["corpora"][corpus]
+        info = corpus_data["info"]
+        result["corpora"][corpus] = {"attrs": corpus_data["attrs"],
+                                     "info": dict(info)}
+        total_size += int(info["Size"])
+        if info.get("Sentences", "").isdigit():
+            total_sentences += int(info["Sentences"])
+
+    result["total_size"] = total_size
+    result["total_sentences"] = total_sentences
+
+    if report_undefined_corpora:
+        result["undefined_corpora"] = undefined_corpora
+
+    if "debug" in form:
+        result["DEBUG"] = {"snapshot": snapshot["created"]}
+
+    return result
+
+
+def get_cqp_version(form):
+    """Return the version line output by CQP.
+
+    The version is cached in CACHE_DIR by the modification time of the
+    CQP executable, so that CQP need not be run to find it out.
+    """
+    use_cache = bool(not form.get("cache", "").lower() == "false"
+                     and config.CACHE_DIR)
+    if use_cache:
+        try:
+            mtime = os.path.getmtime(config.CQP_EXECUTABLE)
+        except OSError:
+            mtime = None
+        cachefilename = os.path.join(
+            config.CACHE_DIR,
+            "cqpversion_" + get_hash((config.CQP_EXECUTABLE, mtime)))
+        if os.path.exists(cachefilename):
+            with open(cachefilename, "r") as cachefile:
+                return cachefile.read().decode("utf-8")
+
+    version = runCQP("exit;", form).next()
+
+    if use_cache:
+        tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
+        with open(tmpfile, "w") as cachefile:
+            cachefile.write(version.encode("utf-8"))
+        os.rename(tmpfile, cachefilename)
+
+    return version
+
+
 def filter_undefined_corpora(corpora, form, strict=True):
     """Return a pair of a list of defined and a list of undefined corpora
     in the argument corpora. If strict, try to select each corpus in
@@ -378,7 +595,7 @@ def filter_undefined_corpora(corpora, form, strict=True):
         cachefilename = os.path.join(config.CACHE_DIR, "corpora_" + checksum)
         if os.path.exists(cachefilename):
             with open(cachefilename, "r") as cachefile:
-                result = json.load(cachefile)
+                result = korp_json.load(cachefile)
                 # Since this is not the result of a command, we cannot
                 # add debug information on using cache to the result.
                 return (result["defined"], result["undefined"])
@@ -419,7 +636,7 @@ def filter_undefined_corpora(corpora, form, strict=True):
         if not os.path.exists(cachefilename):
             tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
             with open(tmpfile, "w") as cachefile:
-                json.dump({"defined": defined, "undefined": undefined}, cachefile)
+                korp_json.dump({"defined": defined, "undefined": undefined}, cachefile)
             os.rename(tmpfile, cachefilename)
 
     return (defined, undefined)
@@ -428,18 +645,15 @@ def filter_undefined_corpora(corpora, form, strict=True):
 def add_corpusinfo_from_database(result, corpora):
     """Add extra info items from database to the info of corpora in result."""
     try:
-        conn = MySQLdb.connect(use_unicode=True,
-                               charset="utf8",
-                               **config.DBCONNECT)
-        cursor = conn.cursor()
-        sql = ("SELECT `corpus`, `key`, `value` FROM corpus_info WHERE corpus IN (%s)"
-               % ", ".join("%s" % conn.escape(c) for c in corpora))
-        cursor.execute(sql)
-        for row in cursor:
-            corpus, key, value = row
-            result["corpora"][corpus]["info"][key] = value
-        cursor.close()
-        conn.close()
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            sql = ("SELECT `corpus`, `key`, `value` FROM corpus_info WHERE corpus IN (%s)"
+                   % ", ".join("%s" % conn.escape(c) for c in corpora))
+            cursor.execute(sql)
+            for row in cursor:
+                corpus, key, value = row
+                result["corpora"][corpus]["info"][key] = value
+            cursor.close()
     except (MySQLdb.MySQLError, MySQLdb.InterfaceError, MySQLdb.DatabaseError):
         # Return the result unmodified if the database access caused
         # an error.
@@ -862,7 +1076,17 @@ def query_optimize(cqp, cqpextra, find_match=True, expand=True):
     return cmd
 
 
-def query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results=False, expand_prequeries=True):
+def query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results=False, expand_prequeries=True, undump_file=None):
+    """Run the CQP queries cqp in corpus and return a tuple of the
+    lines of the result rows start to end, the number of hits, the
+    attributes of the corpus and the secondary contexts.
+
+    If undump_file is given, cqp is ignored and the matches are
+    instead read with the CQP command undump from the file
+    undump_file, containing the start and end corpus positions of
+    each match separated by a tab, one match per line, in ascending
+    order.
+    """
 
     # Optimization
     optimize = True
@@ -1002,10 +1226,19 @@ def query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end,
     else:
         sortcmd = []
 
+    # The named query containing the matches
+    query_name = "Undumped" if undump_file else "Last"
+    if query_name != "Last":
+        sortcmd = [sc.replace("sort ", "sort %s " % query_name, 1)
+                   for sc in sortcmd]
+
     # Build the CQP query
     cmd = ["%s;" % corpus]
     # This prints the attributes and their relative order:
     cmd += show_attributes()
+    if undump_file:
+        cmd += ["undump %s < '%s';" % (query_name, undump_file)]
+        cqp = []
     for i, c in enumerate(cqp):
         cqpextra_temp = cqpextra_internal.copy()
         pre_query = i+1 < len(cqp)
@@ -1023,7 +1256,7 @@ def query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end,
             cmd += ["Last;"]
     
     # This prints the size of the query (i.e., the number of results):
-    cmd += ["size Last;"]
+    cmd += ["size %s;" % query_name]
     if not no_results:
         cmd += ["show +%s;" % " +".join(shown)]
         if len(context) == 1:
@@ -1037,7 +1270,7 @@ def query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end,
         cmd += ["set ExternalSort yes;"]
         cmd += sortcmd
         # This prints the result rows:
-        cmd += ["cat Last %s %s;" % (start, end)]
+        cmd += ["cat %s %s %s;" % (query_name, start, end)]
     cmd += ["exit;"]
 
     ######################################################################
@@ -1288,8 +1521,8 @@ def query_parse_lines(corpus, lines, attrs, shown, shown_structs,
     return kwic
 
 
-def query_and_parse(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results=False, expand_prequeries=True):
-    lines, nr_hits, attrs, context2 = query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results, expand_prequeries)
+def query_and_parse(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results=False, expand_prequeries=True, undump_file=None):
+    lines, nr_hits, attrs, context2 = query_corpus(form, corpus, cqp, cqpextra, shown, shown_structs, start, end, no_results, expand_prequeries, undump_file)
     kwic = query_parse_lines(corpus, lines, attrs, shown, shown_structs,
                              context2)
     return kwic, nr_hits
@@ -1387,22 +1620,23 @@ def count(form):
                      sorted(ignore_case),
                      sorted(split),
                      sorted(strippointer),
-                     start,
-                     end,
                      form.get("defaultwithin"),
                      form.get("within"))
     checksum = get_hash(checksum_data)
     
+    # The whole result is cached regardless of start and end, so that
+    # each page of a result is read from the same cache file
     if use_cache:
-        cachefilename = os.path.join(config.CACHE_DIR, "count_" + checksum)
-        if os.path.exists(cachefilename):
-            with open(cachefilename, "r") as cachefile:
-                result = json.load(cachefile)
-                if "debug" in form:
-                    result.setdefault("DEBUG", {})
-                    result["DEBUG"]["cache_read"] = True
-                    result["DEBUG"]["checksum"] = checksum
-                return result
+        cachefilename = os.path.join(config.CACHE_DIR, "countbin_" + checksum)
+        reader = korp_count_cache.open_count_cache(cachefilename)
+        if reader:
+            try:
+                result = count_result_from_cache(reader, start, end)
+            finally:
+                reader.close()
+            if "debug" in form:
+                result["DEBUG"] = {"cache_read": True, "checksum": checksum}
+            return result
 
     result = {"corpora": {}}
     total_stats = {"absolute": defaultdict(int),
@@ -1419,11 +1653,53 @@ def count(form):
     if incremental:
         print '"progress_corpora": [%s],' % ('"' + '", "'.join(corpora) + '"' if corpora else "")
 
+    # The frequency tables of the individual corpora are stored
+    # separately, so that they can be reused by requests with a
+    # different set of corpora (such as loglike comparing subsets of
+    # the corpora of a statistics query) or different start and end
+    freq_table_keys = {}
+    freq_tables = {}
+    for corpus in corpora:
+        freq_table_keys[corpus] = get_freq_table_key(
+            corpus, cqp, groupby, ignore_case, split, strippointer, simple,
+            expand_prequeries, form)
+        if use_cache:
+            freq_table = get_cached_freq_table(freq_table_keys[corpus])
+            if freq_table:
+                freq_tables[corpus] = freq_table
+
+    corpus_sizes = {}
+
+    def add_corpus_stats(corpus, freqs, corpus_size):
+        ns.total_size += corpus_size
+        corpus_sizes[corpus] = corpus_size
+        corpus_stats = {"absolute": defaultdict(int),
+                        "relative": defaultdict(float),
+                        "sums": {"absolute": 0, "relative": 0.0}}
+
+        for ngram, count in freqs.iteritems():
+            corpus_stats["absolute"][ngram] += count
+            corpus_stats["relative"][ngram] += count / float(corpus_size) * 1000000
+            corpus_stats["sums"]["absolute"] += count
+            total_stats["absolute"][ngram] += count
+        corpus_stats["sums"]["relative"] = corpus_stats["sums"]["absolute"] / float(corpus_size) * 1000000 if corpus_size > 0 else 0.0
+        total_stats["sums"]["absolute"] += corpus_stats["sums"]["absolute"]
+
+        result["corpora"][corpus] = corpus_stats
+
+        ns.limit_count += len(corpus_stats["absolute"])
+
     with futures.ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
-        future_query = dict((executor.submit(count_function, corpus, cqp, groupby, ignore_case, form, expand_prequeries), corpus) for corpus in corpora)
+        future_query = dict((executor.submit(count_function, corpus, cqp, groupby, ignore_case, form, expand_prequeries), corpus) for corpus in corpora if corpus not in freq_tables)
         
         def anti_timeout(queue):
 
+            for corpus, (freqs, corpus_size) in freq_tables.iteritems():
+                add_corpus_stats(corpus, freqs, corpus_size)
+                if incremental:
+                    queue.put('"progress_%d": "%s",' % (ns.progress_count, corpus))
+                    ns.progress_count += 1
+
             for future in futures.as_completed(future_query):
                 corpus = future_query[future]
                 if future.exception() is not None:
@@ -1431,57 +1707,11 @@ def count(form):
                 else:
                     lines, nr_hits, corpus_size = future.result()
 
-                    ns.total_size += corpus_size
-                    corpus_stats = {"absolute": defaultdict(int),
-                                    "relative": defaultdict(float),
-                                    "sums": {"absolute": 0, "relative": 0.0}}
-                    
-                    for line in lines:
-                        count, ngram = line.lstrip().split(" ", 1)
-                        
-                        if config.ENCODED_SPECIAL_CHARS:
-                            ngram = decode_special_chars(ngram)
+                    freqs = count_parse_lines(lines, groupby, split, strippointer)
+                    add_corpus_stats(corpus, freqs, corpus_size)
 
-                        if len(groupby) > 1:
-                            ngram_groups = ngram.split("\t")
-                        else:
-                            ngram_groups = [ngram]
-                        
-                        all_ngrams = []
-                        
-                        for i, ngram in enumerate(ngram_groups):
-                            # Split value sets and treat each value as a hit
-                            if groupby[i] in split:
-                                tokens = ngram.split(" ")
-                                split_tokens = [[x for x in token.split("|") if x] if not token == "|" else ["|"] for token in tokens]
-                                ngrams = itertools.product(*split_tokens)
-                                ngrams = [" ".join(x) for x in ngrams]
-                            else:
-                                ngrams = [ngram]
-                            
-                            # Remove multi word pointers
-                            if groupby[i] in strippointer:
-                                for i in range(len(ngrams)):
-                                    if ":" in ngrams[i]:
-                                        ngramtemp, pointer = ngrams[i].rsplit(":", 1)
-                                        if pointer.isnumeric():
-                                            ngrams[i] = ngramtemp
-                            all_ngrams.append(ngrams)
-                        
-                        cross = list(itertools.product(*all_ngrams))
-                                                        
-                        for ngram in cross:
-                            ngram = "/".join(ngram)
-                            corpus_stats["absolute"][ngram] += int(count)
-                            corpus_stats["relative"][ngram] += int(count) / float(corpus_size) * 1000000
-                            corpus_stats["sums"]["absolute"] += int(count)
-                            corpus_stats["sums"]["relative"] += int(count) / float(corpus_size) * 1000000
-                            total_stats["absolute"][ngram] += int(count)
-                            total_stats["sums"]["absolute"] += int(count)
-                
-                    result["corpora"][corpus] = corpus_stats
-                    
-                    ns.limit_count += len(corpus_stats["absolute"])
+                    if use_cache:
+                        save_freq_table(freq_table_keys[corpus], freqs, corpus_size)
                     
                     if incremental:
                         queue.put('"progress_%d": "%s",' % (ns.progress_count, corpus))
@@ -1490,6 +1720,19 @@ def count(form):
 
         anti_timeout_loop(anti_timeout)
 
+    cache_saved = False
+    if use_cache and ns.limit_count <= config.CACHE_MAX_STATS:
+        tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
+        korp_count_cache.write_count_cache(
+            tmpfile,
+            [(corpus, result["corpora"][corpus]["absolute"],
+              corpus_sizes[corpus],
+              result["corpora"][corpus]["sums"]["absolute"])
+             for corpus in corpora],
+            total_stats["absolute"], ns.total_size)
+        os.rename(tmpfile, cachefilename)
+        cache_saved = True
+
     result["count"] = len(total_stats["absolute"])
     
     if end > -1 and (start > 0 or len(total_stats["absolute"]) > (end - start) + 1):
@@ -1516,22 +1759,154 @@ def count(form):
     
     if "debug" in form:
         result["DEBUG"] = {"cqp": cqp, "checksum": checksum, "simple": simple}
-    
-    if use_cache and ns.limit_count <= config.CACHE_MAX_STATS:
-        unique_id = os.getenv("UNIQUE_ID")
-        cachefilename = os.path.join(config.CACHE_DIR, "count_" + checksum)
-        tmpfile = "%s.%s" % (cachefilename, unique_id)
-
-        with open(tmpfile, "w") as cachefile:
-            json.dump(result, cachefile)
-        os.rename(tmpfile, cachefilename)
-        
-        if "debug" in form:
+        if cache_saved:
             result["DEBUG"]["cache_saved"] = True
     
     return result
 
 
+def count_result_from_cache(reader, start, end):
+    """Return the result of the count command with the rows from start
+    to end (all rows if end is -1) in descending order of total
+    frequency, read with the count cache reader reader. Only the
+    requested rows are read from the cache file."""
+    total_sum = reader.total_sum
+    total_stats = {"absolute": {}, "relative": {},
+                   "sums": {"absolute": total_sum,
+                            "relative": total_sum / float(reader.total_size) * 1000000 if reader.total_size > 0 else 0.0}}
+    result = {"corpora": {}, "count": reader.rows, "total": total_stats}
+
+    paged = end > -1 and (start > 0 or reader.rows > (end - start) + 1)
+    if paged:
+        rows = reader.get_total_rows(start, end + 1)
+    else:
+        rows = reader.get_total_rows()
+        values = [ngram for _, ngram, _ in rows]
+
+    for corpus in reader.corpora:
+        if paged and not rows:
+            break
+        corpus_size = reader.get_corpus_size(corpus)
+        corpus_sum = reader.get_corpus_sum(corpus)
+        if paged:
+            freqs = reader.get_corpus_freqs(corpus, [num for num, _, _ in rows])
+            absolute = dict((ngram, freqs[num]) for num, ngram, _ in rows
+                            if num in freqs)
+        else:
+            absolute = dict((values[num], count) for num, count
+                            in itertools.izip(*reader.get_corpus_rows(corpus)))
+        result["corpora"][corpus] = {
+            "absolute": absolute,
+            "relative": dict((ngram, count / float(corpus_size) * 1000000)
+                             for ngram, count in absolute.iteritems()),
+            "sums": {"absolute": corpus_sum,
+                     "relative": corpus_sum / float(corpus_size) * 1000000 if corpus_size > 0 else 0.0}}
+
+    for _, ngram, count in rows:
+        total_stats["absolute"][ngram] = count
+        total_stats["relative"][ngram] = count / float(reader.total_size) * 1000000
+
+    return result
+
+
+def count_parse_lines(lines, groupby, split, strippointer):
+    """Parse the output lines of a count query worker to a dict
+    mapping the (slash-separated) values of the groupby attributes to
+    their frequencies.
+
+    Value sets of the attributes in split are split so that each value
+    is treated as a hit, and multi-word pointers are removed from the
+    values of the attributes in strippointer.
+    """
+    freqs = defaultdict(int)
+
+    for line in lines:
+        count, ngram = line.lstrip().split(" ", 1)
+
+        if config.ENCODED_SPECIAL_CHARS:
+            ngram = decode_special_chars(ngram)
+
+        if len(groupby) > 1:
+            ngram_groups = ngram.split("\t")
+        else:
+            ngram_groups = [ngram]
+
+        all_ngrams = []
+
+        for i, ngram in enumerate(ngram_groups):
+            # Split value sets and treat each value as a hit
+            if groupby[i] in split:
+                tokens = ngram.split(" ")
+                split_tokens = [[x for x in token.split("|") if x] if not token == "|" else ["|"] for token in tokens]
+                ngrams = itertools.product(*split_tokens)
+                ngrams = [" ".join(x) for x in ngrams]
+            else:
+                ngrams = [ngram]
+
+            # Remove multi word pointers
+            if groupby[i] in strippointer:
+                for j in range(len(ngrams)):
+                    if ":" in ngrams[j]:
+                        ngramtemp, pointer = ngrams[j].rsplit(":", 1)
+                        if pointer.isnumeric():
+                            ngrams[j] = ngramtemp
+            all_ngrams.append(ngrams)
+
+        for ngram in itertools.product(*all_ngrams):
+            freqs["/".join(ngram)] += int(count)
+
+    return freqs
+
+
+def get_freq_table_key(corpus, cqp, groupby, ignore_case, split,
+                       strippointer, simple, expand_prequeries, form):
+    """Get the key of the frequency table of corpus in the frequency
+    table store for a count query with the given parameters."""
+    # Resolve the within of corpus as count_query_worker does, so that
+    # the key does not depend on the within values of other corpora
+    defaultwithin = form.get("defaultwithin", "")
+    within = form.get("within", defaultwithin)
+    if ":" in within:
+        within = dict(x.split(":") for x in within.split(","))
+        within = within.get(corpus, defaultwithin)
+    return get_hash((corpus,
+                     cqp,
+                     groupby,
+                     within,
+                     sorted(ignore_case),
+                     sorted(split),
+                     sorted(strippointer),
+                     simple,
+                     expand_prequeries,
+                     form.get("cut")))
+
+
+def get_cached_freq_table(key):
+    """Return the frequency table with key from the frequency table
+    store as a tuple (frequencies, corpus_size), or None if it has not
+    been stored."""
+    cachefilename = os.path.join(config.CACHE_DIR, "freqtable_" + key)
+    try:
+        with open(cachefilename, "rb") as cachefile:
+            return cPickle.load(cachefile)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        return None
+
+
+def save_freq_table(key, freqs, corpus_size):
+    """Save the frequency table freqs of a corpus with corpus_size
+    tokens with key to the frequency table store, unless it has more
+    rows than config.CACHE_MAX_FREQ_TABLE."""
+    if len(freqs) > config.CACHE_MAX_FREQ_TABLE:
+        return
+    cachefilename = os.path.join(config.CACHE_DIR, "freqtable_" + key)
+    tmpfile = "%s.%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"),
+                            threading.current_thread().ident)
+    with open(tmpfile, "wb") as cachefile:
+        cPickle.dump((dict(freqs), corpus_size), cachefile, protocol=-1)
+    os.rename(tmpfile, cachefilename)
+
+
 def count_all(form):
     """Returns a count of the given attrs.
 
@@ -1673,7 +2048,10 @@ def count_time(form):
         print '"progress_corpora": [%s],' % ('"' + '", "'.join(corpora) + '"' if corpora else "")
 
     with futures.ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
-        future_query = dict((executor.submit(count_query_worker, corpus, cqp, groupby, [], form), corpus) for corpus in corpora)
+        # The date and time attributes are structural, so their
+        # values are the same for all the tokens of a match: tabulate
+        # them only at the match start to get a single row per hit.
+        future_query = dict((executor.submit(count_query_worker, corpus, cqp, groupby, [], form, match_start_only=True), corpus) for corpus in corpora)
         
         def anti_timeout(queue):
             for future in futures.as_completed(future_query):
@@ -1796,7 +2174,16 @@ def count_time(form):
     return result
 
 
-def count_query_worker(corpus, cqp, groupby, ignore_case, form, expand_prequeries=True):
+def count_query_worker(corpus, cqp, groupby, ignore_case, form, expand_prequeries=True, match_start_only=False):
+    """Run a CQP query and tabulate the values of the attributes in
+    groupby for the matches.
+
+    If match_start_only is True, tabulate the values only at the match
+    start position instead of the whole match. This is intended for
+    structural attributes (such as text_datefrom) whose value is the
+    same for all tokens of a match, so that the output of tabulate
+    contains a single value per hit instead of one value per token.
+    """
 
     optimize = True
     cqpextra = {}
@@ -1840,6 +2227,8 @@ def count_query_worker(corpus, cqp, groupby, ignore_case, form, expand_prequerie
     # TODO: Match targets in a better way
     if any("@[" in x for x in cqp):
         match = "target"
+    elif match_start_only:
+        match = "match"
     else:
         match = "match .. matchend"
 
@@ -1853,7 +2242,7 @@ def count_query_worker(corpus, cqp, groupby, ignore_case, form, expand_prequerie
             cmd += [".EOL.;"]
             cmd += ["mainresult;"]
             cmd += query_optimize(c, cqpextra_temp, find_match=True)
-            cmd += ["""tabulate Last %s > "| sort | uniq -c | sort -nr";""" % ", ".join("match .. matchend %s" % g for g in groupby)]
+            cmd += ["""tabulate Last %s > "| sort | uniq -c | sort -nr";""" % ", ".join("%s %s" % ("match" if match_start_only else "match .. matchend", g) for g in groupby)]
 
     #else:
         
@@ -1880,7 +2269,15 @@ def count_query_worker(corpus, cqp, groupby, ignore_case, form, expand_prequerie
 
 def count_query_worker_simple(corpus, cqp, groupby, ignore_case, form, expand_prequeries=True):
 
-    lines = list(run_cwb_scan(corpus, groupby, form))
+    # Fold the case of the ignore_case attributes as CQP does
+    attrs = [attr + "%c" if attr in ignore_case else attr for attr in groupby]
+    # Use a precomputed lexicon of the whole corpus if available
+    lexicon = read_lexicon(corpus, attrs, form)
+    if lexicon:
+        lines, corpus_size = lexicon
+        return lines, corpus_size, corpus_size
+
+    lines = list(run_cwb_scan(corpus, attrs, form))
     nr_hits = 0
 
     for i in range(len(lines)):
@@ -1894,6 +2291,53 @@ def count_query_worker_simple(corpus, cqp, groupby, ignore_case, form, expand_pr
     return lines, nr_hits, corpus_size
 
 
+def read_lexicon(corpus, attrs, form):
+    """Read the lexicon of the attributes attrs of corpus built with
+    korp_build_lexicons.py.
+
+    Return a tuple (lines, total), where lines is an iterator over the
+    lexicon lines in the format of the count query worker output and
+    total is the total frequency (corpus size). Return None if the
+    lexicon does not exist or if it is older than the data of the
+    attributes, so that the corpus is scanned instead.
+    """
+    if not config.LEXICON_DIR:
+        return None
+    filename = os.path.join(config.LEXICON_DIR, corpus.lower(), "+".join(attrs))
+    try:
+        data_mtime = korp_registry.get_attribute_mtime(
+            corpus, [attr[:-2] if attr.endswith("%c") else attr
+                     for attr in attrs])
+        if data_mtime is not None and os.path.getmtime(filename) < data_mtime:
+            logging.info("Lexicon %s is older than the corpus data", filename)
+            return None
+    except (OSError, korp_registry.RegistryError):
+        return None
+    try:
+        with open(filename, "rb") as lexicon_file:
+            lexicon = mmap.mmap(lexicon_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+        return None
+    header = lexicon.readline()
+    if not header.startswith("#total\t"):
+        lexicon.close()
+        return None
+    total = int(header.split("\t")[1])
+    encoding = form.get("encoding", config.CQP_ENCODING)
+
+    def read_lines():
+        try:
+            for line in iter(lexicon.readline, ""):
+                # Convert to the same format as the regular CQP count
+                line = line.rstrip("\n").decode(encoding, "ignore").replace("\t", " ", 1)
+                if len(line) < 65536:
+                    yield line
+        finally:
+            lexicon.close()
+
+    return read_lines(), total
+
+
 def loglike(form):
     """Runs a log-likelihood comparison on two queries.
     
@@ -1911,6 +2355,9 @@ def loglike(form):
     """
 
     import math
+    # The log-likelihoods are computed without NumPy if it is not
+    # installed
+    numpy = import_optional("numpy")
 
     def expected(total, wordtotal, sumtotal):
         """ The expected is that the words are uniformely distributed over the corpora. """
@@ -2004,6 +2451,58 @@ def loglike(form):
             max(nums) if nums else 0.0
         )
 
+    def compute_ll_stats_numpy(sets, count):
+        """ The same as compute_ll_stats(compute_list(...), count, sets),
+        but computing the log-likelihoods and directions of all words
+        with NumPy arrays. The values of the returned words and the
+        minimum and maximum are recomputed with compute_loglike for the
+        candidates near the cut-off points, so that they and the ties
+        are the same as without NumPy. The average may differ in the
+        last decimal in rare cases, as NumPy rounds differently. """
+        freq1, tot1 = sets[0]["freq"], sets[0]["total"]
+        freq2, tot2 = sets[1]["freq"], sets[1]["total"]
+        words = list(set(freq1.keys()).union(set(freq2.keys())))
+        if not words:
+            return ([], 0.0, 0.0, 0.0)
+        f1 = numpy.fromiter((freq1.get(w, 0) for w in words), dtype=float,
+                            count=len(words))
+        f2 = numpy.fromiter((freq2.get(w, 0) for w in words), dtype=float,
+                            count=len(words))
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            e1 = (f1 + f2) * (float(tot1) / (tot1 + tot2))
+            e2 = (f1 + f2) * (float(tot2) / (tot1 + tot2))
+            l1 = numpy.where(f1 > 0, f1 * numpy.log(f1 / e1), 0.0)
+            l2 = numpy.where(f2 > 0, f2 * numpy.log(f2 / e2), 0.0)
+            lls = numpy.round(2 * (l1 + l2), 2)
+            in_set1 = (f1 > 0) & ((f2 == 0) | (f1 / tot1 > f2 / tot2))
+
+        def exact(indices):
+            """ (ll, w) pairs for the words at indices, in descending order. """
+            return sorted(((compute_loglike((freq1.get(words[i], 0), tot1),
+                                            (freq2.get(words[i], 0), tot2)),
+                            words[i])
+                           for i in indices), reverse=True)
+
+        # A rounded log-likelihood differs from the NumPy value by at
+        # most 0.005 plus a rounding error, so words farther than 0.02
+        # below the cut-off need not be recomputed
+        margin = 0.02
+        new_list = []
+        for in_set, sign in [(in_set1, -1), (~in_set1, 1)]:
+            indices = numpy.flatnonzero(in_set)
+            if count and len(indices) > count:
+                cutoff = numpy.partition(lls[indices], len(indices) - count)[len(indices) - count]
+                indices = indices[lls[indices] >= cutoff - margin]
+            ll_ws = exact(indices)
+            if count:
+                ll_ws = ll_ws[:count]
+            new_list.extend((ll * sign, w) for (ll, w) in ll_ws)
+
+        avg = round(float(lls.sum()) / len(words), 2)
+        mi = exact(numpy.flatnonzero(lls <= lls.min() + margin))[-1][0]
+        ma = exact(numpy.flatnonzero(lls >= lls.max() - margin))[0][0]
+        return (new_list, avg, mi, ma)
+
     assert_key("set1_cqp", form, r"", True)
     assert_key("set2_cqp", form, r"", True)
     assert_key("set1_corpus", form, r"", True)
@@ -2044,7 +2543,13 @@ def loglike(form):
         form1["cqp"] = form.get("set1_cqp")
         form2["corpus"] = ",".join(set2)
         form2["cqp"] = form.get("set2_cqp")
-        count_result = [count(form1), count(form2)]
+        # The counts of the sets are independent, so run them
+        # concurrently; the progress reports of the two would be
+        # interleaved, so omit them
+        for form_set in (form1, form2):
+            form_set.pop("incremental", None)
+        with futures.ThreadPoolExecutor(max_workers=2) as executor:
+            count_result = list(executor.map(count, (form1, form2)))
     
         sets = [{}, {}]
         for i, cset in enumerate((set1, set2)):
@@ -2052,8 +2557,11 @@ def loglike(form):
             sets[i]["total"] = count_result_temp["total"]["sums"]["absolute"]
             sets[i]["freq"] = count_result_temp["total"]["absolute"]
     
-    ll_list = compute_list(sets[0]["freq"], sets[0]["total"], sets[1]["freq"], sets[1]["total"])
-    (ws, avg, mi, ma) = compute_ll_stats(ll_list, maxresults, sets)
+    if numpy is not None:
+        (ws, avg, mi, ma) = compute_ll_stats_numpy(sets, maxresults)
+    else:
+        ll_list = compute_list(sets[0]["freq"], sets[0]["total"], sets[1]["freq"], sets[1]["total"])
+        (ws, avg, mi, ma) = compute_ll_stats(ll_list, maxresults, sets)
     
     result = {"loglike": {}, "average": avg, "set1": {}, "set2": {}}
 
@@ -2080,11 +2588,25 @@ def lemgram_count(form):
        (default: all corpora)
      - count: what to count (lemgram/prefix/suffix)
        (default: lemgram)
+     - normalize: count all the lemgrams whose normalized form
+       (lowercased, possibly without diacritics) is that of a lemgram
+       in the list (true/false; requires config.LEMGRAM_INDEX_HAS_KEY)
+       (default: false)
+     - per_corpus: return for each lemgram an object with the total
+       count ("total") and the counts by corpus ("corpora") instead of
+       only the total (true/false)
+       (default: false)
+
+    The counts of each lemgram are cached in a file of their own by
+    the corpora and the other options, so that only the lemgrams not
+    counted before are counted from the database.
     """
 
     assert_key("lemgram", form, r"", True)
     assert_key("corpus", form, IS_IDENT)
     assert_key("count", form, r"(lemgram|prefix|suffix)")
+    assert_key("normalize", form, r"(true|false)")
+    assert_key("per_corpus", form, r"(true|false)")
     
     corpora = get_setvalued_param(form, "corpus", default=[])
     
@@ -2095,34 +2617,103 @@ def lemgram_count(form):
     lemgram = get_setvalued_param(form, "lemgram", alt_delim="")
     
     count = get_setvalued_param(form, "count", "lemgram")
-       
+
+    use_cache = bool(not form.get("cache", "").lower() == "false" and
+                     config.CACHE_DIR)
+    per_corpus = form.get("per_corpus", "").lower() == "true"
+    normalize = (form.get("normalize", "").lower() == "true"
+                 and config.LEMGRAM_INDEX_HAS_KEY)
+    if normalize:
+        lemgram = set(
+            korp_lemgram_index.normalize_lemgram(l.decode("utf-8"))
+            .encode("utf-8")
+            for l in lemgram)
+
+    # Map each lemgram in the parameter to a dict of the counts of the
+    # lemgrams found for it (only the lemgram itself unless
+    # normalize), empty if none was found
+    counts = {}
+    cachefilenames = {}
+    if use_cache:
+        for l in lemgram:
+            checksum = get_hash((sorted(corpora), sorted(count), normalize,
+                                 per_corpus, l))
+            cachefilenames[l] = os.path.join(config.CACHE_DIR,
+                                             "lemgramcount_" + checksum)
+            try:
+                with open(cachefilenames[l], "r") as cachefile:
+                    counts[l] = korp_json.load(cachefile)
+            except (IOError, ValueError):
+                # Not cached yet (or a broken cache file)
+                pass
+
+    missing = set(l for l in lemgram if l not in counts)
+    if missing:
+        counts.update(lemgram_count_query(
+            missing, corpora, count, normalize, per_corpus))
+        if use_cache:
+            unique_id = os.getenv("UNIQUE_ID")
+            for l in missing:
+                tmpfile = "%s.%s" % (cachefilenames[l], unique_id)
+                with open(tmpfile, "w") as cachefile:
+                    korp_json.dump(counts[l], cachefile)
+                os.rename(tmpfile, cachefilenames[l])
+
+    result = {}
+    for l in lemgram:
+        result.update(counts[l])
+    if "debug" in form:
+        result["DEBUG"] = {"cached": len(lemgram) - len(missing),
+                           "queried": len(missing)}
+    
+    return result
+
+
+def lemgram_count_query(lemgram, corpora, count, normalize=False,
+                        per_corpus=False):
+    """Count the lemgrams in the set lemgram (UTF-8) in corpora from
+    the database; a helper function for lemgram_count.
+
+    Return a dict mapping each lemgram in lemgram to a dict of the
+    counts of the lemgrams found for it: those with the normalized
+    form lemgram if normalize, otherwise lemgram itself. A count is
+    an integer, or a dict with the keys "total" and "corpora" if
+    per_corpus.
+    """
     counts = {"lemgram": "freq",
               "prefix": "freq_prefix",
               "suffix": "freq_suffix"}
     
     sums = " + ".join("SUM(%s)" % counts[c] for c in count)
+    lemgram_column = "lemgram_key" if normalize else "lemgram"
     
-    conn = MySQLdb.connect(use_unicode=True,
-                           charset="utf8",
-                           **config.DBCONNECT)
-    # Get Unicode objects even with collation utf8_bin; see
-    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
-    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
-        (None, conn.string_decoder)]
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        cursor = conn.cursor()
     
-    lemgram_sql = " lemgram IN (%s)" % "%s" % ", ".join(conn.escape(l).decode("utf-8") for l in lemgram)
-    corpora_sql = " AND corpus IN (%s)" % ", ".join("%s" % conn.escape(c) for c in corpora) if corpora else ""
+        lemgram_sql = " " + lemgram_column + " IN (%s)" % "%s" % ", ".join(conn.escape(l).decode("utf-8") for l in lemgram)
+        corpora_sql = " AND corpus IN (%s)" % ", ".join("%s" % conn.escape(c) for c in corpora) if corpora else ""
     
-    sql = "SELECT lemgram, " + sums + " FROM lemgram_index WHERE" + lemgram_sql + corpora_sql + " GROUP BY lemgram COLLATE utf8_bin;"
+        if per_corpus:
+            sql = "SELECT lemgram, " + sums + ", corpus FROM lemgram_index WHERE" + lemgram_sql + corpora_sql + " GROUP BY lemgram COLLATE utf8_bin, corpus;"
+        else:
+            sql = "SELECT lemgram, " + sums + " FROM lemgram_index WHERE" + lemgram_sql + corpora_sql + " GROUP BY lemgram COLLATE utf8_bin;"
     
-    result = {}
-    cursor.execute(sql)
+        result = dict((l, {}) for l in lemgram)
+        cursor.execute(sql)
 
-    for row in cursor:
-        # We need this check here, since a search for "hår" also returns "här" and "har".
-        if row[0].encode("utf-8") in lemgram and int(row[1]) > 0:
-            result[row[0]] = int(row[1])
+        for row in cursor:
+            # We need this check here, since a search for "hår" also returns "här" and "har".
+            row_lemgram = (korp_lemgram_index.normalize_lemgram(row[0])
+                           if normalize else row[0]).encode("utf-8")
+            if row_lemgram in lemgram and int(row[1]) > 0:
+                if per_corpus:
+                    l_counts = result[row_lemgram].setdefault(
+                        row[0], {"total": 0, "corpora": {}})
+                    l_counts["total"] += int(row[1])
+                    l_counts["corpora"][row[2]] = int(row[1])
+                else:
+                    result[row_lemgram][row[0]] = int(row[1])
+        cursor.close()
     
     return result
 
@@ -2200,58 +2791,57 @@ def timespan(form):
                     result["DEBUG"]["cache_read"] = True
                 return result
 
-    conn = MySQLdb.connect(use_unicode=True,
-                           charset="utf8",
-                           cursorclass=MySQLdb.cursors.SSCursor,
-                           **config.DBCONNECT)
-    cursor = conn.cursor()
+    with db_connection() as conn:
+        # Use an unbuffered cursor to process the rows as they arrive
+        cursor = conn.cursor(MySQLdb.cursors.SSCursor)
 
-    ns = {}
+        ns = {}
     
-    def anti_timeout_fun(queue):
-        corpora_sql = "(%s)" % ", ".join("%s" % conn.escape(c) for c in corpora)
+        def anti_timeout_fun(queue):
+            corpora_sql = "(%s)" % ", ".join("%s" % conn.escape(c) for c in corpora)
 
-        fromto = ""
+            fromto = ""
     
-        if strategy == 1:
-            if fromdate and todate:
-                fromto = " AND ((datefrom >= %s AND dateto <= %s) OR (datefrom <= %s AND dateto >= %s))" % (conn.escape(fromdate), conn.escape(todate), conn.escape(fromdate), conn.escape(todate))
-        elif strategy == 2:
-            if todate:
-                fromto += " AND datefrom <= %s" % conn.escape(todate)
-            if fromdate:
-                fromto = " AND dateto >= %s" % conn.escape(fromdate)
-        elif strategy == 3:
-            if fromdate:
-                fromto = " AND datefrom >= %s" % conn.escape(fromdate)
-            if todate:
-                fromto += " AND dateto <= %s" % conn.escape(todate)
+            if strategy == 1:
+                if fromdate and todate:
+                    fromto = " AND ((datefrom >= %s AND dateto <= %s) OR (datefrom <= %s AND dateto >= %s))" % (conn.escape(fromdate), conn.escape(todate), conn.escape(fromdate), conn.escape(todate))
+            elif strategy == 2:
+                if todate:
+                    fromto += " AND datefrom <= %s" % conn.escape(todate)
+                if fromdate:
+                    fromto = " AND dateto >= %s" % conn.escape(fromdate)
+            elif strategy == 3:
+                if fromdate:
+                    fromto = " AND datefrom >= %s" % conn.escape(fromdate)
+                if todate:
+                    fromto += " AND dateto <= %s" % conn.escape(todate)
 
-        # We do the granularity truncation and summation in the DB query if we can (depending on strategy), since it's much faster than doing it afterwards
+            # We do the granularity truncation and summation in the DB query if we can (depending on strategy), since it's much faster than doing it afterwards
         
-        timedata_corpus = "timedata_date" if granularity in ("y", "m", "d") else "timedata"
-        if strategy == 1:
-            # We need the full dates for this strategy, so no truncating the results
-            sql = "SELECT corpus, datefrom AS df, dateto AS dt, SUM(tokens) FROM " + timedata_corpus + " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
-        else:
-            sql = "SELECT corpus, LEFT(datefrom, " + str(shorten[granularity]) + ") AS df, LEFT(dateto, " + str(shorten[granularity]) + ") AS dt, SUM(tokens) FROM " + timedata_corpus + " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
-        cursor.execute(sql)
+            timedata_corpus = "timedata_date" if granularity in ("y", "m", "d") else "timedata"
+            if strategy == 1:
+                # We need the full dates for this strategy, so no truncating the results
+                sql = "SELECT corpus, datefrom AS df, dateto AS dt, SUM(tokens) FROM " + timedata_corpus + " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
+            else:
+                sql = "SELECT corpus, LEFT(datefrom, " + str(shorten[granularity]) + ") AS df, LEFT(dateto, " + str(shorten[granularity]) + ") AS dt, SUM(tokens) FROM " + timedata_corpus + " WHERE corpus IN " + corpora_sql + fromto + " GROUP BY corpus, df, dt ORDER BY NULL;"
+            cursor.execute(sql)
         
-        ns["result"] = timespan_calculator(cursor, granularity=granularity, spans=spans, combined=combined, per_corpus=per_corpus, strategy=strategy)
+            ns["result"] = timespan_calculator(cursor, granularity=granularity, spans=spans, combined=combined, per_corpus=per_corpus, strategy=strategy)
 
-        if use_cache:
-            tmpfile = "%s.%s" % (cachefile, unique_id)
-            with open(tmpfile, "w") as f:
-                cPickle.dump(ns["result"], f, protocol=-1)
-            os.rename(tmpfile, cachefile)
+            if use_cache:
+                tmpfile = "%s.%s" % (cachefile, unique_id)
+                with open(tmpfile, "w") as f:
+                    cPickle.dump(ns["result"], f, protocol=-1)
+                os.rename(tmpfile, cachefile)
         
-        if "debug" in form:
-            ns["result"].setdefault("DEBUG", {})
-            ns["result"]["DEBUG"]["cache_saved"] = True
+            if "debug" in form:
+                ns["result"].setdefault("DEBUG", {})
+                ns["result"]["DEBUG"]["cache_saved"] = True
 
-        queue.put("DONE")
+            queue.put("DONE")
 
-    anti_timeout_loop(anti_timeout_fun)
+        anti_timeout_loop(anti_timeout_fun)
+        cursor.close()
 
     return ns["result"]
 
@@ -2505,7 +3095,7 @@ def relations(form):
     
     if use_cache and os.path.exists(os.path.join(config.CACHE_DIR, "wordpicture_" + checksum)):
         with open(os.path.join(config.CACHE_DIR, "wordpicture_" + checksum), "r") as cachefile:
-            result = json.load(cachefile)
+            result = korp_json.load(cachefile)
             if "debug" in form:
                 result.setdefault("DEBUG", {})
                 result["DEBUG"]["cache_read"] = True
@@ -2513,141 +3103,206 @@ def relations(form):
     
     result = {}
 
-    conn = MySQLdb.connect(use_unicode=True,
-                           charset="utf8",
-                           **config.DBCONNECT)
-    # Get Unicode objects even with collation utf8_bin; see
-    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
-    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
-        (None, conn.string_decoder)]
-    cursor = conn.cursor()
-    cursor.execute("SET @@session.long_query_time = 1000;")
-    
-    # Get available tables
-    cursor.execute("SHOW TABLES LIKE '" + config.DBTABLE + "_%';")
-    tables = set(x[0] for x in cursor)
-    logging.debug("tables = %s", tables)
-    # Filter out corpora which doesn't exist in database
-    corpora = filter(lambda x: config.DBTABLE + "_" + x.upper() in tables, corpora)
-    if not corpora:
-        return {}
-    
-    selects = []
+    with db_connection() as conn:
+        cursor = conn.cursor()
     
-    if search_type == "lemgram":
-        lemgram_sql = conn.escape(word).decode("utf-8")
+        # Get available tables
+        tables = get_db_tables(cursor, config.DBTABLE)
+        logging.debug("tables = %s", tables)
+        # Filter out corpora which doesn't exist in database
+        corpora = filter_corpora_with_db_tables(corpora, config.DBTABLE, tables)
+        if not corpora:
+            cursor.close()
+            return {}
+
+        # Use the pre-aggregated table of a corpus group if the corpora
+        # are exactly those of the group. The minimum frequency applies
+        # to the frequencies in the individual corpora, which the group
+        # table does not have, so the per-corpus tables are used with it.
+        group_table = (find_wordpicture_group_table(cursor, corpora, tables)
+                       if not minfreq else None)
+        logging.debug("group_table = %s", group_table)
+    
+        selects = []
+    
+        if group_table:
+            selects = [(group_table, sql) for sql in
+                       relations_group_selects(conn, group_table, word, search_type)]
+        elif search_type == "lemgram":
+            lemgram_sql = conn.escape(word).decode("utf-8")
         
-        for corpus in corpora:
-            corpus_table = config.DBTABLE + "_" + corpus.upper()
-
-            selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
-                            u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                            u"WHERE S1.string = " + lemgram_sql + " COLLATE utf8_bin AND F.head = S1.id AND S2.id = F.dep " +
-                            minfreqsql +
-                            u"AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                            ))
-            selects.append((None, u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
-                            u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                            u"WHERE S2.string = " + lemgram_sql + " COLLATE utf8_bin AND F.dep = S2.id AND S1.id = F.head " +
-                            minfreqsql +
-                            u"AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                            ))
-    else:
-        word_sql = conn.escape(word).decode("utf-8")
-        word = word.decode("utf-8")
-        
-        for corpus in corpora:
-            corpus_table = config.DBTABLE + "_" + corpus.upper()
-    
-            selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
-                            u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                            u"WHERE S1.string = " + word_sql + " AND F.head = S1.id AND F.wfhead = 1 AND S2.id = F.dep " +
-                            minfreqsql +
-                            u"AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                            ))
-            selects.append((None, u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
-                            u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
-                            u"WHERE S2.string = " + word_sql + " AND F.dep = S2.id AND F.wfdep = 1 AND S1.id = F.head " +
-                            minfreqsql +
-                            u"AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
-                            ))
-
-    cursor_result = []
-    if incremental:
-        print '"progress_corpora": [%s],' % ('"' + '", "'.join(corpora) + '"' if corpora else "")
-        progress_count = 0
-        for sql in selects:
-            logging.debug("sql = %s", sql[1])
-            cursor.execute(sql[1])
-            cursor_result.extend(list(cursor))
-            if sql[0]:
-                print '"progress_%d": {"corpus": "%s"},' % (progress_count, sql[0])
-                progress_count += 1
-    else:    
-        sql = u" UNION ALL ".join(x[1] for x in selects)
-        logging.debug("sql = %s", sql)
-        cursor.execute(sql)
-        cursor_result = cursor
-    
-    rels = {}
-    counter = {}
-    freq_rel = {}
-    freq_head_rel = {}
-    freq_rel_dep = {}
-    
-    # 0     1        2    3    4       5         6     7         8              9             10      11
-    # head, headpos, rel, dep, deppos, depextra, freq, rel_freq, head_rel_freq, dep_rel_freq, corpus, id
-    
-    for row in cursor_result:
-        #       head    headpos
-        head = (row[0], row[1])
-        #      dep     deppos  depextra
-        dep = (row[3], row[4], row[5])
-        rels.setdefault((head, row[2], dep), {"freq": 0, "source": set()})
-        rels[(head, row[2], dep)]["freq"] += row[6]
-        rels[(head, row[2], dep)]["source"].add("%s:%d" % (row[10], row[11]))
-        #                   rel          corpus   rel        rel_freq
-        freq_rel.setdefault(row[2], {})[(row[10], row[2])] = row[7]
-        freq_head_rel.setdefault((head, row[2]), {})[(row[10], row[2])] = row[8]
-        freq_rel_dep.setdefault((row[2], dep), {})[(row[10], row[2])] = row[9]
-    
-    # Calculate MI
-    for rel in rels:
-        f_rel = sum(freq_rel[rel[1]].values())
-        f_head_rel = sum(freq_head_rel[(rel[0], rel[1])].values())
-        f_rel_dep = sum(freq_rel_dep[(rel[1], rel[2])].values())
-        rels[rel]["mi"] = rels[rel]["freq"] * math.log((f_rel * rels[rel]["freq"]) / (f_head_rel * f_rel_dep * 1.0), 2)
-    
-    sortedrels = sorted(rels.items(), key=lambda x: (x[0][1], x[1][sortby]), reverse=True)
-    
-    logging.debug("sortedrels = %s", sortedrels)
-
-    for rel in sortedrels:
-        counter.setdefault((rel[0][1], "h"), 0)
-        counter.setdefault((rel[0][1], "d"), 0)
-        if search_type == "lemgram" and rel[0][0][0] == word:
-            counter[(rel[0][1], "h")] += 1
-            if maxresults and counter[(rel[0][1], "h")] > maxresults:
-                continue
+            for corpus in corpora:
+                corpus_table = config.DBTABLE + "_" + corpus.upper()
+
+                selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
+                                u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
+                                u"WHERE S1.string = " + lemgram_sql + " COLLATE utf8_bin AND F.head = S1.id AND S2.id = F.dep " +
+                                minfreqsql +
+                                u"AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
+                                ))
+                selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
+                                u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
+                                u"WHERE S2.string = " + lemgram_sql + " COLLATE utf8_bin AND F.dep = S2.id AND S1.id = F.head " +
+                                minfreqsql +
+                                u"AND F.bfhead = 1 AND F.bfdep = 1 AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
+                                ))
         else:
-            counter[(rel[0][1], "d")] += 1
-            if maxresults and counter[(rel[0][1], "d")] > maxresults:
-                continue
+            word_sql = conn.escape(word).decode("utf-8")
+            word = word.decode("utf-8")
+        
+            for corpus in corpora:
+                corpus_table = config.DBTABLE + "_" + corpus.upper()
+    
+                selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
+                                u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
+                                u"WHERE S1.string = " + word_sql + " AND F.head = S1.id AND F.wfhead = 1 AND S2.id = F.dep " +
+                                minfreqsql +
+                                u"AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
+                                ))
+                selects.append((corpus.upper(), u"(SELECT S1.string AS head, S1.pos AS headpos, F.rel, S2.string AS dep, S2.pos AS deppos, S2.stringextra AS depextra, F.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq, DR.freq AS dep_rel_freq, " + conn.string_literal(corpus.upper()) + u" AS corpus, F.id " +
+                                u"FROM `" + corpus_table + "_strings` AS S1, `" + corpus_table + "_strings` AS S2, `" + corpus_table + "` AS F, `" + corpus_table + "_rel` AS R, `" + corpus_table + "_head_rel` AS HR, `" + corpus_table + "_dep_rel` AS DR " +
+                                u"WHERE S2.string = " + word_sql + " AND F.dep = S2.id AND F.wfdep = 1 AND S1.id = F.head " +
+                                minfreqsql +
+                                u"AND F.rel = R.rel AND F.head = HR.head AND F.rel = HR.rel AND F.dep = DR.dep AND F.rel = DR.rel)"
+                                ))
+
+        # Only the top maxresults relations of each relation type are
+        # shown, so when the ranking is known in SQL, fetch only them from
+        # the database. This is possible for a single corpus, for which MI
+        # can be calculated from the component frequencies in its tables,
+        # and for a corpus group table, which has the summed frequencies
+        # and MI. With multiple corpora otherwise, summing the frequencies
+        # over the corpora may change the ranking, so all relations are
+        # fetched and ranked below. The top-N selection thus applies only
+        # to requests for a single corpus or a corpus group.
+        if maxresults and sortby in ("freq", "mi") and (len(corpora) == 1 or group_table):
+            cursor.execute(u" UNION ".join(
+                u"SELECT rel FROM `" + config.DBTABLE + "_" + corpus.upper() + "_rel`"
+                for corpus in corpora) + u";")
+            rel_types = sorted(set(row[0] for row in cursor))
+            if group_table:
+                rel_column = u"rel"
+                order_by = sortby
+                other_columns = [u"dep", u"head"]
+            else:
+                rel_column = u"F.rel"
+                order_by = (u"F.freq" if sortby == "freq"
+                            else u"F.freq * LOG2((R.freq * F.freq) / (HR.freq * DR.freq))")
+                other_columns = [u"S2.string", u"S1.string"]
+            # A relation of the word with itself is selected by both the
+            # head and the dep select, so its frequency is doubled in
+            # merge_rows and a lemgram search counts it for the head below.
+            # The top-N selection would rank it by its single frequency
+            # (and let it take the place of a dependent), so all such rows
+            # are fetched in addition to the top rows.
+            word_cond = conn.escape(form.get("word")).decode("utf-8")
+            if search_type == "lemgram":
+                word_cond += u" COLLATE utf8_bin"
+            selects = [(corpus, relations_top_n_select(conn, sql, rel_column, rel_types, order_by, maxresults,
+                                                       u"%s = %s" % (other_column, word_cond)))
+                       for (corpus, sql), other_column in zip(selects, other_columns)]
+
+        rels = {}
+        counter = {}
+        freq_rel = {}
+        freq_head_rel = {}
+        freq_rel_dep = {}
+
+        def merge_rows(rows, group_source=False):
+            # 0     1        2    3    4       5         6     7         8              9             10      11
+            # head, headpos, rel, dep, deppos, depextra, freq, rel_freq, head_rel_freq, dep_rel_freq, corpus, id
+            # In the rows of a corpus group table, 11 is the source
+            # (a comma-separated list of corpus:id) instead of id
+            for row in rows:
+                #       head    headpos
+                head = (row[0], row[1])
+                #      dep     deppos  depextra
+                dep = (row[3], row[4], row[5])
+                rels.setdefault((head, row[2], dep), {"freq": 0, "source": set()})
+                rels[(head, row[2], dep)]["freq"] += row[6]
+                if group_source:
+                    rels[(head, row[2], dep)]["source"].update(row[11].split(","))
+                else:
+                    rels[(head, row[2], dep)]["source"].add("%s:%d" % (row[10], row[11]))
+                #                   rel          corpus   rel        rel_freq
+                freq_rel.setdefault(row[2], {})[(row[10], row[2])] = row[7]
+                freq_head_rel.setdefault((head, row[2]), {})[(row[10], row[2])] = row[8]
+                freq_rel_dep.setdefault((row[2], dep), {})[(row[10], row[2])] = row[9]
 
-        r = {"head": rel[0][0][0],
-             "headpos": rel[0][0][1],
-             "rel": rel[0][1],
-             "dep": rel[0][2][0],
-             "deppos": rel[0][2][1],
-             "depextra": rel[0][2][2],
-             "freq": rel[1]["freq"],
-             "mi": rel[1]["mi"],
-             "source": list(rel[1]["source"])
-             }
-        result.setdefault("relations", []).append(r)
+        if incremental:
+            print '"progress_corpora": [%s],' % ('"' + '", "'.join(corpora) + '"' if corpora else "")
+
+        if group_table:
+            sql = u" UNION ALL ".join(x[1] for x in selects)
+            logging.debug("sql = %s", sql)
+            cursor.execute(sql)
+            merge_rows(cursor, group_source=True)
+            if incremental:
+                for progress_count, corpus in enumerate(corpora):
+                    print '"progress_%d": {"corpus": "%s"},' % (progress_count, corpus)
+        elif config.DB_PARALLEL_THREADS > 1 and len(corpora) > 1:
+            # Run the queries of each corpus in a separate thread with a
+            # connection of its own, so that the database server can
+            # evaluate them in parallel, and merge the rows of each
+            # corpus as soon as its queries have completed.
+            corpus_selects = []
+            for corpus, sql in selects:
+                if not corpus_selects or corpus_selects[-1][0] != corpus:
+                    corpus_selects.append((corpus, []))
+                corpus_selects[-1][1].append(sql)
+            relations_query_parallel(corpus_selects, merge_rows, incremental)
+        elif incremental:
+            progress_count = 0
+            for i, sql in enumerate(selects):
+                logging.debug("sql = %s", sql[1])
+                cursor.execute(sql[1])
+                merge_rows(cursor)
+                # Report progress when all the queries of a corpus are done
+                if i + 1 == len(selects) or selects[i + 1][0] != sql[0]:
+                    print '"progress_%d": {"corpus": "%s"},' % (progress_count, sql[0])
+                    progress_count += 1
+        else:    
+            sql = u" UNION ALL ".join(x[1] for x in selects)
+            logging.debug("sql = %s", sql)
+            cursor.execute(sql)
+            merge_rows(cursor)
+    
+        # Calculate MI
+        for rel in rels:
+            f_rel = sum(freq_rel[rel[1]].values())
+            f_head_rel = sum(freq_head_rel[(rel[0], rel[1])].values())
+            f_rel_dep = sum(freq_rel_dep[(rel[1], rel[2])].values())
+            rels[rel]["mi"] = rels[rel]["freq"] * math.log((f_rel * rels[rel]["freq"]) / (f_head_rel * f_rel_dep * 1.0), 2)
+    
+        sortedrels = sorted(rels.items(), key=lambda x: (x[0][1], x[1][sortby]), reverse=True)
+    
+        logging.debug("sortedrels = %s", sortedrels)
+
+        for rel in sortedrels:
+            counter.setdefault((rel[0][1], "h"), 0)
+            counter.setdefault((rel[0][1], "d"), 0)
+            if search_type == "lemgram" and rel[0][0][0] == word:
+                counter[(rel[0][1], "h")] += 1
+                if maxresults and counter[(rel[0][1], "h")] > maxresults:
+                    continue
+            else:
+                counter[(rel[0][1], "d")] += 1
+                if maxresults and counter[(rel[0][1], "d")] > maxresults:
+                    continue
+
+            r = {"head": rel[0][0][0],
+                 "headpos": rel[0][0][1],
+                 "rel": rel[0][1],
+                 "dep": rel[0][2][0],
+                 "deppos": rel[0][2][1],
+                 "depextra": rel[0][2][2],
+                 "freq": rel[1]["freq"],
+                 "mi": rel[1]["mi"],
+                 "source": list(rel[1]["source"])
+                 }
+            result.setdefault("relations", []).append(r)
     
-    cursor.close()
-    conn.close()
+        cursor.close()
     
     if use_cache:
         unique_id = os.getenv("UNIQUE_ID")
@@ -2655,7 +3310,7 @@ def relations(form):
         tmpfile = "%s.%s" % (cachefilename, unique_id)
     
         with open(tmpfile, "w") as cachefile:
-            json.dump(result, cachefile)
+            korp_json.dump(result, cachefile)
         os.rename(tmpfile, cachefilename)
         
         if "debug" in form:
@@ -2665,6 +3320,130 @@ def relations(form):
     return result
 
 
+def find_wordpicture_group_table(cursor, corpora, tables):
+    """Return the name of the combined word picture table of the corpus
+    group consisting of exactly the corpora, or None if there is no
+    such group.
+
+    The groups are listed in config.WORDPICTURE_CORPUS_GROUPS and
+    their tables are built with korp_build_wordpicture_groups.py. The
+    corpora of a group are compared with those recorded in the table
+    DBTABLE_group_NAME_corpora when the group table was built, so that
+    a stale group table is not used if the configuration has changed.
+    The recorded corpora are read along with the catalogue of database
+    tables (see get_db_catalogue). tables is the set of word picture
+    tables in the database.
+    """
+    corpora = set(corpora)
+    group_corpora = get_db_catalogue(cursor)["groups"]
+    for group in sorted(config.WORDPICTURE_CORPUS_GROUPS):
+        group_table = config.DBTABLE + "_group_" + group
+        if (group_table in tables
+                and set(group_corpora.get(group_table, [])) == corpora):
+            return group_table
+    return None
+
+
+def relations_group_selects(conn, group_table, word, search_type):
+    """Return a list of parenthesized SQL statements selecting the word
+    picture relations of word (of search_type "lemgram" or "word") from
+    the pre-aggregated corpus group table group_table, with word as the
+    head and as the dependent.
+
+    The result rows contain the same columns as those selected from
+    the tables of individual corpora, with the frequencies summed over
+    the corpora of the group: head, headpos, rel, dep, deppos,
+    depextra, freq, rel_freq, head_rel_freq, dep_rel_freq, corpus (the
+    name of group_table) and source (a comma-separated list of
+    corpus:id) instead of id.
+    """
+    word_sql = conn.escape(word).decode("utf-8")
+    if search_type == "lemgram":
+        # Lemgrams are compared case-sensitively
+        word_sql += u" COLLATE utf8_bin"
+        head_cond = dep_cond = u"bfhead = 1 AND bfdep = 1"
+    else:
+        head_cond = u"wfhead = 1"
+        dep_cond = u"wfdep = 1"
+    return [u"(SELECT head, headpos, rel, dep, deppos, depextra, freq,"
+            u" rel_freq, head_rel_freq, dep_rel_freq, "
+            + conn.string_literal(group_table) + u" AS corpus, source"
+            u" FROM `" + group_table + u"` WHERE " + word_col + u" = "
+            + word_sql + u" AND " + cond + u")"
+            for word_col, cond in [(u"head", head_cond), (u"dep", dep_cond)]]
+
+
+def relations_top_n_select(conn, select, rel_column, rel_types, order_by, maxresults,
+                           unlimited_cond=None):
+    """Return an SQL statement selecting the top maxresults rows of each
+    relation type in rel_types from the result of select.
+
+    select is a parenthesized SELECT statement with a WHERE clause,
+    rel_column is the name of its relation type column and order_by
+    is the expression by which to rank the rows in descending order.
+    If unlimited_cond is given, the rows matching it are excluded from
+    the ranking and all of them are selected in addition to the top
+    rows. If rel_types is empty, return select as such.
+    """
+    if not rel_types:
+        return select
+    select = select.strip()[1:-1]
+    limited_cond = u" AND NOT (%s)" % unlimited_cond if unlimited_cond else u""
+    top_n_selects = [
+        u"(%s AND %s = %s%s ORDER BY %s DESC LIMIT %d)"
+        % (select, rel_column, conn.escape(rel).decode("utf-8"), limited_cond,
+           order_by, maxresults)
+        for rel in rel_types]
+    if unlimited_cond:
+        top_n_selects.append(u"(%s AND %s)" % (select, unlimited_cond))
+    return u" UNION ALL ".join(top_n_selects)
+
+
+def relations_query_parallel(corpus_selects, merge_rows, incremental=False):
+    """Execute word picture SQL queries for multiple corpora in parallel.
+
+    corpus_selects is a list of pairs (corpus, sqls), where sqls is a
+    list of SQL statements for the corpus. The statements of each
+    corpus are executed in a separate thread using a database
+    connection of its own, at most config.DB_PARALLEL_THREADS at a
+    time. The function merge_rows is called with the result rows of
+    each corpus as soon as all its statements have completed; the
+    calls are made from a single thread. If incremental is True,
+    report the progress after each completed corpus.
+    """
+
+    def query_corpus_relations(sqls):
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            rows = []
+            for sql in sqls:
+                logging.debug("sql = %s", sql)
+                cursor.execute(sql)
+                rows.extend(cursor.fetchall())
+            cursor.close()
+        return rows
+
+    ns = Namespace()
+    ns.progress_count = 0
+
+    with futures.ThreadPoolExecutor(max_workers=config.DB_PARALLEL_THREADS) as executor:
+        future_query = dict((executor.submit(query_corpus_relations, sqls), corpus)
+                            for corpus, sqls in corpus_selects)
+
+        def anti_timeout(queue):
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                if future.exception() is not None:
+                    raise future.exception()
+                merge_rows(future.result())
+                if incremental:
+                    queue.put('"progress_%d": {"corpus": "%s"},' % (ns.progress_count, corpus))
+                    ns.progress_count += 1
+            queue.put("DONE")
+
+        anti_timeout_loop(anti_timeout)
+
+
 ################################################################################
 # RELATIONS_SENTENCES
 ################################################################################
@@ -2685,8 +3464,6 @@ def relations_sentences(form):
      - show_struct
     """
 
-    from copy import deepcopy
-    
     assert_key("source", form, "", True)
     assert_key("start", form, IS_NUMBER, False)
     assert_key("end", form, IS_NUMBER, False)
@@ -2706,60 +3483,57 @@ def relations_sentences(form):
     
     start = int(form.get("start", "0"))
     end = int(form.get("end", "99"))
-    shown = form.get("show", "word")
+    shown = get_setvalued_param(form, "show", default=[])
+    shown.add("word")
     shown_structs = get_setvalued_param(form, "show_struct", default=[])
     
     querystarttime = time.time()
 
-    conn = MySQLdb.connect(**config.DBCONNECT)
-    # Get Unicode objects even with collation utf8_bin; see
-    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
-    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
-        (None, conn.string_decoder)]
-    cursor = conn.cursor()
-    cursor.execute("SET @@session.long_query_time = 1000;")
-    selects = []
-    counts = []
-    
-    # Get available tables
-    cursor.execute("SHOW TABLES LIKE '" + config.DBTABLE + "_%';")
-    tables = set(x[0] for x in cursor)
-    # Filter out corpora which doesn't exist in database
-    source = sorted(filter(lambda x: config.DBTABLE + "_" + x[0].upper() in tables, source.iteritems()))
-    if not source:
-        return {}
-    corpora = [x[0] for x in source]
-    
-    for s in source:
-        corpus, ids = s
-        ids = [conn.escape(i) for i in ids]
-        ids_list = "(" + ", ".join(ids) + ")"
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        selects = []
+        counts = []
+    
+        # Get available tables
+        tables = get_db_tables(cursor, config.DBTABLE)
+        # Filter out corpora which doesn't exist in database
+        source = sorted((corpus, source[corpus]) for corpus in
+                        filter_corpora_with_db_tables(source, config.DBTABLE, tables))
+        if not source:
+            cursor.close()
+            return {}
+        corpora = [x[0] for x in source]
+    
+        for s in source:
+            corpus, ids = s
+            ids = [conn.escape(i) for i in ids]
+            ids_list = "(" + ", ".join(ids) + ")"
         
-        corpus_table_sentences = config.DBTABLE + "_" + corpus.upper() + "_sentences"
+            corpus_table_sentences = config.DBTABLE + "_" + corpus.upper() + "_sentences"
         
-        selects.append(u"(SELECT S.sentence, S.start, S.end, " + conn.string_literal(corpus.upper()) + u" AS corpus " +
-                       u"FROM `" + corpus_table_sentences + u"` as S " +
-                       u" WHERE S.id IN " + ids_list + u")"
-                       )
-        counts.append(u"(SELECT " + conn.string_literal(corpus.upper()) + u" AS corpus, COUNT(*) FROM `" + corpus_table_sentences + "` as S WHERE S.id IN " + ids_list + u")")
+            selects.append(u"(SELECT S.sentence, S.start, S.end, " + conn.string_literal(corpus.upper()) + u" AS corpus " +
+                           u"FROM `" + corpus_table_sentences + u"` as S " +
+                           u" WHERE S.id IN " + ids_list + u")"
+                           )
+            counts.append(u"(SELECT " + conn.string_literal(corpus.upper()) + u" AS corpus, COUNT(*) FROM `" + corpus_table_sentences + "` as S WHERE S.id IN " + ids_list + u")")
 
-    sql_count = u" UNION ALL ".join(counts)
-    cursor.execute(sql_count)
+        sql_count = u" UNION ALL ".join(counts)
+        cursor.execute(sql_count)
     
-    corpus_hits = {}
-    for row in cursor:
-        corpus_hits[row[0]] = int(row[1])
+        corpus_hits = {}
+        for row in cursor:
+            corpus_hits[row[0]] = int(row[1])
     
-    sql = u" UNION ALL ".join(selects) + (u" LIMIT %d, %d" % (start, end - 1))
-    cursor.execute(sql)
+        sql = u" UNION ALL ".join(selects) + (u" LIMIT %d, %d" % (start, end - 1))
+        cursor.execute(sql)
     
-    querytime = time.time() - querystarttime
-    corpora_dict = {}
-    for row in cursor:
-        # 0 sentence, 1 start, 2 end, 3 corpus
-        corpora_dict.setdefault(row[3], {}).setdefault(row[0], []).append((row[1], row[2]))
+        querytime = time.time() - querystarttime
+        corpora_dict = {}
+        for row in cursor:
+            # 0 sentence, 1 start, 2 end, 3 corpus
+            corpora_dict.setdefault(row[3], {}).setdefault(row[0], []).append((row[1], row[2]))
 
-    cursor.close()
+        cursor.close()
     
     total_hits = sum(corpus_hits.values())
 
@@ -2768,37 +3542,8 @@ def relations_sentences(form):
     
     cqpstarttime = time.time()
     result = {}
-    
-    for corp, sids in sorted(corpora_dict.items(), key=lambda x: x[0]):
-        cqp = u'<sentence_id="%s"> []* </sentence_id> within sentence' % "|".join(set(sids.keys()))
-        q = {"cqp": cqp,
-             "corpus": corp,
-             "start": "0",
-             "end": str(end - start),
-             "show_struct": ["sentence_id"] + list(shown_structs),
-             "defaultcontext": "1 sentence"}
-        if shown:
-            q["show"] = shown
-        result_temp = query(q)
-
-        # Loop backwards since we might be adding new items
-        for i in range(len(result_temp["kwic"]) - 1, -1, -1):
-            s = result_temp["kwic"][i]
-            sid = s["structs"]["sentence_id"]
-            r = sids[sid][0]
-            s["match"]["start"] = min(map(int, r)) - 1
-            s["match"]["end"] = max(map(int, r))
-            
-            # If the same relation appears more than once in the same sentence,
-            # append copies of the sentence as separate results
-            for r in sids[sid][1:]:
-                s2 = deepcopy(s)
-                s2["match"]["start"] = min(map(int, r)) - 1
-                s2["match"]["end"] = max(map(int, r))
-                result_temp["kwic"].insert(i + 1, s2)
-    
-        result.setdefault("kwic", []).extend(result_temp["kwic"])
-
+    result["kwic"] = query_sentences(corpora_dict, end - start, shown,
+                                     shown_structs, "1 sentence")
     result["hits"] = total_hits
     result["corpus_hits"] = corpus_hits
     result["corpus_order"] = corpora
@@ -2808,6 +3553,145 @@ def relations_sentences(form):
     return result
 
 
+def query_sentences(corpora_dict, end, shown, shown_structs, defaultcontext,
+                    contexts=None):
+    """Retrieve the KWIC rows of the sentences in corpora_dict.
+
+    corpora_dict maps corpus ids to dicts mapping sentence ids to
+    lists of (start, end) pairs of match positions relative to the
+    sentence. At most end + 1 sentences are retrieved per corpus. The
+    corpora are queried in parallel. A sentence containing several
+    matches is repeated for each match, with only the match positions
+    differing.
+
+    The context is defaultcontext, unless contexts (a dict of context
+    parameter values by corpus) contains one for the corpus.
+
+    Return a list of the rows of all the corpora, sorted by corpus.
+    """
+    shown_structs = set(shown_structs) | set(["sentence_id"])
+    contexts = contexts or {}
+    corpora_kwics = {}
+
+    with futures.ThreadPoolExecutor(max_workers=config.PARALLEL_THREADS) as executor:
+        future_query = {}
+        for corpus, sids in corpora_dict.iteritems():
+            form = {"defaultcontext": defaultcontext}
+            if contexts.get(corpus):
+                form["context"] = contexts[corpus]
+            future_query[executor.submit(
+                query_corpus_sentences, form, corpus, sids, end, shown,
+                shown_structs)] = corpus
+
+        def anti_timeout(queue):
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                if future.exception() is not None:
+                    raise CQPError(future.exception())
+                corpora_kwics[corpus] = future.result()
+            queue.put("DONE")
+
+        anti_timeout_loop(anti_timeout)
+
+    kwic = []
+    for corpus in sorted(corpora_kwics):
+        kwic.extend(corpora_kwics[corpus])
+    return kwic
+
+
+def query_corpus_sentences(form, corpus, sids, end, shown, shown_structs):
+    """Retrieve the KWIC rows of the sentences sids in corpus; a helper
+    function for query_sentences.
+
+    The sentences are located by their corpus positions in the
+    sentence index of the corpus if it has an up-to-date one, and the
+    rest by a CQP query on their ids.
+    """
+    positions, missing = get_sentence_positions(corpus, sids)
+    kwic = []
+    if positions:
+        undump_file = tempfile.NamedTemporaryFile(
+            dir=config.TMPDIR or None, prefix="korp_sentences_",
+            delete=False)
+        try:
+            with undump_file:
+                for sent_start, sent_end in positions:
+                    undump_file.write("%d\t%d\n" % (sent_start, sent_end))
+            kwic, _ = query_and_parse(form, corpus, [], {}, shown,
+                                      shown_structs, 0, end,
+                                      undump_file=undump_file.name)
+        finally:
+            os.remove(undump_file.name)
+    if missing:
+        cqp = [u'<sentence_id="%s"> []* </sentence_id> within sentence'
+               % "|".join(missing)]
+        missing_kwic, _ = query_and_parse(form, corpus, cqp, {}, shown,
+                                          shown_structs, 0, end)
+        if kwic:
+            kwic = sorted(kwic + missing_kwic,
+                          key=lambda row: row["match"]["position"])[:end + 1]
+        else:
+            kwic = missing_kwic
+
+    result = []
+    for row in kwic:
+        # If the same relation or name appears more than once in the
+        # same sentence, add shallow copies of the row as separate
+        # results, changing only the match positions. Skip a sentence
+        # with an unrequested id, which a sentence index could only
+        # return if it did not match the corpus.
+        for match in sids.get(row["structs"].get("sentence_id"), []):
+            result.append(dict(row, match=dict(
+                row["match"],
+                start=min(map(int, match)) - 1,
+                end=max(map(int, match)))))
+    return result
+
+
+def get_sentence_positions(corpus, sentence_ids):
+    """Return a pair of a sorted list of the (start, end) corpus
+    positions of the sentences with the ids sentence_ids in corpus and
+    a sorted list of the ids whose positions were not found.
+
+    The positions are read from the sentence index of the corpus
+    built with korp_build_sentence_index.py. All the ids are returned
+    as not found if config.SENTENCE_INDEX_DIR is not set, or if the
+    corpus has no sentence index or one older than the corpus data.
+    """
+    sentence_ids = sorted(set(sentence_ids))
+    if not config.SENTENCE_INDEX_DIR:
+        return [], sentence_ids
+    index_name = os.path.join(config.SENTENCE_INDEX_DIR, corpus.lower())
+    # Depending on the dbm implementation, the index may consist of
+    # several files with extensions
+    index_mtimes = [os.path.getmtime(filename)
+                    for filename in glob.glob(index_name) + glob.glob(index_name + ".*")]
+    try:
+        data_mtime = korp_registry.get_attribute_mtime(
+            corpus, ["word", "sentence_id"])
+    except korp_registry.RegistryError:
+        data_mtime = None
+    if not index_mtimes or (data_mtime is not None
+                             and min(index_mtimes) < data_mtime):
+        return [], sentence_ids
+    try:
+        index = anydbm.open(index_name, "r")
+    except anydbm.error:
+        return [], sentence_ids
+    positions = []
+    missing = []
+    try:
+        for sentence_id in sentence_ids:
+            value = index.get(sentence_id.encode("utf-8"))
+            if value:
+                positions.append(tuple(int(pos) for pos in value.split("\t")))
+            else:
+                missing.append(sentence_id)
+    finally:
+        index.close()
+    return sorted(positions), missing
+
+
 ################################################################################
 # NAMES
 ################################################################################
@@ -2867,78 +3751,53 @@ def names(form):
         os.path.exists(os.path.join(config.CACHE_DIR, "names_" + checksum))):
         with open(os.path.join(
                 config.CACHE_DIR, "names_" + checksum), "r") as cachefile:
-            result = json.load(cachefile)
+            result = korp_json.load(cachefile)
             if "debug" in form:
                 result.setdefault("DEBUG", {})
                 result["DEBUG"]["cache_read"] = True
             return result
     
-    conn = MySQLdb.connect(use_unicode=True,
-                           charset="utf8",
-                           **config.DBCONNECT)
-    # Get Unicode objects even with collation utf8_bin; see
-    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
-    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
-        (None, conn.string_decoder)]
-    cursor = conn.cursor()
-    cursor.execute("SET @@session.long_query_time = 1000;")
-    
-    # Get available tables
-    cursor.execute("SHOW TABLES LIKE '" + config.DBTABLE_NAMES + "_%';")
-    tables = set(x[0] for x in cursor)
-    logging.debug("tables: %s", tables)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Get available tables
+        tables = get_db_tables(cursor, config.DBTABLE_NAMES)
+        logging.debug("tables: %s", tables)
+        cursor.close()
     # Filter out corpora which do not exist in database
-    corpora = filter(lambda x: config.DBTABLE_NAMES + "_" + x.upper() in tables,
-                     corpora)
+    corpora = filter_corpora_with_db_tables(corpora, config.DBTABLE_NAMES,
+                                            tables)
     logging.debug('corpora: %s', corpora)
     if not corpora:
         return {}
 
-    (defaultwithin, within_all) = _get_default_and_corpus_specific_param(
-        form, "within", "defaultwithin", "sentence")
-    (default_nameswithin, nameswithin_all) = \
-        _get_default_and_corpus_specific_param(
-        form, "nameswithin", "default_nameswithin", "text_id")
-
     if incremental:
         print '"progress_corpora": [%s],' % ('"' + '", "'.join(corpora) + '"'
                                              if corpora else "")
-        progress_count = 0
 
-    name_freqs = {}
     cqp = cqp[0]
 
-    for corpus in corpora:
-
-        within = within_all.get(corpus, defaultwithin)
-        nameswithin = nameswithin_all.get(corpus, default_nameswithin)
-        text_ids = _names_find_matching_texts(
-            form, corpus, cqp, within, nameswithin)
-        if not text_ids:
-            continue
-
+    def query_corpus_names(conn, cursor, corpus, text_ids):
         corpus_table = config.DBTABLE_NAMES + "_" + corpus.upper()
-        # Use literal single quotes, since conn.escape() does not seem
-        # to quote strings as expected. Why?
-        text_ids_in = ",".join("'" + text_id + "'" for text_id in text_ids)
-        # logging.debug("text_ids: %s", text_ids)
-        # logging.debug("text_ids_in: %s", text_ids_in)
-
+        texts_from, texts_where = _names_text_ids_sql(
+            cursor, corpus_table, text_ids, "N")
         select = u"""SELECT NS.name, NS.category, N.name_id, sum(N.freq)
                      FROM `{corptbl}` as N, `{corptbl}_strings` as NS
-                     WHERE N.name_id = NS.id and N.text_id IN ({text_ids})
+                          {texts_from}
+                     WHERE N.name_id = NS.id {texts_where}
                      GROUP BY NS.id;""".format(
             corptbl=corpus_table,
-            text_ids=text_ids_in)
+            texts_from=texts_from,
+            texts_where=texts_where)
         logging.debug('select: %s', select)
-
         cursor.execute(select)
+        return cursor.fetchall()
 
-        if incremental:
-            print '"progress_%d": {"corpus": "%s"},' % (progress_count, corpus)
-            progress_count += 1
+    corpus_rows = _names_query_corpora(form, corpora, cqp, query_corpus_names,
+                                       incremental)
 
-        for row in cursor:
+    name_freqs = {}
+    for corpus in corpora:
+        for row in corpus_rows.get(corpus, []):
             logging.debug('row: %s', row)
             name, cat, name_id, freq = row
             cat_freqs = name_freqs.setdefault(cat, {})
@@ -2946,9 +3805,6 @@ def names(form):
             cat_freqs[name] = (prev_freq + int(freq),
                                (prev_source + [corpus + ":" + str(name_id)]))
 
-    cursor.close()
-    conn.close()
-
     # An empty name_groups indicates that no names were found with the
     # query, whereas a completely empty result indicates that the
     # selected corpora have no name information.
@@ -2991,7 +3847,7 @@ def names(form):
         tmpfile = "%s.%s" % (cachefilename, unique_id)
 
         with open(tmpfile, "w") as cachefile:
-            json.dump(result, cachefile)
+            korp_json.dump(result, cachefile)
         os.rename(tmpfile, cachefilename)
 
         if "debug" in form:
@@ -3025,9 +3881,115 @@ def _get_default_and_corpus_specific_param(form, param_name,
     return (default, corpus_specific)
 
 
+def _names_query_corpora(form, corpora, cqp, query_func, incremental=False):
+    """Run the name database queries of corpora and return a dict of
+    their results by corpus.
+
+    query_func(conn, cursor, corpus, text_ids) runs the queries of
+    corpus and returns the result. If cqp is non-empty, text_ids is
+    the list of the ids of the texts of corpus with matches for cqp,
+    and corpora without any such texts are omitted from the result;
+    otherwise text_ids is None. The corpora are processed in parallel,
+    each with a database connection of its own, at most
+    config.DB_PARALLEL_THREADS at a time. If incremental is True,
+    report the progress after each completed corpus.
+
+    A helper function used by names and names_sentences.
+    """
+    if cqp:
+        (defaultwithin, within_all) = _get_default_and_corpus_specific_param(
+            form, "within", "defaultwithin", "sentence")
+        (default_nameswithin, nameswithin_all) = \
+            _get_default_and_corpus_specific_param(
+            form, "nameswithin", "default_nameswithin", "text_id")
+
+    def query_corpus(corpus):
+        text_ids = None
+        if cqp:
+            within = within_all.get(corpus, defaultwithin)
+            nameswithin = nameswithin_all.get(corpus, default_nameswithin)
+            text_ids = _names_find_matching_texts(
+                form, corpus, cqp, within, nameswithin)
+            if not text_ids:
+                return None
+        with db_connection() as conn:
+            cursor = conn.cursor()
+            result = query_func(conn, cursor, corpus, text_ids)
+            cursor.close()
+        return result
+
+    ns = Namespace()
+    ns.progress_count = 0
+    results = {}
+
+    with futures.ThreadPoolExecutor(max_workers=max(config.DB_PARALLEL_THREADS, 1)) as executor:
+        future_query = dict((executor.submit(query_corpus, corpus), corpus)
+                            for corpus in corpora)
+
+        def anti_timeout(queue):
+            for future in futures.as_completed(future_query):
+                corpus = future_query[future]
+                if future.exception() is not None:
+                    raise future.exception()
+                if future.result() is not None:
+                    results[corpus] = future.result()
+                if incremental:
+                    queue.put('"progress_%d": {"corpus": "%s"},' % (ns.progress_count, corpus))
+                    ns.progress_count += 1
+            queue.put("DONE")
+
+        anti_timeout_loop(anti_timeout)
+
+    return results
+
+
+def _names_text_ids_sql(cursor, corpus_table, text_ids, alias):
+    """Return SQL fragments restricting the rows of a name table to
+    the texts text_ids.
+
+    Return a pair (from_sql, where_sql), where from_sql is to be added
+    to the FROM clause and where_sql to the WHERE clause of a
+    statement in which alias is the alias of corpus_table or of a
+    table with a text_id column of the same type. Both are empty if
+    text_ids is None. At most config.NAMES_TEXT_IDS_IN_LIST_MAX ids
+    are listed in an IN condition; more ids are loaded into the
+    session temporary table tmp_names_text_ids in chunks of
+    config.NAMES_TEXT_IDS_CHUNK_SIZE, and the table is joined.
+
+    A helper function used by names and names_sentences.
+    """
+    if text_ids is None:
+        return ("", "")
+    if len(text_ids) <= config.NAMES_TEXT_IDS_IN_LIST_MAX:
+        # Use literal single quotes, since conn.escape() does not seem
+        # to quote strings as expected. Why?
+        text_ids_in = ",".join("'" + text_id + "'" for text_id in text_ids)
+        return ("", "AND {alias}.text_id IN ({text_ids})".format(
+            alias=alias, text_ids=text_ids_in))
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_names_text_ids;")
+    # Copy the type and collation of text_id from the name table, so
+    # that the join can use the index
+    cursor.execute("CREATE TEMPORARY TABLE tmp_names_text_ids"
+                   " SELECT text_id FROM `" + corpus_table + "` LIMIT 0;")
+    cursor.execute("ALTER TABLE tmp_names_text_ids ADD PRIMARY KEY (text_id);")
+    chunk_size = config.NAMES_TEXT_IDS_CHUNK_SIZE
+    for chunk_start in xrange(0, len(text_ids), chunk_size):
+        cursor.executemany(
+            "INSERT IGNORE INTO tmp_names_text_ids (text_id) VALUES (%s)",
+            [(text_id,) for text_id in
+             text_ids[chunk_start:chunk_start + chunk_size]])
+    return (", tmp_names_text_ids AS T",
+            "AND {alias}.text_id = T.text_id".format(alias=alias))
+
+
 def _names_find_matching_texts(form, corpus, cqp, within, nameswithin):
     """Find the text ids with matches for a CQP query.
 
+    The value of the structural attribute nameswithin (the text id)
+    at the start of each match is printed with tabulate, so CQP
+    outputs one short line per match instead of a concordance line.
+    Return a sorted list of the distinct text ids.
+
     A helper function used by names and names_sentences.
     """
 
@@ -3035,12 +3997,9 @@ def _names_find_matching_texts(form, corpus, cqp, within, nameswithin):
     if within:
         cqpextra["within"] = within
     cmd = ["%s;" % corpus]
-    cmd += ["set Context 0 words;"]
-    cmd += ["set PrintStructures \"%s\";" % nameswithin]
-    cmd += ["show -cpos;"]
     cmd += make_query(make_cqp(cqp, cqpextra))
     cmd += ["size Last;"]
-    cmd += ["cat Last;"]
+    cmd += ["tabulate Last match %s;" % nameswithin]
     cmd += ["exit;"]
     lines = runCQP(cmd, form)
 
@@ -3050,17 +4009,9 @@ def _names_find_matching_texts(form, corpus, cqp, within, nameswithin):
     nr_hits = int(lines.next())
     logging.debug('nr_hits: %s', nr_hits)
 
-    text_ids = []
-    for line in lines:
-        logging.debug('line: %s', line)
-        # Extract text_id from the concordance lines, which should
-        # be of the following form because of the option settings
-        # above: <textid_attr_name text_id>: <matching words>
-        line_words = line.split(" ")
-        if len(line_words) > 1 and line_words[0][1:] == nameswithin:
-            text_id = line.split(" ")[1].rstrip(">:")
-            if not text_ids or text_id != text_ids[-1]:
-                text_ids.append(text_id)
+    # runCQP skips the empty lines that tabulate outputs for matches
+    # outside any region of nameswithin
+    text_ids = sorted(set(lines))
     logging.debug('text_ids: %s', text_ids)
     return text_ids
 
@@ -3084,8 +4035,6 @@ def names_sentences(form):
      - default_nameswithin, nameswithin
     """
 
-    from copy import deepcopy
-    
     assert_key("source", form, "", True)
     assert_key("start", form, IS_NUMBER, False)
     assert_key("end", form, IS_NUMBER, False)
@@ -3105,97 +4054,75 @@ def names_sentences(form):
     
     start = int(form.get("start", "0"))
     end = int(form.get("end", "99"))
-    shown = form.get("show", "word")
+    shown = get_setvalued_param(form, "show", default=[])
+    shown.add("word")
     shown_structs = get_setvalued_param(form, "show_struct", default=[])
     
     querystarttime = time.time()
 
-    conn = MySQLdb.connect(**config.DBCONNECT)
-    # Get Unicode objects even with collation utf8_bin; see
-    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
-    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
-        (None, conn.string_decoder)]
-    cursor = conn.cursor()
-    cursor.execute("SET @@session.long_query_time = 1000;")
-    selects = []
-    counts = []
-    
-    # Get available tables
-    cursor.execute("SHOW TABLES LIKE '" + config.DBTABLE_NAMES + "_%';")
-    tables = set(x[0] for x in cursor)
+    with db_connection() as conn:
+        cursor = conn.cursor()
+        # Get available tables
+        tables = get_db_tables(cursor, config.DBTABLE_NAMES)
+        cursor.close()
     # Filter out corpora which doesn't exist in database
-    source = sorted(filter(
-            lambda x: config.DBTABLE_NAMES + "_" + x[0].upper() in tables,
-            source.iteritems()))
+    source = dict(
+        (corpus, source[corpus]) for corpus in
+        filter_corpora_with_db_tables(source, config.DBTABLE_NAMES, tables))
     if not source:
         return {}
-    corpora = [x[0] for x in source]
+    corpora = sorted(source)
     
     cqp = form.get("cqp", "").decode('utf-8')
-    if cqp:
-        (defaultwithin, within_all) = _get_default_and_corpus_specific_param(
-            form, "within", "defaultwithin", "sentence")
-        (default_nameswithin, nameswithin_all) = \
-            _get_default_and_corpus_specific_param(
-            form, "nameswithin", "default_nameswithin", "text_id")
-
-    for s in source:
-        corpus, ids = s
-        ids_list = ", ".join(conn.escape(i) for i in ids)
-
-        if cqp:
-            within = within_all.get(corpus, defaultwithin)
-            nameswithin = nameswithin_all.get(corpus, default_nameswithin)
-            text_ids = _names_find_matching_texts(
-                form, corpus, cqp, within, nameswithin)
-            if not text_ids:
-                continue
-            # Use literal single quotes, since conn.escape() does not
-            # seem to quote strings as expected. Why?
-            text_ids_list = ",".join("'" + i + "'" for i in text_ids)
-            text_ids_sql = "AND S.text_id in ({text_ids})".format(
-                text_ids=text_ids_list)
-        else:
-            text_ids_sql = ""
+    # The rows of all corpora from start to end - 1 are returned, so
+    # at most start + end - 1 rows are needed from each corpus
+    limit = start + end - 1
 
+    def query_corpus_sentences(conn, cursor, corpus, text_ids):
         corpus_table_sentences = (
             config.DBTABLE_NAMES + "_" + corpus.upper() + "_sentences")
-
-        sql_params = dict(corpus_u=conn.string_literal(corpus.upper()),
-                          corptbl=corpus_table_sentences,
-                          name_ids=ids_list,
-                          text_ids_sql=text_ids_sql)
-        selects.append(
-            u"""(SELECT S.sentence_id, S.start, S.end, {corpus_u} AS corpus
-                 FROM `{corptbl}` as S
-                 WHERE S.name_id IN ({name_ids}) {text_ids_sql})"""
-            .format(**sql_params))
-        counts.append(
-            u"""(SELECT {corpus_u} AS corpus, COUNT(*)
-                 FROM `{corptbl}` as S
-                 WHERE S.name_id IN ({name_ids}) {text_ids_sql})"""
+        texts_from, texts_where = _names_text_ids_sql(
+            cursor, corpus_table_sentences, text_ids, "S")
+        sql_params = dict(corptbl=corpus_table_sentences,
+                          texts_from=texts_from,
+                          name_ids=", ".join(conn.escape(i)
+                                             for i in source[corpus]),
+                          text_ids_sql=texts_where)
+        sql_count = (
+            u"""SELECT COUNT(*)
+                FROM `{corptbl}` as S {texts_from}
+                WHERE S.name_id IN ({name_ids}) {text_ids_sql}"""
             .format(**sql_params))
+        logging.debug('sql_count: %s', sql_count)
+        cursor.execute(sql_count)
+        count = int(cursor.fetchone()[0])
+        sql = (
+            u"""SELECT S.sentence_id, S.start, S.end
+                FROM `{corptbl}` as S {texts_from}
+                WHERE S.name_id IN ({name_ids}) {text_ids_sql}
+                LIMIT {limit}"""
+            .format(limit=limit, **sql_params))
+        logging.debug('sql: %s', sql)
+        cursor.execute(sql)
+        return count, cursor.fetchall()
+
+    corpus_results = _names_query_corpora(form, corpora, cqp,
+                                          query_corpus_sentences)
 
-    sql_count = u" UNION ALL ".join(counts)
-    logging.debug('sql_count: %s', sql_count)
-    cursor.execute(sql_count)
-    
     corpus_hits = {}
-    for row in cursor:
-        corpus_hits[row[0]] = int(row[1])
-    
-    sql = u" UNION ALL ".join(selects) + (u" LIMIT %d, %d" % (start, end - 1))
-    logging.debug('sql: %s', sql)
-    cursor.execute(sql)
+    rows = []
+    for corpus in corpora:
+        if corpus in corpus_results:
+            count, corpus_rows = corpus_results[corpus]
+            corpus_hits[corpus.upper()] = count
+            rows.extend((corpus.upper(), row) for row in corpus_rows)
     
     querytime = time.time() - querystarttime
     corpora_dict = {}
-    for row in cursor:
-        # 0 sentence, 1 start, 2 end, 3 corpus
-        corpora_dict.setdefault(row[3], {}).setdefault(row[0], []).append((row[1], row[2]))
+    for corpus, row in rows[start:start + end - 1]:
+        # 0 sentence, 1 start, 2 end
+        corpora_dict.setdefault(corpus, {}).setdefault(row[0], []).append((row[1], row[2]))
 
-    cursor.close()
-    
     total_hits = sum(corpus_hits.values())
 
     if not corpora_dict:
@@ -3205,41 +4132,9 @@ def names_sentences(form):
         form, "context", "defaultcontext", "1 sentence")
     cqpstarttime = time.time()
     result = {}
-    
-    for corp, sids in sorted(corpora_dict.items(), key=lambda x: x[0]):
-        cqp = (u'<sentence_id="%s"> []* </sentence_id> within sentence'
-               % "|".join(set(sids.keys())))
-        q = {"cqp": cqp,
-             "corpus": corp,
-             "start": "0",
-             "end": str(end - start),
-             "show_struct": ["sentence_id"] + list(shown_structs),
-             "defaultcontext": defaultcontext}
-        context = context_all.get(corpus)
-        if context:
-            q["context"] = context
-        if shown:
-            q["show"] = shown
-        result_temp = query(q)
-
-        # Loop backwards since we might be adding new items
-        for i in range(len(result_temp["kwic"]) - 1, -1, -1):
-            s = result_temp["kwic"][i]
-            sid = s["structs"]["sentence_id"]
-            r = sids[sid][0]
-            s["match"]["start"] = min(map(int, r)) - 1
-            s["match"]["end"] = max(map(int, r))
-            
-            # If the same name appears more than once in the same sentence,
-            # append copies of the sentence as separate results
-            for r in sids[sid][1:]:
-                s2 = deepcopy(s)
-                s2["match"]["start"] = min(map(int, r)) - 1
-                s2["match"]["end"] = max(map(int, r))
-                result_temp["kwic"].insert(i + 1, s2)
-    
-        result.setdefault("kwic", []).extend(result_temp["kwic"])
-
+    result["kwic"] = query_sentences(corpora_dict, end - start, shown,
+                                     shown_structs, defaultcontext,
+                                     context_all)
     result["hits"] = total_hits
     result["corpus_hits"] = corpus_hits
     result["corpus_order"] = corpora
@@ -3614,31 +4509,300 @@ def assert_key(key, form, regexp, required=False):
         raise ValueError("Value(s) for key %s do(es) not match /%s/: %s" % (key, pattern, value))
 
 
-def print_header():
-    """Prints the JSON header."""
-    print "Content-Type: application/json"
-    print "Access-Control-Allow-Origin: *"
-    print "Access-Control-Allow-Methods: GET, POST"
-    print "Access-Control-Allow-Headers: Authorization, Content-Type"
-    print
+def print_header(out=None, content_encoding=None):
+    """Prints the JSON header to out (default: stdout), with the
+    Content-Encoding content_encoding if the output is compressed."""
+    out = out or sys.stdout
+    print >> out, "Content-Type: application/json"
+    if config.OUTPUT_COMPRESSION:
+        print >> out, "Vary: Accept-Encoding"
+    if content_encoding:
+        print >> out, "Content-Encoding: " + content_encoding
+    print >> out, "Access-Control-Allow-Origin: *"
+    print >> out, "Access-Control-Allow-Methods: GET, POST"
+    print >> out, "Access-Control-Allow-Headers: Authorization, Content-Type"
+    print >> out
+
+
+def choose_content_encoding():
+    """Return the first encoding in config.OUTPUT_COMPRESSION that is
+    available and accepted by the client according to the
+    Accept-Encoding request header, or None."""
+    accepted = {}
+    for item in os.environ.get("HTTP_ACCEPT_ENCODING", "").split(","):
+        params = item.split(";")
+        coding = params[0].strip().lower()
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            accepted[coding] = quality
+    for coding in config.OUTPUT_COMPRESSION:
+        if (Compressor.is_available(coding)
+                and accepted.get(coding, accepted.get("*", 0.0)) > 0.0):
+            return coding
+    return None
+
+
+class Compressor(object):
+
+    """A streaming compressor for the content encoding gzip, br
+    (requires the module brotli) or zstd (requires zstandard)."""
+
+    # The modules required by the content encodings other than gzip
+    _modules = {"br": "brotli", "zstd": "zstandard"}
+
+    @staticmethod
+    def is_available(encoding):
+        return (encoding == "gzip"
+                or (encoding in Compressor._modules
+                    and import_optional(Compressor._modules[encoding])
+                    is not None))
+
+    def __init__(self, encoding):
+        self._encoding = encoding
+        if encoding == "gzip":
+            self._compressor = zlib.compressobj(6, zlib.DEFLATED,
+                                                16 + zlib.MAX_WBITS)
+        elif encoding == "br":
+            brotli = import_optional("brotli")
+            self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT,
+                                                 quality=5)
+        elif encoding == "zstd":
+            zstandard = import_optional("zstandard")
+            self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        else:
+            raise ValueError("Unsupported content encoding: %s" % encoding)
+
+    def compress(self, data):
+        if self._encoding == "br":
+            return self._compressor.process(data)
+        return self._compressor.compress(data)
+
+    def flush(self):
+        """Return the compressed data so far, so that the client can
+        decompress everything written until now."""
+        if self._encoding == "gzip":
+            return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        elif self._encoding == "br":
+            return self._compressor.flush()
+        return self._compressor.flush(
+            import_optional("zstandard").COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        """Return the rest of the compressed data."""
+        if self._encoding == "br":
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+
+class ResponseOutput(object):
+
+    """The output of the CGI script: the HTTP header followed by the
+    body, compressed with the content encoding if the body is at least
+    config.OUTPUT_COMPRESSION_MIN_SIZE bytes.
+
+    The output is buffered until the minimum size is reached or until
+    it is flushed (as for incremental progress reports and keep-alive
+    output), after which the header is written and the rest of the
+    output is compressed as it is written. flush makes the output so
+    far available to the client also when compressed. finish must be
+    called at the end of the output.
+    """
+
+    def __init__(self, out, content_encoding=None):
+        self._out = out
+        self._content_encoding = content_encoding
+        self._compressor = None
+        self._buf = []
+        self._buf_size = 0
+        self._started = False
+        # The output may be written from several threads
+        self._lock = threading.Lock()
+        # Used by the print statement
+        self.softspace = 0
+        if not content_encoding:
+            self._start(False)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        with self._lock:
+            if self._started:
+                self._write(data)
+            else:
+                self._buf.append(data)
+                self._buf_size += len(data)
+                if self._buf_size >= config.OUTPUT_COMPRESSION_MIN_SIZE:
+                    self._start(True)
+
+    def flush(self):
+        with self._lock:
+            # The response will take time, so compress it regardless of
+            # its size so far
+            if not self._started:
+                self._start(True)
+            if self._compressor:
+                self._out.write(self._compressor.flush())
+            self._out.flush()
+
+    def finish(self):
+        with self._lock:
+            if not self._started:
+                self._start(False)
+            if self._compressor:
+                self._out.write(self._compressor.finish())
+                self._compressor = None
+            self._out.flush()
+
+    def _start(self, compress):
+        content_encoding = self._content_encoding if compress else None
+        print_header(self._out, content_encoding)
+        if content_encoding:
+            self._compressor = Compressor(content_encoding)
+        self._started = True
+        buf, self._buf = self._buf, []
+        self._write("".join(buf))
+
+    def _write(self, data):
+        if self._compressor:
+            data = self._compressor.compress(data)
+        if data:
+            self._out.write(data)
 
 
 def print_object(obj, form):
     """Prints an object in JSON format.
     The CGI form can contain optional parameter 'indent'
     which change the output format.
+
+    The compact JSON is written in chunks of at least
+    config.OUTPUT_CHUNK_SIZE bytes as it is encoded, so that the whole
+    encoded result need not be kept in memory. As part of the output
+    may already have been written when an item fails to encode, the
+    item is output as null and the error as the member "ERROR" at the
+    end of the result object, so that the output remains valid JSON.
+    The indented JSON (for debugging) is encoded completely before
+    writing, and the compact encoding is used if it fails.
     """
     try:
         indent = int(form.get("indent"))
-        out = json.dumps(obj, sort_keys=True, indent=indent)
-        out = out[1:-1] if form.get("incremental", "").lower() == "true" else out
-        print out,
-    except:
-        out = json.dumps(obj, separators=(",", ":"))
-        out = out[1:-1] if form.get("incremental", "").lower() == "true" else out
-        print out,
+        chunks = [json.dumps(obj, sort_keys=True, indent=indent)]
+    except Exception:
+        errors = []
+        chunks = iterencode_json(obj, errors)
+        if isinstance(obj, dict):
+            chunks = add_json_error_member(chunks, errors, form)
+    incremental = form.get("incremental", "").lower() == "true"
     global _result_json_size
-    _result_json_size += len(out)
+    _result_json_size += write_chunks(chunks, strip_braces=incremental)
+
+
+def add_json_error_member(chunks, errors, form):
+    """Yield the chunks of a JSON object, adding to the object the
+    member "ERROR" for the first exception in errors (see
+    iterencode_json) if there is one when the chunks have been
+    generated. The last chunk must be the closing brace."""
+    prev = None
+    for chunk in chunks:
+        if prev is not None:
+            yield prev
+        prev = chunk
+    if errors:
+        error = make_error_result(form, 0, errors[0])["ERROR"]
+        yield "," + korp_json.dumps({"ERROR": error})[1:]
+    else:
+        yield prev
+
+
+def iterencode_json(obj, errors=None, levels=3):
+    """Yield obj encoded as compact JSON in chunks.
+
+    The dicts and lists in the top levels levels of obj are written
+    item by item, and each of their items below that is encoded with
+    korp_json.dumps. This gives the same output as korp_json.dumps for
+    the whole object, but the (fast) encoder needs to keep only a
+    single item of the result, such as a KWIC row or the statistics of
+    a corpus, in memory at a time.
+
+    If errors is a list, an item that cannot be encoded is output as
+    null (or omitted if its key cannot be encoded) and the exception
+    info of the error is appended to errors; otherwise the exception
+    is propagated.
+    """
+    if levels > 0 and isinstance(obj, dict):
+        yield "{"
+        separator = ""
+        for key, value in obj.iteritems():
+            # Convert the key (followed by the colon) as the encoder
+            # does; skip the item if the key cannot be encoded
+            try:
+                key = korp_json.dumps({key: 0})[1:-2]
+            except Exception:
+                if errors is None:
+                    raise
+                errors.append(sys.exc_info())
+                continue
+            yield separator + key
+            for chunk in iterencode_json(value, errors, levels - 1):
+                yield chunk
+            separator = ","
+        yield "}"
+    elif levels > 0 and isinstance(obj, (list, tuple)):
+        yield "["
+        separator = ""
+        for item in obj:
+            yield separator
+            for chunk in iterencode_json(item, errors, levels - 1):
+                yield chunk
+            separator = ","
+        yield "]"
+    elif errors is None:
+        yield korp_json.dumps(obj)
+    else:
+        try:
+            yield korp_json.dumps(obj)
+        except Exception:
+            errors.append(sys.exc_info())
+            yield "null"
+
+
+def write_chunks(chunks, strip_braces=False):
+    """Write the strings chunks to stdout in blocks of at least
+    config.OUTPUT_CHUNK_SIZE bytes and return the number of bytes
+    written. If strip_braces, omit the first and the last character
+    (the braces of an object whose items are output incrementally).
+    """
+    size = 0
+    buf = []
+    buf_size = 0
+    strip_first = strip_braces
+    for chunk in chunks:
+        if strip_first and chunk:
+            chunk = chunk[1:]
+            strip_first = False
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= config.OUTPUT_CHUNK_SIZE:
+            out = "".join(buf)
+            # Keep the last character, which may need to be stripped
+            if strip_braces:
+                buf, out = [out[-1:]], out[:-1]
+                buf_size = len(buf[0])
+            else:
+                buf, buf_size = [], 0
+            sys.stdout.write(out)
+            size += len(out)
+    out = "".join(buf)
+    if strip_braces:
+        out = out[:-1]
+    sys.stdout.write(out)
+    return size + len(out)
 
 
 def authenticate(_=None):
@@ -3671,35 +4835,307 @@ def authenticate(_=None):
     else:
         return dict(username=None)
 
+    # The permissions are cached by a cryptographic hash of the
+    # identity attributes, so that a collision cannot give a user the
+    # permissions of another. The hash of credentials is keyed with
+    # config.AUTH_SECRET, so that the cache file names cannot be used
+    # to guess passwords; without a secret, they are not cached.
+    if "password" not in postdata:
+        cachekey = hashlib.sha256(
+            json.dumps(postdata, sort_keys=True)).hexdigest()
+    elif config.AUTH_SECRET:
+        cachekey = hmac.new(config.AUTH_SECRET,
+                            json.dumps(postdata, sort_keys=True),
+                            hashlib.sha256).hexdigest()
+    else:
+        cachekey = None
+    if cachekey:
+        permitted_resources = read_auth_cache(cachekey)
+        if permitted_resources is not None:
+            return permitted_resources
+
+    if config.AUTH_RESOLVE_LOCALLY:
+        auth_response = resolve_permissions_locally(postdata)
+    else:
+        try:
+            contents = urllib2.urlopen(config.AUTH_SERVER, urllib.urlencode(postdata)).read()
+            auth_response = korp_json.loads(contents)
+        except urllib2.HTTPError:
+            raise KorpAuthenticationError("Could not contact authentication server.")
+        except ValueError:
+            raise KorpAuthenticationError("Invalid response from authentication server.")
+        except:
+            raise KorpAuthenticationError("Unexpected error during authentication.")
+
+    # Response contains username and corpora, or username=None
+    permitted_resources = auth_response.get('permitted_resources', {})
+    # Cache only successful authentications, so that a failed one (for
+    # example, with a mistyped password) is not repeated from the cache
+    if (cachekey and auth_response.get('authenticated')
+            and permitted_resources):
+        write_auth_cache(cachekey, permitted_resources)
+    return permitted_resources
+
+
+def resolve_permissions_locally(postdata):
+    """Resolve the permissions of the user identified by postdata
+    directly from the auth database with korp_auth, returning the same
+    response as config.AUTH_SERVER."""
+    try:
+        with db_connection(config.AUTH_DBCONNECT) as conn:
+            cursor = conn.cursor()
+            auth_response = korp_auth.resolve_permissions(
+                cursor, postdata, get_license_table(cursor))
+            cursor.close()
+    except (MySQLdb.MySQLError, MySQLdb.InterfaceError, MySQLdb.DatabaseError):
+        raise KorpAuthenticationError("Could not access the authorization database.")
+    return auth_response
+
+
+def get_license_table(cursor):
+    """Return the licence table of the auth database (a
+    korp_auth.LicenseTable), cached like the protected corpora."""
+    license_data = read_auth_cache("licenses")
+    if license_data is not None:
+        return korp_auth.LicenseTable.from_dict(license_data)
+    license_table = korp_auth.LicenseTable.from_database(cursor)
+    write_auth_cache("licenses", license_table.to_dict())
+    return license_table
+
+
+def read_auth_cache(key):
+    """Return the authorization data cached with key, or None if it is
+    not cached or if the cache entry is older than
+    config.AUTH_CACHE_TTL seconds or than the last invalidation (see
+    invalidate_auth_cache)."""
+    if not (config.CACHE_DIR and config.AUTH_CACHE_TTL):
+        return None
+    cachefilename = os.path.join(config.CACHE_DIR, "auth_" + key)
+    try:
+        mtime = os.path.getmtime(cachefilename)
+        if time.time() - mtime >= config.AUTH_CACHE_TTL:
+            return None
+        if (config.AUTH_CACHE_STAMP_FILE
+                and os.path.exists(config.AUTH_CACHE_STAMP_FILE)
+                and mtime <= os.path.getmtime(config.AUTH_CACHE_STAMP_FILE)):
+            return None
+        with open(cachefilename, "r") as cachefile:
+            return korp_json.load(cachefile)
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def write_auth_cache(key, data):
+    """Cache the authorization data data with key. An error in writing
+    the cache is only logged, as the data need not be cached."""
+    if not (config.CACHE_DIR and config.AUTH_CACHE_TTL):
+        return
+    cachefilename = os.path.join(config.CACHE_DIR, "auth_" + key)
+    tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
+    try:
+        with open(tmpfile, "w") as cachefile:
+            korp_json.dump(data, cachefile)
+        os.rename(tmpfile, cachefilename)
+    except (IOError, OSError), e:
+        logging.warning("Could not write the authorization cache %s: %s",
+                        cachefilename, e)
+        try:
+            os.remove(tmpfile)
+        except OSError:
+            pass
+
+
+def invalidate_auth_cache():
+    """Invalidate all cached authorization data by touching
+    config.AUTH_CACHE_STAMP_FILE. The auth database management tool
+    (authing/auth) does the same after changing the database."""
+    if config.AUTH_CACHE_STAMP_FILE:
+        with open(config.AUTH_CACHE_STAMP_FILE, "a"):
+            os.utime(config.AUTH_CACHE_STAMP_FILE, None)
+
+
+def get_db_connection(dbconnect=None):
+    """Return a database connection with the connection options
+    dbconnect (default: config.DBCONNECT).
+
+    An idle connection with the same options is taken from the
+    connection pool if one is still alive; otherwise a new one is
+    opened. All connections use UTF-8 and return Unicode strings, also
+    for binary collations. Return the connection to the pool with
+    release_db_connection when done with it. The pool persists as long
+    as the process, so connections are reused by the commands called
+    in the same request and, if the script is run in a persistent
+    process, across requests.
+    """
+    dbconnect = dbconnect or config.DBCONNECT
+    key = tuple(sorted(dbconnect.items()))
+    while True:
+        with _db_pool_lock:
+            idle = _db_pool.get(key)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            break
+        try:
+            conn.ping()
+            return conn
+        except MySQLdb.Error:
+            # The connection has timed out or been closed by the server
+            with _db_pool_lock:
+                _db_pool_keys.pop(conn, None)
+    conn = MySQLdb.connect(use_unicode=True,
+                           charset="utf8",
+                           **dbconnect)
+    # Get Unicode objects even with collation utf8_bin; see
+    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
+    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
+        (None, conn.string_decoder)]
+    cursor = conn.cursor()
+    cursor.execute("SET @@session.long_query_time = 1000;")
+    cursor.close()
+    with _db_pool_lock:
+        _db_pool_keys[conn] = key
+    return conn
+
+
+def release_db_connection(conn):
+    """Return conn, obtained with get_db_connection, to the connection
+    pool. The cursors of conn should be closed first."""
+    with _db_pool_lock:
+        _db_pool.setdefault(_db_pool_keys[conn], []).append(conn)
+
+
+@contextmanager
+def db_connection(dbconnect=None):
+    """A context manager for a connection from get_db_connection. The
+    connection is returned to the pool at the end, unless an exception
+    occurred, in which case it is closed."""
+    conn = get_db_connection(dbconnect)
     try:
-        contents = urllib2.urlopen(config.AUTH_SERVER, urllib.urlencode(postdata)).read()
-        auth_response = json.loads(contents)
-    except urllib2.HTTPError:
-        raise KorpAuthenticationError("Could not contact authentication server.")
-    except ValueError:
-        raise KorpAuthenticationError("Invalid response from authentication server.")
+        yield conn
     except:
-        raise KorpAuthenticationError("Unexpected error during authentication.")
+        with _db_pool_lock:
+            _db_pool_keys.pop(conn, None)
+        conn.close()
+        raise
+    release_db_connection(conn)
+
+
+def close_db_connections():
+    """Close the idle connections in the connection pool."""
+    with _db_pool_lock:
+        for idle in _db_pool.itervalues():
+            for conn in idle:
+                _db_pool_keys.pop(conn, None)
+                try:
+                    conn.close()
+                except MySQLdb.Error:
+                    pass
+        _db_pool.clear()
+
+
+def get_db_tables(cursor, table_prefix):
+    """Return the set of the names of the database tables whose names
+    begin with table_prefix followed by an underscore.
+
+    The names are looked up in the catalogue of the database tables
+    returned by get_db_catalogue. cursor is a cursor for the database
+    connection to use if the catalogue needs to be read.
+    """
+    prefix = table_prefix + "_"
+    return set(table for table in get_db_catalogue(cursor)["tables"]
+               if table.startswith(prefix))
+
+
+def get_db_catalogue(cursor):
+    """Return the catalogue of the database tables as a dict with the
+    keys "tables" (the set of the names of all tables) and "groups"
+    (a dict mapping the names of word picture corpus group tables to
+    the lists of the corpora recorded in their DBTABLE_group_NAME_corpora
+    tables).
+
+    The catalogue is kept in memory and cached in the file "dbtables"
+    in config.CACHE_DIR, and it is reread from the database when it is
+    config.DB_TABLES_CACHE_TTL seconds old. Remove the cache file to
+    update the catalogue immediately after adding or removing tables.
+    cursor is a cursor for the database connection to use if the
+    catalogue needs to be read.
+    """
+    global _db_catalogue
+    if _db_catalogue is not None:
+        catalogue, read_time = _db_catalogue
+        if (time.time() - read_time < config.DB_TABLES_CACHE_TTL
+                and (not config.CACHE_DIR
+                     or os.path.exists(os.path.join(config.CACHE_DIR,
+                                                    "dbtables")))):
+            return catalogue
+    _db_catalogue = _read_db_catalogue(cursor)
+    return _db_catalogue[0]
+
+
+def _read_db_catalogue(cursor):
+    """Return the catalogue of the database tables and the time when it
+    was read from the database, from the cache file if it is fresh
+    enough."""
+    use_cache = bool(config.CACHE_DIR and config.DB_TABLES_CACHE_TTL)
+    if use_cache:
+        cachefilename = os.path.join(config.CACHE_DIR, "dbtables")
+        try:
+            mtime = os.path.getmtime(cachefilename)
+            if time.time() - mtime < config.DB_TABLES_CACHE_TTL:
+                with open(cachefilename, "r") as cachefile:
+                    catalogue = korp_json.load(cachefile)
+                return ({"tables": set(catalogue["tables"]),
+                         "groups": catalogue["groups"]},
+                        mtime)
+        except (OSError, IOError, ValueError, KeyError, TypeError):
+            # No cache file or a broken one: read the catalogue below
+            pass
+    read_time = time.time()
+    cursor.execute("SHOW TABLES;")
+    tables = set(row[0] for row in cursor)
+    groups = {}
+    group_prefix = config.DBTABLE + "_group_"
+    for table in sorted(tables):
+        if (table.startswith(group_prefix) and not table.endswith("_corpora")
+                and table + "_corpora" in tables):
+            cursor.execute("SELECT corpus FROM `" + table + "_corpora`;")
+            groups[table] = sorted(row[0].upper() for row in cursor)
+    if use_cache:
+        tmpfile = "%s.%s" % (cachefilename, os.getenv("UNIQUE_ID"))
+        with open(tmpfile, "w") as cachefile:
+            korp_json.dump({"tables": sorted(tables), "groups": groups},
+                           cachefile)
+        os.rename(tmpfile, cachefilename)
+    return ({"tables": tables, "groups": groups}, read_time)
 
-    # Response contains username and corpora, or username=None
-    return auth_response.get('permitted_resources', {})
+
+def filter_corpora_with_db_tables(corpora, table_prefix, tables):
+    """Return a list of the corpora in corpora for which the set tables
+    contains the table table_prefix_CORPUS."""
+    return [corpus for corpus in corpora
+            if table_prefix + "_" + corpus.upper() in tables]
 
 
 def get_protected_corpora():
-    """Return a list of protected corpora listed in the auth database."""
+    """Return a list of protected corpora listed in the auth database.
+
+    The list is cached for config.AUTH_CACHE_TTL seconds (see
+    read_auth_cache).
+    """
+    protected = read_auth_cache("protected")
+    if protected is not None:
+        return protected
     protected = []
     try:
-        conn = MySQLdb.connect(use_unicode=True,
-                               charset="utf8",
-                               **config.AUTH_DBCONNECT)
-        cursor = conn.cursor()
-        cursor.execute('''
-        select corpus from auth_license
-        where license like 'ACA%' or license = 'RES'
-        ''')
-        protected = [ corpus for corpus, in cursor ]
-        cursor.close()
-        conn.close()
+        with db_connection(config.AUTH_DBCONNECT) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+            select corpus from auth_license
+            where license like 'ACA%' or license = 'RES'
+            ''')
+            protected = [ corpus for corpus, in cursor ]
+            cursor.close()
+        write_auth_cache("protected", protected)
     except (AttributeError, MySQLdb.MySQLError, MySQLdb.InterfaceError,
             MySQLdb.DatabaseError):
         # Assume that no corpora are protected if trying to access the
@@ -3757,10 +5193,17 @@ def anti_timeout_loop(f, args=None, timeout=90):
                 break
             elif isinstance(msg, tuple):
                 raise CustomTracebackException(msg)
-            else:
+            elif _anti_timeout_output:
                 print msg
         except Empty:
-            print " ",
+            if _anti_timeout_output:
+                print " ",
+        if _anti_timeout_output:
+            # Send the output also if it is compressed
+            sys.stdout.flush()
+
+
+atexit.register(close_db_connections)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Resolve the corpora that a user is permitted to access.
+
+The logic is shared by auth.cgi, the authentication server called by
+korp.cgi over HTTP, and korp.cgi itself, which can resolve the
+permissions directly when it has access to the auth database
+(korp_config.AUTH_RESOLVE_LOCALLY), saving an HTTP request and a CGI
+process per authenticated request.
+
+The licences of the corpora and the mapping of LBR ids to corpora are
+read into a LicenseTable, which korp.cgi caches, so that only the
+person-specific data (password, local academic status and personal
+permissions) need to be queried for each user.
+"""
+
+
+import logging
+
+
+# academic is TRUE if 'member' is part of affiliation.
+# This is NOT true for member@clarin!
+# OR ACA status via LBR is set
+def is_academic(clarin, form):
+    aca_affiliation_values = ['member', 'employee', 'student', 'faculty', 'staff']
+    affiliation = form.get('affiliation', '').lower()
+    entitlement = form.get('entitlement', '')
+
+    academic = (
+    (not clarin
+     and any(key in affiliation for key in aca_affiliation_values)
+    ) or
+    (clarin and
+     'http://www.clarin.eu/entitlement/academic' in entitlement
+    )
+    or
+    'urn:nbn:fi:lb-2016110710' in entitlement
+    )
+    return academic
+
+
+class LicenseTable(object):
+
+    """The licences of corpora (PUB, ACA, ACA-Fi or RES) and the
+    corpora mapped to each LBR id."""
+
+    def __init__(self, licenses, lbr_map):
+        """licenses maps corpora to their licences and lbr_map LBR ids to
+        lists of corpora."""
+        self.licenses = licenses
+        self.lbr_map = lbr_map
+
+    @classmethod
+    def from_database(cls, cursor):
+        """Read the licence table with cursor to the auth database."""
+        cursor.execute('''
+        select corpus, license from auth_license''')
+        licenses = dict((corpus, license) for corpus, license in cursor)
+        cursor.execute('''
+        select lbr_id, corpus from auth_lbr_map''')
+        lbr_map = {}
+        for lbr_id, corpus in cursor:
+            lbr_map.setdefault(lbr_id, []).append(corpus)
+        return cls(licenses, lbr_map)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the licence table represented by data, returned by
+        to_dict."""
+        return cls(data["licenses"], data["lbr_map"])
+
+    def to_dict(self):
+        """Return the licence table as a dict that can be serialized as
+        JSON."""
+        return {"licenses": self.licenses, "lbr_map": self.lbr_map}
+
+    def get_licensed_corpora(self, academic, top_domain):
+        """Return the set of corpora available to academic users (if
+        academic), including ACA-Fi corpora if top_domain is fi."""
+        if not academic:
+            return set()
+        return set(corpus for corpus, license in self.licenses.iteritems()
+                   if license == 'ACA'
+                   or (license == 'ACA-Fi' and top_domain == 'fi'))
+
+    def get_lbr_corpora(self, lbr_ids):
+        """Return the set of corpora mapped to the LBR ids lbr_ids."""
+        return set(corpus for lbr_id in lbr_ids
+                   for corpus in self.lbr_map.get(lbr_id, []))
+
+
+def resolve_permissions(cursor, form, license_table=None):
+    """Return the authentication result for the parameters in form,
+    as returned by auth.cgi: a dict with authenticated=True and
+    permitted_resources containing username and corpora, or with
+    authenticated=False.
+
+    form contains either remote_user, affiliation and entitlement of
+    a user authenticated by the web server (Shibboleth), or username
+    and password to be checked against the auth database. cursor is a
+    cursor to the auth database. If license_table is None, it is read
+    from the database.
+    """
+    authenticated, academic = False, False
+    top_domain = ''
+    entitlement = ()
+
+    if 'remote_user' in form:
+        username = form['remote_user']
+        clarin = username.endswith("@clarin.eu")
+        clarin_fi = username.endswith(".fi@clarin.eu")
+        # Get the top-level-domain for checking ACA-Fi
+        top_domain = username.rpartition('.')[-1]
+        authenticated = True
+        # entitlement contains LBR REMS IDs (URNs) as a semicolon separated list.
+        if form.get('entitlement'):
+            entitlement = tuple(filter(None, (form['entitlement'] + ';').split(';')))
+
+        # Determine "academic status" based on supplied attributes
+        academic = is_academic(clarin, form)
+        # set topdomain = fi if the user is academic and a CLARIN user with a fin. email
+        # The ACA status must have come from LBR in that case
+        if academic and clarin_fi:
+            top_domain = 'fi'
+    else:
+        username = form.get('username', '')
+        password = form.get('password', '')
+        cursor.execute('''
+        select secret from auth_secret
+        where person = %s''', [username])
+        secret = cursor.fetchone()
+        if secret is not None and secret[0] == password:
+            authenticated = True
+
+    logging.info('Is Academic: %s', academic)
+    logging.debug('DEBUG entitlement %s', entitlement)
+
+    if not authenticated:
+        return dict(authenticated=False)
+
+    # We can grant ACA status to people locally:
+    if not academic:
+        cursor.execute('''
+        select 1 from auth_academic
+        where person = %s''', [username])
+        if cursor.fetchone():
+            academic = True
+
+    if license_table is None:
+        license_table = LicenseTable.from_database(cursor)
+
+    corpora = license_table.get_licensed_corpora(academic, top_domain)
+    cursor.execute('''
+    select corpus from auth_allow
+    where person = %s''', [username])
+    corpora.update(corpus for corpus, in cursor)
+    # entitlement is a tuple of URNs that need mapping to Korp corpus IDs
+    corpora.update(license_table.get_lbr_corpora(entitlement))
+    corpora = sorted(corpora)
+    logging.debug('DEBUG corpora: %s', corpora)
+
+    return dict(authenticated=True,
+                permitted_resources=dict(username=username,
+                                         corpora=corpora))
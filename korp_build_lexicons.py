@@ -0,0 +1,151 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Build whole-corpus frequency lexicons for the count_all command.
+
+For each corpus given as an argument and for each attribute
+combination in korp_config.LEXICON_ATTRIBUTES (or given with
+--attributes), count the frequencies of the value combinations of the
+positional attributes in the whole corpus with cwb-scan-corpus and
+write them to the file LEXICON_DIR/corpus/attr1+attr2... (the corpus
+name in lowercase). For the combinations containing attributes listed
+in korp_config.LEXICON_IGNORE_CASE_ATTRIBUTES, a lexicon with the
+values of those attributes case-folded is also written, with "%c"
+appended to the names of the case-folded attributes in the file name
+(for example, word%c+pos). The values are folded by cwb-scan-corpus
+with the %c flag, so that they are the same as those counted by CQP
+(and cwb-scan-corpus) when ignoring case.
+
+The first line of a lexicon file is "#total<TAB>n", where n is the
+total frequency (the number of tokens in the corpus). It is followed
+by lines of the form "freq<TAB>value1<TAB>value2...", in descending
+order of frequency. korp.cgi memory-maps the files, so count_all reads
+only the lexicons of the requested attributes instead of scanning the
+corpus.
+
+The lexicons of a corpus should be rebuilt whenever the corpus is
+re-encoded. Each lexicon is written under a temporary name and renamed
+only when complete.
+
+Usage: korp_build_lexicons.py [--verbose] [--attributes attr[+attr...] ...]
+         corpus ...
+"""
+
+
+import os
+import sys
+import time
+import argparse
+
+from collections import defaultdict
+from subprocess import Popen, PIPE
+
+import korp_config as config
+
+
+class LexiconBuilder(object):
+
+    """Build whole-corpus frequency lexicons for corpora."""
+
+    def __init__(self, attribute_combinations, ignore_case_attributes,
+                 verbose=False):
+        self._attribute_combinations = attribute_combinations
+        self._ignore_case_attributes = set(ignore_case_attributes)
+        self._verbose = verbose
+
+    def build_lexicons(self, corpora):
+        """Build the lexicons of corpora."""
+        for corpus in corpora:
+            self.build_corpus_lexicons(corpus.lower())
+
+    def build_corpus_lexicons(self, corpus):
+        """Build the lexicons of all attribute combinations of corpus."""
+        lexicon_dir = os.path.join(config.LEXICON_DIR, corpus)
+        if not os.path.isdir(lexicon_dir):
+            os.makedirs(lexicon_dir)
+        for attrs in self._attribute_combinations:
+            self.build_lexicon(corpus, attrs, lexicon_dir)
+
+    def build_lexicon(self, corpus, attrs, lexicon_dir):
+        """Build the lexicon of the attribute list attrs for corpus, and
+        its case-folded variant if attrs contains attributes whose case
+        is to be ignored."""
+        self._log("Building lexicon %s for %s" % ("+".join(attrs), corpus))
+        starttime = time.time()
+        freqs = self._scan(corpus, attrs)
+        if freqs is None:
+            return
+        self._write_lexicon(os.path.join(lexicon_dir, "+".join(attrs)), freqs)
+        nocase_attrs = [attr + "%c" if attr in self._ignore_case_attributes
+                        else attr for attr in attrs]
+        if nocase_attrs != attrs:
+            nocase_freqs = self._scan(corpus, nocase_attrs)
+            if nocase_freqs is None:
+                return
+            self._write_lexicon(
+                os.path.join(lexicon_dir, "+".join(nocase_attrs)),
+                nocase_freqs)
+        self._log("  %d values in %.1f s"
+                  % (len(freqs), time.time() - starttime))
+
+    def _scan(self, corpus, attrs):
+        """Return a dict of the frequencies of the value combinations
+        of attrs (possibly with the flag %c) in corpus, counted with
+        cwb-scan-corpus, or None if cwb-scan-corpus fails."""
+        process = Popen([config.CWB_SCAN_EXECUTABLE, "-q",
+                         "-r", config.CWB_REGISTRY, corpus.upper()] + attrs,
+                        stdout=PIPE)
+        freqs = defaultdict(int)
+        for line in process.stdout:
+            freq, values = line.rstrip("\n").split("\t", 1)
+            freqs[values] += int(freq)
+        if process.wait() != 0:
+            sys.stderr.write("Error: cwb-scan-corpus failed for corpus %s,"
+                             " attributes %s\n" % (corpus, " ".join(attrs)))
+            return None
+        return freqs
+
+    def _write_lexicon(self, filename, freqs):
+        new_filename = filename + "_new"
+        with open(new_filename, "wb") as lexicon:
+            lexicon.write("#total\t%d\n" % sum(freqs.itervalues()))
+            for values, freq in sorted(freqs.iteritems(),
+                                       key=lambda item: item[1],
+                                       reverse=True):
+                lexicon.write("%d\t%s\n" % (freq, values))
+        os.rename(new_filename, filename)
+
+    def _log(self, msg):
+        if self._verbose:
+            sys.stderr.write(msg + "\n")
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Build whole-corpus frequency lexicons for corpora to"
+        " korp_config.LEXICON_DIR.")
+    argparser.add_argument(
+        "corpora", nargs="+", metavar="corpus",
+        help="the corpora for which to build lexicons")
+    argparser.add_argument(
+        "--attributes", "-a", nargs="+", metavar="attr[+attr...]",
+        help="the attribute combinations for which to build lexicons"
+        " (default: korp_config.LEXICON_ATTRIBUTES)")
+    argparser.add_argument(
+        "--verbose", "-v", action="store_true",
+        help="report progress")
+    args = argparser.parse_args()
+    if not config.LEXICON_DIR:
+        argparser.error("korp_config.LEXICON_DIR is not set")
+    if args.attributes:
+        attribute_combinations = [attrs.split("+") for attrs in args.attributes]
+    else:
+        attribute_combinations = config.LEXICON_ATTRIBUTES
+    LexiconBuilder(attribute_combinations,
+                   config.LEXICON_IGNORE_CASE_ATTRIBUTES,
+                   verbose=args.verbose).build_lexicons(args.corpora)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Build sentence indexes for finding sentences by their ids.
+
+For each corpus given as an argument, read the corpus positions of the
+regions of the structural attribute sentence_id with cwb-s-decode and
+write them to a dbm database SENTENCE_INDEX_DIR/corpus (lowercase),
+mapping each sentence id to its start and end position separated by a
+tab. The relations_sentences and names_sentences commands of korp.cgi
+use the index to retrieve the sentences of example hits by position
+instead of matching the ids with a regular expression.
+
+The index of a corpus should be rebuilt whenever the corpus is
+re-encoded, since the positions would otherwise refer to wrong
+sentences; korp.cgi does not use an index older than the data of the
+word and sentence_id attributes of the corpus. The index is written under a temporary name and renamed
+only when complete.
+
+Usage: korp_build_sentence_index.py [--verbose] [--attribute attr] corpus ...
+"""
+
+
+import os
+import sys
+import glob
+import time
+import anydbm
+import argparse
+
+from subprocess import Popen, PIPE
+
+import korp_config as config
+
+
+class SentenceIndexBuilder(object):
+
+    """Build sentence id to corpus position indexes for corpora."""
+
+    def __init__(self, attribute="sentence_id", verbose=False):
+        self._attribute = attribute
+        self._verbose = verbose
+
+    def build_indexes(self, corpora):
+        """Build the sentence indexes of corpora."""
+        if not os.path.isdir(config.SENTENCE_INDEX_DIR):
+            os.makedirs(config.SENTENCE_INDEX_DIR)
+        for corpus in corpora:
+            self.build_index(corpus.lower())
+
+    def build_index(self, corpus):
+        """Build the sentence index of corpus."""
+        self._log("Building sentence index for %s" % corpus)
+        starttime = time.time()
+        index_name = os.path.join(config.SENTENCE_INDEX_DIR, corpus)
+        new_name = index_name + "_new"
+        self._remove_files(new_name)
+        process = Popen([config.CWB_S_DECODE_EXECUTABLE,
+                         "-r", config.CWB_REGISTRY,
+                         corpus.upper(), "-S", self._attribute],
+                        stdout=PIPE)
+        index = anydbm.open(new_name, "n")
+        count = 0
+        for line in process.stdout:
+            start, end, sentence_id = line.rstrip("\n").split("\t", 2)
+            # Keep the first sentence if an id is not unique
+            if sentence_id not in index:
+                index[sentence_id] = start + "\t" + end
+                count += 1
+        index.close()
+        if process.wait() != 0:
+            self._remove_files(new_name)
+            sys.stderr.write("Error: cwb-s-decode failed for corpus %s\n"
+                             % corpus)
+            return
+        # Depending on the dbm implementation, the database may consist
+        # of several files with extensions
+        for fname in self._index_files(new_name):
+            os.rename(fname, index_name + fname[len(new_name):])
+        self._log("  %d sentences in %.1f s"
+                  % (count, time.time() - starttime))
+
+    def _index_files(self, name):
+        return glob.glob(name) + glob.glob(name + ".*")
+
+    def _remove_files(self, name):
+        for fname in self._index_files(name):
+            os.remove(fname)
+
+    def _log(self, msg):
+        if self._verbose:
+            sys.stderr.write(msg + "\n")
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Build sentence id to corpus position indexes for"
+        " corpora to korp_config.SENTENCE_INDEX_DIR.")
+    argparser.add_argument(
+        "corpora", nargs="+", metavar="corpus",
+        help="the corpora for which to build an index")
+    argparser.add_argument(
+        "--attribute", "-a", default="sentence_id",
+        help="the structural attribute containing sentence ids"
+        " (default: %(default)s)")
+    argparser.add_argument(
+        "--verbose", "-v", action="store_true",
+        help="report progress")
+    args = argparser.parse_args()
+    if not config.SENTENCE_INDEX_DIR:
+        argparser.error("korp_config.SENTENCE_INDEX_DIR is not set")
+    SentenceIndexBuilder(attribute=args.attribute,
+                         verbose=args.verbose).build_indexes(args.corpora)
+
+
+if __name__ == "__main__":
+    main()
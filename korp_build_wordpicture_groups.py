@@ -0,0 +1,274 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Build pre-aggregated word picture tables for corpus groups.
+
+For each corpus group in korp_config.WORDPICTURE_CORPUS_GROUPS (or for
+the groups given as arguments), combine the word picture (relations)
+tables of the corpora of the group into a single table
+DBTABLE_group_NAME. In the group table, the frequencies of identical
+relations (identified by their head and dependent strings) are summed
+over the corpora, and the frequencies of the relation, head-relation
+and relation-dependent combinations and the association score (MI)
+are precalculated as if the corpora were a single corpus. The source
+column lists the corpus:id pairs of the relation in the corpora. The
+corpora actually included in the group table (those with word picture
+tables) are listed in DBTABLE_group_NAME_corpora.
+
+korp.cgi uses the table of a group in the relations command when the
+requested corpora are exactly those of the group, so that it can
+select the relations of a word without joins and only the top
+relations by frequency or MI. Otherwise, and when a minimum frequency
+is given (as it applies to the frequencies in the individual
+corpora), it combines the per-corpus tables at query time. In that
+case, the relation, head-relation and relation-dependent frequencies
+are summed only over the corpora in which the word has the relation,
+so MI may differ slightly from that in the group table.
+
+The script should be rerun whenever the word picture data of a corpus
+in a group is updated or the corpora of a group are changed in the
+configuration. The tables are built under temporary names and renamed
+over the old ones only when complete, so the relations command can be
+used during the build.
+
+Usage: korp_build_wordpicture_groups.py [--verbose] [group ...]
+"""
+
+
+import os
+import sys
+import time
+import argparse
+
+import MySQLdb
+
+import korp_config as config
+
+
+class WordPictureGroupBuilder(object):
+
+    """Build pre-aggregated word picture tables for corpus groups."""
+
+    def __init__(self, verbose=False):
+        self._verbose = verbose
+        self._conn = MySQLdb.connect(use_unicode=True,
+                                     charset="utf8",
+                                     **config.DBCONNECT)
+        self._cursor = self._conn.cursor()
+        self._execute("SET @@session.long_query_time = 1000;")
+        # The source column lists all the corpus:id pairs of a relation
+        self._execute("SET SESSION group_concat_max_len = 1048576;")
+
+    def build_groups(self, groups):
+        """Build the tables for the named corpus groups."""
+        self._execute("SHOW TABLES LIKE '" + config.DBTABLE + "_%';")
+        tables = set(row[0] for row in self._cursor)
+        for group in groups:
+            self.build_group(group, config.WORDPICTURE_CORPUS_GROUPS[group],
+                             tables)
+        self._cursor.close()
+        self._conn.close()
+        self._invalidate_table_cache()
+
+    def build_group(self, group, corpora, tables):
+        """Build the table of group consisting of corpora.
+
+        tables is the set of existing word picture tables.
+        """
+        group_table = config.DBTABLE + "_group_" + group
+        corpora = sorted(set(corpus.upper() for corpus in corpora))
+        missing = [corpus for corpus in corpora
+                   if config.DBTABLE + "_" + corpus not in tables]
+        if missing:
+            self._warn("Group %s: no word picture tables for corpora %s"
+                       % (group, ", ".join(missing)))
+        corpora = [corpus for corpus in corpora if corpus not in missing]
+        if not corpora:
+            self._warn("Group %s: no corpora with word picture tables,"
+                       " skipping" % group)
+            return
+        self._log("Building group %s (%d corpora)" % (group, len(corpora)))
+        starttime = time.time()
+        new_table = group_table + "_new"
+        self._drop_tables([new_table, new_table + "_corpora"])
+        self._collect_corpus_data(corpora)
+        self._aggregate(new_table)
+        self._execute("CREATE TABLE `" + new_table + "_corpora`"
+                      " (`corpus` varchar(64) NOT NULL,"
+                      " PRIMARY KEY (`corpus`)) DEFAULT CHARSET = utf8;")
+        self._cursor.executemany(
+            "INSERT INTO `" + new_table + "_corpora` (corpus) VALUES (%s);",
+            [(corpus,) for corpus in corpora])
+        self._replace_tables(group_table, new_table, tables)
+        self._drop_tables(["tmp_wp_rels", "tmp_wp_rel", "tmp_wp_head_rel",
+                           "tmp_wp_dep_rel", "tmp_wp_agg_rel",
+                           "tmp_wp_agg_head_rel", "tmp_wp_agg_dep_rel"],
+                          temporary=True)
+        self._conn.commit()
+        self._log("Group %s done in %.1f s" % (group, time.time() - starttime))
+
+    def _collect_corpus_data(self, corpora):
+        """Collect the relations and the component frequencies of all
+        corpora to temporary tables, identifying heads and dependents
+        by their strings instead of the corpus-specific ids."""
+        self._drop_tables(["tmp_wp_rels", "tmp_wp_rel", "tmp_wp_head_rel",
+                           "tmp_wp_dep_rel"], temporary=True)
+        for num, corpus in enumerate(corpora):
+            self._log("  Collecting %s" % corpus)
+            corpus_table = config.DBTABLE + "_" + corpus
+            # Create the temporary tables from the first corpus and
+            # insert the data of the rest
+            into = ("CREATE TEMPORARY TABLE `%s` " if num == 0
+                    else "INSERT INTO `%s` ")
+            self._execute(
+                (into % "tmp_wp_rels")
+                + "SELECT S1.string AS head, S1.pos AS headpos, F.rel,"
+                " S2.string AS dep, S2.pos AS deppos,"
+                " S2.stringextra AS depextra, F.freq,"
+                " F.bfhead, F.bfdep, F.wfhead, F.wfdep,"
+                " CAST(" + self._conn.string_literal(corpus)
+                + " AS CHAR(64)) AS corpus, F.id"
+                " FROM `" + corpus_table + "_strings` AS S1,"
+                " `" + corpus_table + "_strings` AS S2,"
+                " `" + corpus_table + "` AS F"
+                " WHERE F.head = S1.id AND F.dep = S2.id;")
+            self._execute(
+                (into % "tmp_wp_rel")
+                + "SELECT R.rel, R.freq FROM `" + corpus_table + "_rel` AS R;")
+            self._execute(
+                (into % "tmp_wp_head_rel")
+                + "SELECT S.string AS head, S.pos AS headpos, HR.rel, HR.freq"
+                " FROM `" + corpus_table + "_head_rel` AS HR,"
+                " `" + corpus_table + "_strings` AS S"
+                " WHERE HR.head = S.id;")
+            self._execute(
+                (into % "tmp_wp_dep_rel")
+                + "SELECT S.string AS dep, S.pos AS deppos,"
+                " S.stringextra AS depextra, DR.rel, DR.freq"
+                " FROM `" + corpus_table + "_dep_rel` AS DR,"
+                " `" + corpus_table + "_strings` AS S"
+                " WHERE DR.dep = S.id;")
+
+    def _aggregate(self, new_table):
+        """Sum the collected frequencies over the corpora and create
+        new_table with the aggregated relations and their MI.
+
+        The frequency columns are named as the columns selected by the
+        relations command from the per-corpus tables.
+        """
+        self._log("  Aggregating")
+        self._drop_tables(["tmp_wp_agg_rel", "tmp_wp_agg_head_rel",
+                           "tmp_wp_agg_dep_rel"], temporary=True)
+        self._execute(
+            "CREATE TEMPORARY TABLE tmp_wp_agg_rel"
+            " SELECT rel, CAST(SUM(freq) AS UNSIGNED) AS freq"
+            " FROM tmp_wp_rel GROUP BY rel;")
+        self._execute("ALTER TABLE tmp_wp_agg_rel ADD INDEX (rel);")
+        self._execute(
+            "CREATE TEMPORARY TABLE tmp_wp_agg_head_rel"
+            " SELECT head, headpos, rel, CAST(SUM(freq) AS UNSIGNED) AS freq"
+            " FROM tmp_wp_head_rel GROUP BY head, headpos, rel;")
+        self._execute("ALTER TABLE tmp_wp_agg_head_rel ADD INDEX (head, rel);")
+        self._execute(
+            "CREATE TEMPORARY TABLE tmp_wp_agg_dep_rel"
+            " SELECT dep, deppos, depextra, rel,"
+            " CAST(SUM(freq) AS UNSIGNED) AS freq"
+            " FROM tmp_wp_dep_rel GROUP BY dep, deppos, depextra, rel;")
+        self._execute("ALTER TABLE tmp_wp_agg_dep_rel ADD INDEX (dep, rel);")
+        # The base form and word form flags are included in the
+        # grouping, since the relations command selects relations by
+        # them. In practice, they are determined by the head and
+        # dependent strings. NULL-safe comparisons are used for the
+        # optional columns.
+        self._execute(
+            "CREATE TABLE `" + new_table + "` DEFAULT CHARSET = utf8"
+            " SELECT A.head, A.headpos, A.rel, A.dep, A.deppos, A.depextra,"
+            " A.freq, R.freq AS rel_freq, HR.freq AS head_rel_freq,"
+            " DR.freq AS dep_rel_freq,"
+            " A.freq * LOG2((R.freq * A.freq) / (HR.freq * DR.freq)) AS mi,"
+            " A.bfhead, A.bfdep, A.wfhead, A.wfdep, A.source"
+            " FROM (SELECT head, headpos, rel, dep, deppos, depextra,"
+            "       bfhead, bfdep, wfhead, wfdep,"
+            "       CAST(SUM(freq) AS UNSIGNED) AS freq,"
+            "       GROUP_CONCAT(CONCAT(corpus, ':', id)) AS source"
+            "       FROM tmp_wp_rels"
+            "       GROUP BY head, headpos, rel, dep, deppos, depextra,"
+            "       bfhead, bfdep, wfhead, wfdep) AS A"
+            " JOIN tmp_wp_agg_rel AS R ON R.rel = A.rel"
+            " JOIN tmp_wp_agg_head_rel AS HR ON HR.head = A.head"
+            "  AND HR.headpos <=> A.headpos AND HR.rel = A.rel"
+            " JOIN tmp_wp_agg_dep_rel AS DR ON DR.dep = A.dep"
+            "  AND DR.deppos <=> A.deppos AND DR.depextra <=> A.depextra"
+            "  AND DR.rel = A.rel;")
+        self._log("  Indexing")
+        self._execute("ALTER TABLE `" + new_table + "`"
+                      " ADD INDEX head (head, rel), ADD INDEX dep (dep, rel);")
+
+    def _replace_tables(self, group_table, new_table, tables):
+        """Atomically replace the tables of group_table with those of
+        new_table."""
+        if group_table in tables:
+            old_table = group_table + "_old"
+            self._drop_tables([old_table, old_table + "_corpora"])
+            renames = [(group_table, old_table),
+                       (group_table + "_corpora", old_table + "_corpora")]
+        else:
+            old_table = None
+            renames = []
+        renames += [(new_table, group_table),
+                    (new_table + "_corpora", group_table + "_corpora")]
+        self._execute("RENAME TABLE "
+                      + ", ".join("`%s` TO `%s`" % rename
+                                  for rename in renames) + ";")
+        if old_table:
+            self._drop_tables([old_table, old_table + "_corpora"])
+
+    def _invalidate_table_cache(self):
+        """Remove the table list cached by korp.cgi, so that it finds
+        the new group tables."""
+        if config.CACHE_DIR:
+            try:
+                os.remove(os.path.join(config.CACHE_DIR, "dbtables"))
+            except OSError:
+                pass
+
+    def _drop_tables(self, table_names, temporary=False):
+        self._execute("DROP " + ("TEMPORARY " if temporary else "")
+                      + "TABLE IF EXISTS "
+                      + ", ".join("`%s`" % name for name in table_names) + ";")
+
+    def _execute(self, sql):
+        if self._verbose > 1:
+            self._log("    SQL: " + sql)
+        self._cursor.execute(sql)
+
+    def _log(self, msg):
+        if self._verbose:
+            sys.stderr.write(msg + "\n")
+
+    def _warn(self, msg):
+        sys.stderr.write("Warning: " + msg + "\n")
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Build pre-aggregated word picture tables for the"
+        " corpus groups in korp_config.WORDPICTURE_CORPUS_GROUPS.")
+    argparser.add_argument(
+        "groups", nargs="*", metavar="group",
+        help="the groups to build (default: all configured groups)")
+    argparser.add_argument(
+        "--verbose", "-v", action="count", default=0,
+        help="report progress (twice to also show the SQL statements)")
+    args = argparser.parse_args()
+    groups = args.groups or sorted(config.WORDPICTURE_CORPUS_GROUPS)
+    unknown = [group for group in groups
+               if group not in config.WORDPICTURE_CORPUS_GROUPS]
+    if unknown:
+        argparser.error("Unknown corpus groups: " + ", ".join(unknown))
+    WordPictureGroupBuilder(verbose=args.verbose).build_groups(groups)
+
+
+if __name__ == "__main__":
+    main()
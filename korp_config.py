@@ -6,10 +6,23 @@ This is the configuration file, used by the main korp.cgi script.
 # The absolute path to the CQP binaries
 CQP_EXECUTABLE = "/usr/local/cwb/bin/cqp"
 CWB_SCAN_EXECUTABLE = "/usr/local/cwb/bin/cwb-scan-corpus"
+CWB_S_DECODE_EXECUTABLE = "/usr/local/cwb/bin/cwb-s-decode"
 
 # The absolute path to the CWB registry files
 CWB_REGISTRY = "/v/corpora/registry"
 
+# Whether the info command reads the corpus information (attributes,
+# size and .info items) and the list of corpora directly from the CWB
+# registry files and corpus data instead of running CQP. The CQP
+# version reported by the command is cached in CACHE_DIR.
+CORPUS_INFO_FROM_REGISTRY = True
+
+# The corpus metadata snapshot file built with korp_info_snapshot.py
+# (optional). If the file exists, the info command takes the
+# information of the corpora from it instead of computing it, except
+# for corpora not in the snapshot.
+INFO_SNAPSHOT_FILE = ""
+
 # The default encoding for the cqp binary
 # (this can be changed by the CGI parameter 'encoding')
 CQP_ENCODING = "UTF-8"
@@ -20,15 +33,74 @@ LC_COLLATE = "sv_SE.UTF-8"
 # The temporary directory, used by sort called by cqp
 TMPDIR = "/tmp"
 
+# The directory of the sentence indexes built with
+# korp_build_sentence_index.py, mapping sentence ids to corpus
+# positions. relations_sentences and names_sentences use the index of
+# a corpus to retrieve sentences by position; for corpora without an
+# index or with one older than the corpus data, for ids not in the
+# index (or if this is empty), sentences are found with a CQP query on
+# their ids, which is slow for large result pages.
+SENTENCE_INDEX_DIR = ""
+
+# The directory of the whole-corpus frequency lexicons built with
+# korp_build_lexicons.py. count_all reads the frequencies of a corpus
+# from the lexicon of the requested attributes if it exists and is not
+# older than the data of the attributes, instead of scanning the whole
+# corpus with cwb-scan-corpus. Empty to disable.
+LEXICON_DIR = ""
+
+# The positional attribute combinations for which
+# korp_build_lexicons.py builds lexicons by default
+LEXICON_ATTRIBUTES = [["word"], ["lemma"], ["pos"], ["word", "pos"]]
+
+# The attributes for whose combinations korp_build_lexicons.py also
+# builds lexicons with the values case-folded (%c), used by count_all with
+# ignore_case
+LEXICON_IGNORE_CASE_ATTRIBUTES = ["word", "lemma"]
+
 # The maximum number of search results that can be returned per query (0 = no limit)
 MAX_KWIC_ROWS = 0
 
+# The module with which to encode and decode JSON for the responses
+# and cache files (see korp_json.py): "ujson", "simplejson" (decodes
+# ASCII strings as str instead of unicode), "json" (the standard
+# module) or "auto" for ujson if installed, otherwise json
+JSON_BACKEND = "auto"
+
+# The minimum size in bytes of the blocks in which the JSON result of
+# a command is written as it is encoded
+OUTPUT_CHUNK_SIZE = 65536
+
+# The content encodings with which to compress the output if the
+# client accepts them (Accept-Encoding), in the order of preference:
+# "br" (requires the Python module brotli), "zstd" (requires
+# zstandard) and "gzip"; empty to disable compression
+OUTPUT_COMPRESSION = ["br", "zstd", "gzip"]
+
+# The minimum size in bytes of the output to compress. Incremental
+# output is compressed regardless of its size once progress
+# information is sent.
+OUTPUT_COMPRESSION_MIN_SIZE = 1024
+
 # Number of threads to use during parallel processing
 PARALLEL_THREADS = 3
 
+# Number of threads, each with a database connection of its own, to
+# use for running per-corpus database queries in parallel (currently
+# word pictures and names); 1 to run the queries of all corpora as a
+# single statement (word pictures) or one corpus at a time (names)
+DB_PARALLEL_THREADS = 3
+
 # The name of the MySQL database and table prefix
 DBNAME = "korp"
 DBTABLE = "relations"
+# Corpus groups for which pre-aggregated word picture tables are built
+# with korp_build_wordpicture_groups.py: a dict mapping a group name
+# (lowercase letters, digits and underscores) to a list of corpus ids.
+# The table of a group (DBTABLE_group_NAME) is used by the relations
+# command when the requested corpora are exactly those of the group
+# and no minimum frequency is given.
+WORDPICTURE_CORPUS_GROUPS = {}
 # Username and password for database access
 DBUSER = "korp"
 DBPASSWORD = ""
@@ -62,7 +134,14 @@ AUTH_DBCONNECT = {
 
 # URL to authentication server
 AUTH_SERVER = "http://localhost/cgi-bin/korp/auth.cgi"
-# Secret string used when communicating with authentication server
+# Whether to resolve the permissions of users directly from the auth
+# database (AUTH_DBCONNECT) in korp.cgi, as auth.cgi would, instead of
+# calling AUTH_SERVER; set to False if the authentication server is on
+# another host or uses another database.
+AUTH_RESOLVE_LOCALLY = True
+# Secret string used when communicating with authentication server;
+# also used to key the hashes by which the permissions of users logged
+# in with a password are cached (not cached if this is empty)
 AUTH_SECRET = ""
 
 # A text file with names of corpora needing authentication, one per line;
@@ -73,8 +152,35 @@ PROTECTED_FILE = None
 # Cache path (optional). Script must have read and write access. Cache needs to be cleared manually when corpus data is updated.
 CACHE_DIR = "/v/korp/cache"
 
-# Max number of rows from count command to cache
-CACHE_MAX_STATS = 5000
+# The number of seconds for which to cache the list of protected
+# corpora and the corpora permitted to each successfully authenticated
+# user (identified by a hash of their identity attributes) in
+# CACHE_DIR, to avoid querying the auth database and AUTH_SERVER on
+# every request; 0 to disable.
+AUTH_CACHE_TTL = 300
+
+# A file whose modification invalidates the cached authorization data
+# (touched by authing/auth after changing the auth database, or with
+# invalidate_auth_cache in korp.cgi); None to use only AUTH_CACHE_TTL.
+AUTH_CACHE_STAMP_FILE = "/v/korp/cache/authstamp"
+
+# Max number of rows (the sum of the rows of the frequency tables of
+# the corpora) in a count command result to cache. The whole result is
+# cached in a binary format (korp_count_cache) from which a page of rows
+# can be read without reading the rest, so large results can be cached.
+CACHE_MAX_STATS = 500000
+
+# Max number of rows in the frequency table of a single corpus to save
+# in the frequency table store of the count command. The stored tables
+# are reused by count and loglike requests with other corpus sets or
+# result ranges.
+CACHE_MAX_FREQ_TABLE = 500000
+
+# The number of seconds for which to cache the list of the tables in
+# the database (used to find the corpora with word picture and name
+# tables); 0 to list the tables on every request. The list is in the
+# file "dbtables" in CACHE_DIR; remove it to refresh the list.
+DB_TABLES_CACHE_TTL = 3600
 
 # Whether corpora contain encoded special characters that would not
 # otherwise be handled correctly (because of limitations of CWB):
@@ -133,3 +239,32 @@ DB_HAS_CORPUSINFO = True
 # The table name prefix of the name information tables in the MySQL
 # database
 DBTABLE_NAMES = "names"
+
+# The maximum number of text ids to list in the SQL statements of the
+# names and names_sentences commands; if more texts match the query,
+# their ids are loaded into a temporary table, in chunks of
+# NAMES_TEXT_IDS_CHUNK_SIZE ids, and joined
+NAMES_TEXT_IDS_IN_LIST_MAX = 500
+NAMES_TEXT_IDS_CHUNK_SIZE = 1000
+
+# The file of the in-memory lemgram prefix index for lemgram
+# autocompletion, built from the table lemgram_index with
+# "korp_lemgram_index.py build"
+LEMGRAM_INDEX_FILE = ""
+# The Unix socket of the lemgram index service started with
+# "korp_lemgram_index.py serve"; korp_lemgrams.cgi queries the table
+# lemgram_index directly if this is empty or the service is not running
+LEMGRAM_INDEX_SOCKET = ""
+
+# Whether the table lemgram_index has the column lemgram_key with
+# normalized lemgrams, added with "korp_lemgram_index.py addkey". If
+# True, korp_lemgrams.cgi matches a lemgram prefix in normalized form
+# with the normalized lemgrams, and lemgram_count can count lemgrams
+# by their normalized forms. The keys are not filled in on insert, so
+# rerun "korp_lemgram_index.py addkey" after each import to
+# lemgram_index.
+LEMGRAM_INDEX_HAS_KEY = False
+# Whether normalized lemgrams have their diacritics removed in
+# addition to being lowercased. Rerun "korp_lemgram_index.py addkey
+# --all" and "korp_lemgram_index.py build" after changing this.
+LEMGRAM_KEY_STRIP_DIACRITICS = False
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+A compact binary format for the cached results of the count command.
+
+A cache file contains the frequency tables of the corpora of a count
+result and their total, so that any range of rows (by descending total
+frequency) can be read from it without reading the rest. The file is
+memory-mapped, and the values are read directly from it.
+
+The file consists of the following parts:
+
+- a header: magic string, the item size and byte order of the arrays,
+  the number of corpora and rows (distinct values), the total size of
+  the corpora and the sum of the total frequencies;
+- for each corpus: its name, size, sum of frequencies and the number
+  of its rows with a non-zero frequency;
+- the string table: the end offsets of the values (UTF-8) in the
+  string data, in the order of the rows;
+- the total frequencies of the rows, in descending order;
+- for each corpus, the numbers of its rows in ascending order and the
+  corresponding frequencies;
+- the string data.
+
+The arrays are unsigned longs in the native byte order; a file written
+on a different platform is treated as missing.
+"""
+
+
+import sys
+import mmap
+import struct
+
+from array import array
+from itertools import izip
+
+
+MAGIC = "KORPCNT1"
+
+# Magic, item size, big-endian, corpora, rows, total size, total sum
+_HEADER = struct.Struct("<8sBBIIQQ")
+# Name length, corpus size, sum of frequencies, number of rows
+_CORPUS = struct.Struct("<HQQI")
+
+_ITEM = struct.Struct("@L")
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+class CountCacheError(Exception):
+    pass
+
+
+def write_count_cache(filename, corpus_tables, total_table, total_size):
+    """Write a count result to the cache file filename.
+
+    corpus_tables is a list of tuples (corpus, freqs, corpus_size,
+    freq_sum), where freqs is a dict mapping values to their
+    frequencies in the corpus; total_table maps values to their total
+    frequencies and total_size is the total size of the corpora.
+    """
+    rows = sorted(total_table.iteritems(), key=lambda x: x[1], reverse=True)
+    row_nums = dict((value, num) for num, (value, _) in enumerate(rows))
+    strings = [value.encode("utf-8") if isinstance(value, unicode) else value
+               for value, _ in rows]
+    offsets = array("L")
+    offset = 0
+    for string in strings:
+        offset += len(string)
+        offsets.append(offset)
+    with open(filename, "wb") as cachefile:
+        cachefile.write(_HEADER.pack(MAGIC, offsets.itemsize, _BIG_ENDIAN,
+                                     len(corpus_tables), len(rows),
+                                     total_size,
+                                     sum(freq for _, freq in rows)))
+        for corpus, freqs, corpus_size, freq_sum in corpus_tables:
+            cachefile.write(_CORPUS.pack(len(corpus), corpus_size, freq_sum,
+                                         len(freqs)))
+            cachefile.write(corpus)
+        offsets.tofile(cachefile)
+        array("L", (freq for _, freq in rows)).tofile(cachefile)
+        for _, freqs, _, _ in corpus_tables:
+            corpus_rows = sorted((row_nums[value], freq)
+                                 for value, freq in freqs.iteritems())
+            array("L", (num for num, _ in corpus_rows)).tofile(cachefile)
+            array("L", (freq for _, freq in corpus_rows)).tofile(cachefile)
+        for string in strings:
+            cachefile.write(string)
+
+
+def open_count_cache(filename):
+    """Return a CountCacheReader for the cache file filename, or None if
+    the file does not exist or is not valid."""
+    try:
+        return CountCacheReader(filename)
+    except (IOError, ValueError, mmap.error, struct.error, CountCacheError):
+        return None
+
+
+class CountCacheReader(object):
+
+    """A reader for a count result cache file.
+
+    The attributes rows, total_size and total_sum contain the number
+    of rows, the total size of the corpora and the sum of the total
+    frequencies, and corpora the list of the names of the corpora.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as cachefile:
+            self._data = mmap.mmap(cachefile.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        (magic, itemsize, big_endian, corpus_count, self.rows,
+         self.total_size, self.total_sum) = _HEADER.unpack_from(self._data, 0)
+        if (magic != MAGIC or itemsize != _ITEM.size
+                or bool(big_endian) != _BIG_ENDIAN):
+            self._data.close()
+            raise CountCacheError("Incompatible count cache file: "
+                                  + filename)
+        pos = _HEADER.size
+        self.corpora = []
+        self._corpus_info = {}
+        for _ in xrange(corpus_count):
+            name_len, corpus_size, freq_sum, corpus_rows = (
+                _CORPUS.unpack_from(self._data, pos))
+            pos += _CORPUS.size
+            corpus = self._data[pos:pos + name_len]
+            pos += name_len
+            self.corpora.append(corpus)
+            self._corpus_info[corpus] = (corpus_size, freq_sum, corpus_rows)
+        self._offsets_pos = pos
+        self._totals_pos = self._offsets_pos + self.rows * _ITEM.size
+        pos = self._totals_pos + self.rows * _ITEM.size
+        self._corpus_pos = {}
+        for corpus in self.corpora:
+            self._corpus_pos[corpus] = pos
+            pos += 2 * self._corpus_info[corpus][2] * _ITEM.size
+        self._strings_pos = pos
+
+    def close(self):
+        self._data.close()
+
+    def get_corpus_size(self, corpus):
+        return self._corpus_info[corpus][0]
+
+    def get_corpus_sum(self, corpus):
+        """Return the sum of the frequencies in corpus."""
+        return self._corpus_info[corpus][1]
+
+    def get_total_rows(self, start=0, end=None):
+        """Return the rows start to end - 1 (default: all) in descending
+        order of total frequency as a list of tuples (row number, value,
+        total frequency)."""
+        end = self.rows if end is None else min(end, self.rows)
+        if start >= end:
+            return []
+        totals = self._get_array(self._totals_pos + start * _ITEM.size,
+                                 end - start)
+        values = self._get_strings(start, end)
+        return [(num, value, total)
+                for num, value, total in izip(xrange(start, end), values,
+                                              totals)]
+
+    def get_corpus_freqs(self, corpus, row_nums):
+        """Return a dict mapping the row numbers in row_nums to their
+        frequencies in corpus, for the rows occurring in corpus."""
+        pos = self._corpus_pos[corpus]
+        corpus_rows = self._corpus_info[corpus][2]
+        freqs_pos = pos + corpus_rows * _ITEM.size
+        freqs = {}
+        for row_num in row_nums:
+            # Binary search in the row numbers of the corpus
+            low, high = 0, corpus_rows
+            while low < high:
+                mid = (low + high) // 2
+                if self._get_item(pos, mid) < row_num:
+                    low = mid + 1
+                else:
+                    high = mid
+            if low < corpus_rows and self._get_item(pos, low) == row_num:
+                freqs[row_num] = self._get_item(freqs_pos, low)
+        return freqs
+
+    def get_corpus_rows(self, corpus):
+        """Return a pair of arrays: the numbers of the rows occurring in
+        corpus in ascending order and their frequencies in corpus."""
+        pos = self._corpus_pos[corpus]
+        corpus_rows = self._corpus_info[corpus][2]
+        return (self._get_array(pos, corpus_rows),
+                self._get_array(pos + corpus_rows * _ITEM.size, corpus_rows))
+
+    def _get_item(self, pos, index):
+        return _ITEM.unpack_from(self._data, pos + index * _ITEM.size)[0]
+
+    def _get_array(self, pos, length):
+        result = array("L")
+        result.fromstring(self._data[pos:pos + length * _ITEM.size])
+        return result
+
+    def _get_strings(self, start, end):
+        """Return the values of the rows start to end - 1."""
+        offsets = self._get_array(self._offsets_pos + start * _ITEM.size,
+                                  end - start)
+        prev = self._get_item(self._offsets_pos, start - 1) if start else 0
+        strings = []
+        for offset in offsets:
+            strings.append(self._data[self._strings_pos + prev:
+                                      self._strings_pos + offset]
+                           .decode("utf-8"))
+            prev = offset
+        return strings
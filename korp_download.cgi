@@ -27,7 +27,8 @@ Parameters:
     filename (string): The (suggested) name of the file to generate;
         overrides `filename_format`
     korp_server (URL): The Korp server to query; default configured in
-       code
+       code; if the value is a program name, its commands are by
+       default run in the process of this script
     logfile (string): The name of the file to which to write log
         messages; default configured in code; use /dev/null to disable
         logging
@@ -63,6 +64,7 @@ import logging
 import urllib
 import time
 import md5
+import itertools
 
 import korpexport.exporter as ke
 
@@ -72,6 +74,23 @@ import korpexport.exporter as ke
 # does
 # KORP_SERVER = "http://localhost/cgi-bin/korp/korp.cgi"
 KORP_SERVER = os.path.join(os.path.dirname(__file__), "korp.cgi")
+# Whether to run the commands of the Korp server in the process of this
+# script (by loading korp.cgi as a module) instead of as a subprocess
+# when the Korp server is a program name, as KORP_SERVER by default
+KORP_SERVER_IN_PROCESS = True
+
+# Whether to output the content in chunks as it is formatted, without
+# a Content-Length header (so that the web server uses chunked transfer
+# encoding), instead of formatting the whole content first
+STREAM_CONTENT = True
+# The minimum size in bytes of the blocks in which to write streamed
+# content
+OUTPUT_CHUNK_SIZE = 65536
+# The content types of streamed content to whose end to append a
+# plain-text marker if an error occurs while formatting the content;
+# for other types (such as JSON, HTML and Excel), the marker would
+# make the file invalid, so the content is only truncated
+ERROR_MARKER_CONTENT_TYPES = ["text/plain", "text/csv", "text/tsv"]
 
 _localtime = time.localtime()
 # Path to log file; use /dev/null to disable logging
@@ -150,7 +169,24 @@ def main():
     try:
         result = ke.make_download_file(
             form, form.get("korp_server", KORP_SERVER),
-            urn_resolver=form.get("urn_resolver", URN_RESOLVER))
+            urn_resolver=form.get("urn_resolver", URN_RESOLVER),
+            korp_in_process=KORP_SERVER_IN_PROCESS,
+            stream=STREAM_CONTENT)
+        if STREAM_CONTENT and "download_content" in result:
+            # Format the first block of the content (normally
+            # including at least the first sentence) before printing
+            # the header, so that errors in formatting are reported
+            # as for the whole content unless they occur only later
+            content = result["download_content"]
+            first_block = []
+            first_block_size = 0
+            for chunk in content:
+                first_block.append(chunk)
+                first_block_size += len(chunk)
+                if first_block_size >= OUTPUT_CHUNK_SIZE:
+                    break
+            result["download_content"] = itertools.chain(first_block,
+                                                         content)
     except Exception as e:
         import traceback
         exc = sys.exc_info()
@@ -164,9 +200,9 @@ def main():
             del result["ERROR"]["traceback"]
     # Print HTTP header and content
     print_header(result)
-    print_object(result)
+    content_length = print_object(result)
     if 'download_content' in result:
-        logging.info('Content-length: %d', len(result['download_content']))
+        logging.info('Content-length: %d', content_length)
     logging.info('CPU-load: %s', ' '.join(str(val) for val in os.getloadavg()))
     logging.info('CPU-times: %s', ' '.join(str(val) for val in os.times()[:4]))
     # Log elapsed time
@@ -186,7 +222,8 @@ def print_header(obj):
             - download_charset => Charset (default: utf-8)
             - download_filename => Content-Disposition filename
             - download_content => Length of the content to
-              Content-Length
+              Content-Length (omitted if the content is an iterator
+              over its chunks)
 
             If `obj` contains the key ``ERROR``, output
             ``text/plain``, not an attachment.
@@ -201,7 +238,8 @@ def print_header(obj):
         # Default filename 
         print make_content_disposition_attachment(
             obj.get("download_filename", "korp_kwic"))
-        print "Content-Length: " + str(len(obj["download_content"]))
+        if isinstance(obj["download_content"], basestring):
+            print "Content-Length: " + str(len(obj["download_content"]))
     print
 
 
@@ -239,7 +277,20 @@ def print_object(obj):
 
     Arguments:
         obj (dict): The downloadable content (in key
-            `download_content`) or an error message dict in `ERROR`.
+            `download_content`), either a string or an iterator over
+            its chunks, or an error message dict in `ERROR`.
+
+    Returns:
+        int: The length of the content printed (0 for an error
+            message)
+
+    The chunks of the content are written in blocks of at least
+    `OUTPUT_CHUNK_SIZE` bytes. As the header has already been printed,
+    an error in formatting the chunks is logged and the content is
+    truncated; for the content types in `ERROR_MARKER_CONTENT_TYPES`,
+    the error is also marked at the end of the content. (Errors in
+    formatting individual sentences are shown as ``[none]`` by the
+    formatter and do not truncate the content.)
     """
     if "ERROR" in obj:
         error = obj["ERROR"]
@@ -247,8 +298,36 @@ def print_object(obj):
         print error["type"] + ": " + error["value"]
         if "traceback" in error:
             print error["traceback"]
-    else:
-        print obj["download_content"],
+        return 0
+    content = obj["download_content"]
+    if isinstance(content, basestring):
+        print content,
+        return len(content)
+    content_length = 0
+    block = []
+    block_size = 0
+    try:
+        for chunk in content:
+            block.append(chunk)
+            block_size += len(chunk)
+            if block_size >= OUTPUT_CHUNK_SIZE:
+                sys.stdout.write("".join(block))
+                content_length += block_size
+                block = []
+                block_size = 0
+    except Exception as e:
+        import traceback
+        logging.error("Error when formatting the content: %s",
+                      traceback.format_exc().splitlines())
+        sys.stdout.write("".join(block))
+        if (obj.get("download_content_type", "text/plain")
+                in ERROR_MARKER_CONTENT_TYPES):
+            sys.stdout.write("\n\n[Error when formatting the content; the"
+                             " content is incomplete: %s: %s]\n"
+                             % (type(e).__name__, str(e)))
+        return content_length + block_size
+    sys.stdout.write("".join(block))
+    return content_length + block_size
 
 
 if __name__ == "__main__":
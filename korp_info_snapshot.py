@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+A precomputed snapshot of the metadata of all corpora for the info
+command.
+
+The snapshot is built offline and saved as a single JSON file
+korp_config.INFO_SNAPSHOT_FILE. It contains the attributes and the
+information items of each corpus (from the CWB registry and data, see
+korp_registry, and the database table corpus_info if
+korp_config.DB_HAS_CORPUSINFO), the undefined corpora, the protected
+corpora and the CQP version. korp.cgi loads the snapshot once per
+process (and again when the file changes) and answers the info command
+by taking the requested corpora from it, so that no per-request
+computation or per-corpus-combination cache files are needed.
+
+The snapshot should be rebuilt whenever corpora are added, updated or
+removed or their licences change; until then, korp.cgi computes the
+information of corpora missing from the snapshot as before. The file
+is written under a temporary name and renamed only when complete.
+
+Usage: korp_info_snapshot.py [--verbose]
+"""
+
+
+import os
+import sys
+import time
+import argparse
+
+from subprocess import Popen, PIPE
+
+import korp_config as config
+import korp_registry
+import korp_json
+
+
+# The version of the snapshot format; snapshots of other versions are
+# ignored
+SNAPSHOT_FORMAT = 1
+
+# The loaded snapshot: (file modification time, snapshot)
+_snapshot = (None, None)
+
+
+def build_snapshot(verbose=False):
+    """Collect the metadata of all corpora and return the snapshot."""
+    starttime = time.time()
+    corpora, undefined = korp_registry.filter_undefined_corpora(
+        korp_registry.list_corpora())
+    snapshot = {"format": SNAPSHOT_FORMAT,
+                "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "cqp-version": _get_cqp_version(),
+                "corpora": dict((corpus, korp_registry.get_corpus_info(corpus))
+                                for corpus in corpora),
+                "undefined_corpora": undefined,
+                "protected_corpora": _get_protected_corpora()}
+    if config.DB_HAS_CORPUSINFO:
+        _add_corpusinfo_from_database(snapshot["corpora"])
+    if verbose:
+        sys.stderr.write("Collected the information of %d corpora in %.1f s\n"
+                         % (len(corpora), time.time() - starttime))
+    return snapshot
+
+
+def save_snapshot(snapshot, filename=None):
+    """Save snapshot to filename (default: config.INFO_SNAPSHOT_FILE)."""
+    filename = filename or config.INFO_SNAPSHOT_FILE
+    tmpfile = filename + "_new"
+    with open(tmpfile, "w") as snapshot_file:
+        korp_json.dump(snapshot, snapshot_file)
+    os.rename(tmpfile, filename)
+
+
+def load_snapshot(filename=None):
+    """Return the snapshot in filename (default:
+    config.INFO_SNAPSHOT_FILE), or None if it does not exist or is of
+    another format version. The snapshot is reloaded only if the file
+    has changed since the previous call."""
+    global _snapshot
+    filename = filename or config.INFO_SNAPSHOT_FILE
+    try:
+        mtime = os.path.getmtime(filename)
+    except OSError:
+        return None
+    if _snapshot[0] != mtime:
+        try:
+            with open(filename, "r") as snapshot_file:
+                snapshot = korp_json.load(snapshot_file)
+        except (IOError, ValueError):
+            return None
+        if snapshot.get("format") != SNAPSHOT_FORMAT:
+            snapshot = None
+        _snapshot = (mtime, snapshot)
+    return _snapshot[1]
+
+
+def _get_cqp_version():
+    process = Popen([config.CQP_EXECUTABLE, "-c", "-r", config.CWB_REGISTRY],
+                    stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    reply, _ = process.communicate("exit;\n")
+    return reply.decode(config.CQP_ENCODING, "ignore").splitlines()[0]
+
+
+def _get_protected_corpora():
+    """Return the protected corpora listed in config.PROTECTED_FILE or
+    the auth database."""
+    if config.PROTECTED_FILE:
+        with open(config.PROTECTED_FILE) as infile:
+            return [x.strip() for x in infile.readlines()]
+    import MySQLdb
+    conn = MySQLdb.connect(use_unicode=True, charset="utf8",
+                           **config.AUTH_DBCONNECT)
+    cursor = conn.cursor()
+    cursor.execute("SELECT corpus FROM auth_license"
+                   " WHERE license LIKE 'ACA%' OR license = 'RES';")
+    protected = [corpus for corpus, in cursor]
+    cursor.close()
+    conn.close()
+    return protected
+
+
+def _add_corpusinfo_from_database(corpus_infos):
+    """Add the extra info items in the table corpus_info to the info of
+    the corpora in corpus_infos."""
+    import MySQLdb
+    conn = MySQLdb.connect(use_unicode=True, charset="utf8",
+                           **config.DBCONNECT)
+    cursor = conn.cursor()
+    cursor.execute("SELECT `corpus`, `key`, `value` FROM corpus_info;")
+    for corpus, key, value in cursor:
+        corpus = corpus.upper()
+        if corpus in corpus_infos:
+            corpus_infos[corpus]["info"][key] = value
+    cursor.close()
+    conn.close()
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Build the corpus metadata snapshot used by the info"
+        " command of korp.cgi to korp_config.INFO_SNAPSHOT_FILE.")
+    argparser.add_argument(
+        "--verbose", "-v", action="store_true",
+        help="report progress")
+    args = argparser.parse_args()
+    if not config.INFO_SNAPSHOT_FILE:
+        argparser.error("korp_config.INFO_SNAPSHOT_FILE is not set")
+    save_snapshot(build_snapshot(args.verbose))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+JSON encoding and decoding with the fastest available backend.
+
+korp.cgi uses this module for its responses and cache files. The
+backend is selected by korp_config.JSON_BACKEND: "auto" (the default)
+uses ujson if it is installed and otherwise the standard json module;
+simplejson can be selected explicitly. All the backends produce
+compact JSON (ASCII) and cache files written with one backend can be
+read with another.
+
+Note that simplejson decodes strings containing only ASCII characters
+as str instead of unicode, unlike the other backends, so it is not
+selected by "auto": the values read from cache files would otherwise
+change type depending on the installed modules. Note also that ujson
+versions before 2 round floating-point numbers to 15 significant
+digits.
+
+Run the module as a script to compare the speed of the available
+backends on count- and KWIC-like data.
+
+Usage: korp_json.py [--rows N] [--repeat N]
+"""
+
+
+import sys
+import json
+import time
+import random
+import argparse
+
+import korp_config as config
+
+
+BACKENDS = ["ujson", "simplejson", "json"]
+# The backends tried by "auto", in order; all decode strings as unicode
+AUTO_BACKENDS = ["ujson", "json"]
+
+
+def _make_backend(name):
+    """Return a tuple (dumps, loads) of the functions of the backend
+    name, or None if it is not installed."""
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    if name == "ujson":
+        return (lambda obj: module.dumps(obj, ensure_ascii=True,
+                                         escape_forward_slashes=False),
+                module.loads)
+    elif name in ("simplejson", "json"):
+        return (lambda obj: module.dumps(obj, separators=(",", ":")),
+                module.loads)
+    raise ValueError("Unknown JSON backend: %s" % name)
+
+
+def _select_backend(name):
+    if name != "auto":
+        backend = _make_backend(name)
+        if backend is None:
+            raise ImportError("JSON backend %s is not installed" % name)
+        return name, backend
+    for name in AUTO_BACKENDS:
+        backend = _make_backend(name)
+        if backend:
+            return name, backend
+
+
+# The name and the functions of the selected backend
+BACKEND, (_dumps, _loads) = _select_backend(config.JSON_BACKEND)
+
+
+def dumps(obj):
+    """Return obj encoded as compact JSON."""
+    return _dumps(obj)
+
+
+def loads(s):
+    """Return the object decoded from the JSON string s."""
+    return _loads(s)
+
+
+def dump(obj, fp):
+    """Write obj encoded as compact JSON to the file fp."""
+    fp.write(_dumps(obj))
+
+
+def load(fp):
+    """Return the object decoded from the JSON in the file fp."""
+    return _loads(fp.read())
+
+
+def _make_count_data(rows):
+    """Return a result of the count command with rows rows in each of
+    five corpora."""
+    words = ["w%d" % num for num in xrange(rows * 2)]
+    corpora = {}
+    for corpus_num in xrange(5):
+        absolute = dict((word, random.randint(1, 1000))
+                        for word in random.sample(words, rows))
+        corpora["CORPUS%d" % corpus_num] = {
+            "absolute": absolute,
+            "relative": dict((word, freq / 123456.7)
+                             for word, freq in absolute.iteritems()),
+            "sums": {"absolute": sum(absolute.itervalues()),
+                     "relative": 8100.5}}
+    return {"corpora": corpora, "count": rows}
+
+
+def _make_kwic_data(rows):
+    """Return a result of the query command with rows KWIC rows."""
+    def token(num):
+        return {"word": u"sana%d" % num, "lemma": u"|sana|",
+                "pos": "N", "msd": "NUM_Sg|CASE_Nom", "ref": str(num),
+                "dephead": str(num - 1), "deprel": "nsubj"}
+    kwic = [{"corpus": "CORPUS",
+             "match": {"start": 10, "end": 11, "position": num * 20},
+             "structs": {"text_title": u"Tähtien sota", "text_year": "1977",
+                         "sentence_id": str(num)},
+             "tokens": [token(tok) for tok in xrange(20)]}
+            for num in xrange(rows)]
+    return {"kwic": kwic, "hits": rows * 10, "corpus_hits": {"CORPUS": rows}}
+
+
+def benchmark(rows, repeat, out=sys.stdout):
+    """Print the time of encoding and decoding count and KWIC data
+    with each installed backend."""
+    random.seed(0)
+    payloads = [("count", _make_count_data(rows)),
+                ("kwic", _make_kwic_data(rows // 10))]
+    out.write("%-12s %-6s %10s %10s %10s\n"
+              % ("backend", "data", "size", "dumps (s)", "loads (s)"))
+    for name in BACKENDS:
+        backend = _make_backend(name)
+        if backend is None:
+            out.write("%-12s (not installed)\n" % name)
+            continue
+        backend_dumps, backend_loads = backend
+        for payload_name, payload in payloads:
+            starttime = time.time()
+            for _ in xrange(repeat):
+                encoded = backend_dumps(payload)
+            dumps_time = (time.time() - starttime) / repeat
+            starttime = time.time()
+            for _ in xrange(repeat):
+                backend_loads(encoded)
+            loads_time = (time.time() - starttime) / repeat
+            out.write("%-12s %-6s %10d %10.4f %10.4f\n"
+                      % (name, payload_name, len(encoded), dumps_time,
+                         loads_time))
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Compare the speed of the available JSON backends on"
+        " count and KWIC results.")
+    argparser.add_argument(
+        "--rows", type=int, default=50000,
+        help="the number of frequency table rows per corpus; the number"
+        " of KWIC rows is a tenth of this (default: %(default)s)")
+    argparser.add_argument(
+        "--repeat", type=int, default=5,
+        help="the number of times to repeat each operation"
+        " (default: %(default)s)")
+    args = argparser.parse_args()
+    sys.stdout.write("Selected backend: %s\n" % BACKEND)
+    benchmark(args.rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,504 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+An in-memory lemgram prefix index for lemgram autocompletion.
+
+The index is built from the database table lemgram_index and saved to
+the file korp_config.LEMGRAM_INDEX_FILE. A persistent service loads
+the index and answers completion requests from korp_lemgrams.cgi over
+the Unix socket korp_config.LEMGRAM_INDEX_SOCKET, so that a completion
+needs neither loading the index nor querying the database. The service
+reloads the index when the file changes.
+
+The module also adds to lemgram_index the column lemgram_key with
+normalized lemgrams (see normalize_lemgram), used by korp_lemgrams.cgi
+and the lemgram_count command of korp.cgi for case-insensitive and
+optionally accent-insensitive lemgram lookup with an index. The
+column is not filled in when rows are inserted, so "addkey" should be
+rerun after each import to lemgram_index; it then only normalizes the
+lemgrams of the new rows.
+
+The completions are the same as those of the database queries in
+korp_lemgrams.cgi: first lemgrams of the lemma in the selected
+corpora, then lemgrams with the prefix in them, then the same in all
+corpora, each ordered by descending frequency and lemgram. If the
+prefix is in normalized form, it is matched with the normalized
+lemgrams.
+
+Usage:
+  korp_lemgram_index.py build [--verbose]
+  korp_lemgram_index.py serve [--verbose]
+  korp_lemgram_index.py addkey [--verbose] [--all]
+"""
+
+
+import os
+import sys
+import json
+import time
+import heapq
+import socket
+import argparse
+import unicodedata
+import cPickle
+import threading
+import SocketServer
+
+from array import array
+from bisect import bisect_left
+
+import korp_config as config
+
+
+class LemgramIndex(object):
+
+    """A lemgram prefix index with frequencies by corpus.
+
+    The lemgrams are kept in a sorted list, and their normalized
+    forms in another sorted list with the numbers of the corresponding
+    lemgrams. The frequencies of each lemgram by corpus are in
+    parallel arrays. The most frequent lemgrams with each prefix of at
+    most TOPK_PREFIX_LEN characters are precomputed in total
+    (TOPK_SIZE lemgrams) and in each corpus (CORPUS_TOPK_SIZE
+    lemgrams), so that the most common completions with short
+    prefixes need not scan all lemgrams with the prefix. The
+    completions in a set of corpora are found from the lists of the
+    corpora with the threshold algorithm, falling back to a scan only
+    if the lists are too short to determine them.
+    """
+
+    TOPK_PREFIX_LEN = 3
+    TOPK_SIZE = 50
+    CORPUS_TOPK_SIZE = 20
+
+    def __init__(self, corpus_freqs):
+        """Build the index from corpus_freqs, a dict mapping lemgrams
+        (Unicode) to dicts mapping corpus ids to frequencies."""
+        self._lemgrams = sorted(corpus_freqs)
+        self._corpus_nums = {}
+        self._totals = array("L")
+        # The corpus frequencies of lemgram i are at positions
+        # _offsets[i] to _offsets[i + 1] - 1 of _corpora and _freqs
+        self._offsets = array("L", [0])
+        self._corpora = array("H")
+        self._freqs = array("L")
+        for lemgram in self._lemgrams:
+            freqs = corpus_freqs[lemgram]
+            for corpus, freq in freqs.iteritems():
+                corpus_num = self._corpus_nums.setdefault(
+                    corpus.upper(), len(self._corpus_nums))
+                self._corpora.append(corpus_num)
+                self._freqs.append(freq)
+            self._offsets.append(len(self._corpora))
+            self._totals.append(sum(freqs.itervalues()))
+        folded = sorted((normalize_lemgram(lemgram), num)
+                        for num, lemgram in enumerate(self._lemgrams))
+        self._folded_keys = [key for key, _ in folded]
+        self._folded_nums = array("L", (num for _, num in folded))
+        by_freq = sorted(xrange(len(self._lemgrams)),
+                         key=lambda num: (-self._totals[num],
+                                          self._lemgrams[num]))
+        # The lemgrams of each corpus in the order of descending
+        # frequency in the corpus
+        by_corpus_freq = {}
+        for num in xrange(len(self._lemgrams)):
+            for entry in xrange(self._offsets[num], self._offsets[num + 1]):
+                by_corpus_freq.setdefault(self._corpora[entry], []).append(
+                    (-self._freqs[entry], self._lemgrams[num], num))
+        for corpus_nums in by_corpus_freq.itervalues():
+            corpus_nums.sort()
+        self._topk = {}
+        self._folded_topk = {}
+        self._corpus_topk = {}
+        self._folded_corpus_topk = {}
+        for topk, corpus_topk, get_key in [
+                (self._topk, self._corpus_topk,
+                 lambda num: self._lemgrams[num]),
+                (self._folded_topk, self._folded_corpus_topk,
+                 lambda num: normalize_lemgram(self._lemgrams[num]))]:
+            self._add_topk(topk, by_freq, get_key, self.TOPK_SIZE)
+            for corpus_num, corpus_nums in by_corpus_freq.iteritems():
+                self._add_topk(corpus_topk, (num for _, _, num in corpus_nums),
+                               get_key, self.CORPUS_TOPK_SIZE, corpus_num)
+
+    def _add_topk(self, topk, nums, get_key, size, corpus_num=None):
+        """Add to the dict topk the size first lemgrams of nums with
+        each prefix of at most TOPK_PREFIX_LEN characters of the keys
+        returned by get_key, as arrays keyed by the prefix, or by the
+        pair (corpus_num, prefix) if corpus_num is not None."""
+        for num in nums:
+            key = get_key(num)
+            for prefix_len in xrange(1, min(len(key), self.TOPK_PREFIX_LEN) + 1):
+                topk_key = key[:prefix_len]
+                if corpus_num is not None:
+                    topk_key = (corpus_num, topk_key)
+                prefix_nums = topk.setdefault(topk_key, array("L"))
+                if len(prefix_nums) < size:
+                    prefix_nums.append(num)
+
+    def __len__(self):
+        return len(self._lemgrams)
+
+    def complete(self, wf, corpora=None, limit=10):
+        """Return at most limit lemgrams completing wf (Unicode).
+
+        Lemgrams of lemma wf in corpora are returned first, then
+        lemgrams beginning with wf in corpora, and then the same in
+        all corpora, each in the order of descending frequency (in
+        corpora) and lemgram. If wf is in normalized form, it is
+        matched with the normalized lemgrams.
+        """
+        fold = is_normalized_lemgram(wf)
+        result = []
+        result_set = set()
+        corpora_lists = [corpora]
+        if corpora:
+            corpora_lists.append(None)
+        for corpus_list in corpora_lists:
+            if corpus_list:
+                corpus_nums = set(self._corpus_nums[corpus.upper()]
+                                  for corpus in corpus_list
+                                  if corpus.upper() in self._corpus_nums)
+                if not corpus_nums:
+                    continue
+            else:
+                corpus_nums = None
+            # A lemma may not end in a full stop, so lemgrams beginning
+            # with wf... are not lemgrams of lemma wf
+            for prefix, exclude in [(wf + u"..", wf + u"..."), (wf, None)]:
+                for num in self._find(prefix, exclude, fold, corpus_nums,
+                                      limit):
+                    lemgram = self._lemgrams[num]
+                    if lemgram not in result_set:
+                        result.append(lemgram)
+                        result_set.add(lemgram)
+                if len(result) >= limit:
+                    return result[:limit]
+        return result
+
+    def _find(self, prefix, exclude, fold, corpus_nums, limit):
+        """Return the numbers of the limit most frequent lemgrams
+        beginning with prefix but not with exclude, in corpus_nums if
+        not None, using the normalized keys if fold."""
+        if prefix and len(prefix) <= self.TOPK_PREFIX_LEN:
+            result = self._find_topk(prefix, exclude, fold, corpus_nums,
+                                     limit)
+            if result is not None:
+                return result
+        keys = self._folded_keys if fold else self._lemgrams
+        start = bisect_left(keys, prefix)
+        end = (bisect_left(keys, prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+               if prefix else len(keys))
+        candidates = []
+        for pos in xrange(start, end):
+            if exclude and keys[pos].startswith(exclude):
+                continue
+            num = self._folded_nums[pos] if fold else pos
+            if corpus_nums is None:
+                freq = self._totals[num]
+            else:
+                freq = None
+                for entry in xrange(self._offsets[num],
+                                    self._offsets[num + 1]):
+                    if self._corpora[entry] in corpus_nums:
+                        freq = (freq or 0) + self._freqs[entry]
+                if freq is None:
+                    continue
+            candidates.append((-freq, self._lemgrams[num], num))
+        return [num for _, _, num in heapq.nsmallest(limit, candidates)]
+
+    def _find_topk(self, prefix, exclude, fold, corpus_nums, limit):
+        """Return the result of _find from the precomputed most
+        frequent lemgrams with prefix, or None if they do not suffice.
+
+        The lists of the corpora in corpus_nums (or the list of total
+        frequencies if corpus_nums is None) are read in parallel
+        (Fagin's threshold algorithm): once the limit best lemgrams
+        seen so far are more frequent than the sum of the frequencies
+        at the current position of the lists, no lemgram further in
+        the lists can be among them. A list shorter than its maximum
+        size contains all the lemgrams with the prefix.
+        """
+        # Pairs (lemgrams, corpora in which their frequencies are
+        # listed)
+        if corpus_nums is None:
+            topk = self._folded_topk if fold else self._topk
+            lists = [(topk.get(prefix, []), None)]
+            size = self.TOPK_SIZE
+        else:
+            topk = self._folded_corpus_topk if fold else self._corpus_topk
+            lists = [(topk[(corpus_num, prefix)], (corpus_num,))
+                     for corpus_num in corpus_nums
+                     if (corpus_num, prefix) in topk]
+            size = self.CORPUS_TOPK_SIZE
+        keys = self._lemgrams
+        seen = set()
+        candidates = []
+        for depth in xrange(size):
+            threshold = 0
+            for nums, list_corpus_nums in lists:
+                if depth >= len(nums):
+                    continue
+                num = nums[depth]
+                threshold += self._get_freq(num, list_corpus_nums)
+                if num in seen:
+                    continue
+                seen.add(num)
+                key = normalize_lemgram(keys[num]) if fold else keys[num]
+                if exclude and key.startswith(exclude):
+                    continue
+                candidates.append((-self._get_freq(num, corpus_nums),
+                                   keys[num], num))
+            best = heapq.nsmallest(limit, candidates)
+            if len(best) == limit and -best[-1][0] > threshold:
+                return [num for _, _, num in best]
+        if all(len(nums) < size for nums, _ in lists):
+            return [num for _, _, num in heapq.nsmallest(limit, candidates)]
+        return None
+
+    def _get_freq(self, num, corpus_nums):
+        """Return the frequency of lemgram num in the corpora
+        corpus_nums, or in total if corpus_nums is None."""
+        if corpus_nums is None:
+            return self._totals[num]
+        return sum(self._freqs[entry]
+                   for entry in xrange(self._offsets[num],
+                                       self._offsets[num + 1])
+                   if self._corpora[entry] in corpus_nums)
+
+    def save(self, filename):
+        """Save the index to filename, replacing it atomically."""
+        tmpfile = "%s.%d" % (filename, os.getpid())
+        with open(tmpfile, "wb") as f:
+            cPickle.dump(self, f, protocol=-1)
+        os.rename(tmpfile, filename)
+
+    @staticmethod
+    def load(filename):
+        """Load an index saved with save from filename."""
+        with open(filename, "rb") as f:
+            return cPickle.load(f)
+
+
+def normalize_lemgram(lemgram,
+                      strip_diacritics=config.LEMGRAM_KEY_STRIP_DIACRITICS):
+    """Return the normalized form of lemgram (Unicode): lowercased and,
+    if strip_diacritics, with diacritics removed (e.g. "hår" -> "har")."""
+    lemgram = lemgram.lower()
+    if strip_diacritics:
+        lemgram = u"".join(
+            char for char in unicodedata.normalize("NFD", lemgram)
+            if not unicodedata.combining(char))
+    return lemgram
+
+
+def is_normalized_lemgram(lemgram):
+    """Return True if lemgram (Unicode) is in normalized form, in which
+    case it should be matched with the normalized lemgrams."""
+    return lemgram == normalize_lemgram(lemgram)
+
+
+def _connect():
+    """Return a connection to the Korp database returning Unicode."""
+    import MySQLdb
+    conn = MySQLdb.connect(use_unicode=True,
+                           charset="utf8",
+                           **config.DBCONNECT)
+    # Get Unicode objects even with collation utf8_bin; see
+    # <http://stackoverflow.com/questions/9522413/mysql-python-collation-issue-how-to-force-unicode-datatype>
+    conn.converter[MySQLdb.constants.FIELD_TYPE.VAR_STRING] = [
+        (None, conn.string_decoder)]
+    return conn
+
+
+def build_index(verbose=False):
+    """Build the lemgram index from the database table lemgram_index
+    and return it."""
+    import MySQLdb.cursors
+    starttime = time.time()
+    conn = _connect()
+    cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+    cursor.execute("SELECT lemgram, corpus, SUM(freq) FROM lemgram_index"
+                   " GROUP BY lemgram, corpus ORDER BY NULL;")
+    corpus_freqs = {}
+    for lemgram, corpus, freq in cursor:
+        corpus_freqs.setdefault(lemgram, {})[corpus] = int(freq)
+    cursor.close()
+    conn.close()
+    if verbose:
+        sys.stderr.write("Read %d lemgrams in %.1f s\n"
+                         % (len(corpus_freqs), time.time() - starttime))
+    index = LemgramIndex(corpus_freqs)
+    if verbose:
+        sys.stderr.write("Built index in %.1f s\n" % (time.time() - starttime))
+    return index
+
+
+def add_lemgram_key(verbose=False, chunk_size=1000, update_all=False):
+    """Add to the table lemgram_index the column lemgram_key with the
+    normalized forms of the lemgrams, and an index on it, or fill in
+    the missing values if the column exists.
+
+    The keys are computed with normalize_lemgram, which cannot be done
+    in the database, so the keys of rows inserted afterwards are NULL
+    and the rows are not found by the normalized lemgram. This should
+    thus be rerun after each import to lemgram_index; only the missing
+    keys are computed, unless update_all is True, as is needed after
+    changing config.LEMGRAM_KEY_STRIP_DIACRITICS.
+    """
+    starttime = time.time()
+    conn = _connect()
+    cursor = conn.cursor()
+    cursor.execute("SHOW COLUMNS FROM lemgram_index;")
+    columns = dict((row[0], row[1]) for row in cursor)
+    if "lemgram_key" not in columns:
+        if verbose:
+            sys.stderr.write("Adding column lemgram_key\n")
+        cursor.execute("ALTER TABLE lemgram_index"
+                       " ADD COLUMN lemgram_key " + columns["lemgram"]
+                       + " CHARACTER SET utf8 COLLATE utf8_bin,"
+                       " ADD INDEX lemgram_key (lemgram_key, corpus);")
+    cursor.execute("SELECT DISTINCT lemgram FROM lemgram_index"
+                   + ("" if update_all else " WHERE lemgram_key IS NULL")
+                   + ";")
+    lemgrams = [row[0] for row in cursor]
+    if verbose:
+        sys.stderr.write("Normalizing %d lemgrams\n" % len(lemgrams))
+    # Set the keys by joining with a table of the keys of the distinct
+    # lemgrams, instead of updating each lemgram separately
+    cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_lemgram_keys;")
+    cursor.execute("CREATE TEMPORARY TABLE tmp_lemgram_keys"
+                   " SELECT lemgram, lemgram_key FROM lemgram_index LIMIT 0;")
+    cursor.execute("ALTER TABLE tmp_lemgram_keys"
+                   " MODIFY lemgram " + columns["lemgram"]
+                   + " CHARACTER SET utf8 COLLATE utf8_bin,"
+                   " ADD PRIMARY KEY (lemgram);")
+    for chunk_start in xrange(0, len(lemgrams), chunk_size):
+        cursor.executemany(
+            "INSERT IGNORE INTO tmp_lemgram_keys (lemgram, lemgram_key)"
+            " VALUES (%s, %s)",
+            [(lemgram, normalize_lemgram(lemgram))
+             for lemgram in lemgrams[chunk_start:chunk_start + chunk_size]])
+    cursor.execute("UPDATE lemgram_index AS L, tmp_lemgram_keys AS K"
+                   " SET L.lemgram_key = K.lemgram_key"
+                   " WHERE L.lemgram = K.lemgram COLLATE utf8_bin;")
+    cursor.execute("DROP TEMPORARY TABLE tmp_lemgram_keys;")
+    conn.commit()
+    cursor.close()
+    conn.close()
+    if verbose:
+        sys.stderr.write("Added lemgram keys in %.1f s\n"
+                         % (time.time() - starttime))
+
+
+class _LemgramIndexHandler(SocketServer.StreamRequestHandler):
+
+    """Answer a completion request of the lemgram index service.
+
+    A request is a JSON object with the keys "wf", "corpora" and
+    "limit" on a single line, and the response is a JSON list of the
+    completing lemgrams on a single line.
+    """
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        index = self.server.get_index()
+        result = index.complete(request["wf"], request.get("corpora"),
+                                int(request.get("limit", 10)))
+        self.wfile.write(json.dumps(result) + "\n")
+
+
+class LemgramIndexServer(SocketServer.ThreadingMixIn,
+                         SocketServer.UnixStreamServer):
+
+    """The lemgram index service, reloading the index from its file
+    when the file has changed."""
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, index_file, verbose=False):
+        self._index_file = index_file
+        self._verbose = verbose
+        self._lock = threading.Lock()
+        self._index = None
+        self._index_mtime = None
+        self.get_index()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                               _LemgramIndexHandler)
+
+    def get_index(self):
+        """Return the index, reloading it if its file has changed."""
+        mtime = os.path.getmtime(self._index_file)
+        if mtime != self._index_mtime:
+            with self._lock:
+                if mtime != self._index_mtime:
+                    self._index = LemgramIndex.load(self._index_file)
+                    self._index_mtime = mtime
+                    if self._verbose:
+                        sys.stderr.write("Loaded %d lemgrams from %s\n"
+                                         % (len(self._index),
+                                            self._index_file))
+        return self._index
+
+
+def query_service(wf, corpora, limit, socket_path=None, timeout=2):
+    """Return the completions of wf (Unicode) in corpora from the
+    lemgram index service listening on socket_path (default:
+    config.LEMGRAM_INDEX_SOCKET). Raise socket.error if the service
+    cannot be reached or does not respond within timeout seconds."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socket_path or config.LEMGRAM_INDEX_SOCKET)
+        sock.sendall(json.dumps({"wf": wf, "corpora": corpora,
+                                 "limit": limit}) + "\n")
+        response = sock.makefile("rb").readline()
+    finally:
+        sock.close()
+    if not response:
+        raise socket.error("No response from the lemgram index service")
+    return json.loads(response)
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description="Build or serve the lemgram prefix index used by"
+        " korp_lemgrams.cgi.")
+    argparser.add_argument(
+        "action", choices=["build", "serve", "addkey"],
+        help="build the index from the database to"
+        " korp_config.LEMGRAM_INDEX_FILE, serve it at"
+        " korp_config.LEMGRAM_INDEX_SOCKET, or add normalized lemgrams"
+        " to the table lemgram_index")
+    argparser.add_argument(
+        "--verbose", "-v", action="store_true",
+        help="report progress")
+    argparser.add_argument(
+        "--all", action="store_true", dest="update_all",
+        help="with addkey, recompute all normalized lemgrams instead of"
+        " only the missing ones")
+    args = argparser.parse_args()
+    if args.action == "addkey":
+        add_lemgram_key(args.verbose, update_all=args.update_all)
+        return
+    if not config.LEMGRAM_INDEX_FILE:
+        argparser.error("korp_config.LEMGRAM_INDEX_FILE is not set")
+    if args.action == "build":
+        # Use the class of the module instead of __main__, so that the
+        # pickled index can be loaded elsewhere
+        import korp_lemgram_index
+        korp_lemgram_index.build_index(args.verbose).save(
+            config.LEMGRAM_INDEX_FILE)
+    else:
+        if not config.LEMGRAM_INDEX_SOCKET:
+            argparser.error("korp_config.LEMGRAM_INDEX_SOCKET is not set")
+        server = LemgramIndexServer(config.LEMGRAM_INDEX_SOCKET,
+                                    config.LEMGRAM_INDEX_FILE, args.verbose)
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
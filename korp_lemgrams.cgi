@@ -12,8 +12,10 @@
 import time
 import cgi
 import json
+import socket
 import MySQLdb
 import korp_config as config
+import korp_lemgram_index
 
 
 # The name of the MySQL database and table prefix
@@ -52,6 +54,15 @@ def main():
 
 
 def get_lemgrams(wf, corpora, limit):
+    if config.LEMGRAM_INDEX_SOCKET:
+        try:
+            result = korp_lemgram_index.query_service(
+                wf.decode("utf-8"), corpora, limit)
+            return encode_lemgram_result(result)
+        except (socket.error, ValueError):
+            # Fall back to querying the database if the lemgram index
+            # service is not running
+            pass
     conn = MySQLdb.connect(use_unicode=True,
                            charset="utf8",
                            **config.DBCONNECT)
@@ -70,7 +81,16 @@ def query_lemgrams(cursor, wf, param_corpora, limit):
     result = []
     # Also collect the results in a set to filter out duplicates
     result_set = set()
-    modcase = (lambda w: w.lower()) if wf.islower() else (lambda w: w)
+    # Match a prefix in normalized form with the normalized lemgrams
+    # if they are available
+    use_key = (config.LEMGRAM_INDEX_HAS_KEY
+               and korp_lemgram_index.is_normalized_lemgram(
+                   wf.decode("utf-8")))
+    if use_key:
+        modcase = lambda w: korp_lemgram_index.normalize_lemgram(
+            w.decode("utf-8")).encode("utf-8")
+    else:
+        modcase = (lambda w: w.lower()) if wf.islower() else (lambda w: w)
     corpora_lists = [param_corpora]
     if param_corpora:
         corpora_lists.append([])
@@ -79,7 +99,8 @@ def query_lemgrams(cursor, wf, param_corpora, limit):
     # order, only until the limit is reached.
     for corpora in corpora_lists:
         for suffpatt, is_any_prefix in [("..%", False), ("%", True)]:
-            sql = make_lemgram_query_part(wf + suffpatt, corpora, limit)
+            sql = make_lemgram_query_part(wf + suffpatt, corpora, limit,
+                                          use_key)
             # print sql
             cursor.execute(sql)
             retrieve_lemgrams(cursor, wf, modcase, is_any_prefix,
@@ -97,10 +118,11 @@ def retrieve_lemgrams(cursor, wf, modcase, is_any_prefix, result, result_set):
     # "här". Using a case-insensitive collation such as
     # utf8_swedish_ci or utf8_unicode_ci would not use the index,
     # since the collation for the table is utf8_bin, so it would be
-    # unacceptably slow. Case-insensitive matching would probably
-    # require a separate column with preprocessed (lowercased, perhaps
-    # accents removed) lemgrams, since apparently MySQL/MariaDB does
-    # not support specifying indexes with different collations.
+    # unacceptably slow. Case-insensitive matching uses the separate
+    # indexed column lemgram_key with normalized (lowercased, perhaps
+    # accents removed) lemgrams if config.LEMGRAM_INDEX_HAS_KEY, since
+    # apparently MySQL/MariaDB does not support specifying indexes
+    # with different collations.
 
     # The SQL LIKE pattern lemma..% also matches lemmas in which the
     # lemma searched for is followed by any number of full stops
@@ -117,8 +139,9 @@ def retrieve_lemgrams(cursor, wf, modcase, is_any_prefix, result, result_set):
             result_set.add(row[0])
 
 
-def make_lemgram_query_part(pattern, corpora, limit):
-    return ("(select distinct lemgram from lemgram_index where lemgram like '"
+def make_lemgram_query_part(pattern, corpora, limit, use_key=False):
+    return ("(select distinct lemgram from lemgram_index where "
+            + ("lemgram_key" if use_key else "lemgram") + " like '"
             + pattern + "'"
             + (" and corpus in (" + ','.join(["'" + corp + "'"
                                              for corp in corpora]) + ")"
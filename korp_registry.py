@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+"""
+Read corpus information directly from CWB registry files and corpus
+data directories.
+
+The functions return the same information as the CQP commands
+"show corpora", "show cd" and "info", used by the info command of
+korp.cgi, without running CQP. The information of a corpus is read
+from its registry file, its .info file and the size of its word
+attribute data; it is memoized per process and reread when the
+modification time of any of the files changes.
+
+A corpus is regarded as undefined (RegistryError) if its registry file
+cannot be read or parsed, or if the data of its word attribute is
+missing; CQP would fail to select such a corpus.
+"""
+
+
+import os
+import re
+import glob
+import shlex
+import struct
+
+import korp_config as config
+
+
+class RegistryError(Exception):
+    pass
+
+
+# Memoized corpus information: corpus id -> (file stamp, info)
+_corpus_infos = {}
+
+_REGISTRY_FILENAME = re.compile(r"^[a-z_][a-z0-9_\-]*$")
+
+
+def _registry_dirs(registry):
+    return [path for path in registry.split(":") if path]
+
+
+def list_corpora(registry=config.CWB_REGISTRY):
+    """Return a sorted list of the ids (in uppercase) of the corpora
+    with a registry file in registry (a colon-separated list of
+    directories)."""
+    corpora = set()
+    for registry_dir in _registry_dirs(registry):
+        try:
+            filenames = os.listdir(registry_dir)
+        except OSError:
+            continue
+        corpora.update(filename.upper() for filename in filenames
+                       if _REGISTRY_FILENAME.match(filename)
+                       and os.path.isfile(os.path.join(registry_dir, filename)))
+    return sorted(corpora)
+
+
+def filter_undefined_corpora(corpora, registry=config.CWB_REGISTRY):
+    """Return a pair of a list of defined and a list of undefined
+    corpora in corpora."""
+    defined = []
+    undefined = []
+    for corpus in corpora:
+        try:
+            get_corpus_info(corpus, registry)
+            defined.append(corpus)
+        except RegistryError:
+            undefined.append(corpus)
+    return (defined, undefined)
+
+
+def get_corpus_info(corpus, registry=config.CWB_REGISTRY):
+    """Return the information of corpus as a dict with the keys "attrs"
+    and "info", in the same format as the result of the info command
+    for a single corpus.
+
+    "attrs" is a dict of the lists of positional ("p"), structural
+    ("s") and alignment ("a") attributes in the order of the registry
+    file. "info" contains the name, size and character set of the
+    corpus and the items of its .info file. If the .info file has no
+    sentence count, it is taken from the number of regions of the
+    structural attribute sentence.
+    """
+    registry_file = _find_registry_file(corpus, registry)
+    memoized = _corpus_infos.get(corpus)
+    if memoized and memoized[0] == _get_stamp(registry_file,
+                                              memoized[1]["files"]):
+        return _copy_info(memoized[1])
+    corpus_info = _read_corpus_info(corpus, registry_file)
+    _corpus_infos[corpus] = (_get_stamp(registry_file, corpus_info["files"]),
+                             corpus_info)
+    return _copy_info(corpus_info)
+
+
+def get_attribute_mtime(corpus, attrs, registry=config.CWB_REGISTRY):
+    """Return the latest modification time of the data files of the
+    attributes attrs of corpus in its data directory, or None if there
+    are no such files. Raise RegistryError if corpus is undefined.
+
+    The time can be compared with that of a file derived from the
+    attributes to check if it is up to date with the corpus data.
+    """
+    get_corpus_info(corpus, registry)
+    home = _corpus_infos[corpus][1]["home"]
+    mtimes = [_get_mtime(filename)
+              for attr in attrs
+              for filename in glob.glob(os.path.join(home, attr + ".*"))]
+    return max(mtimes) if mtimes else None
+
+
+def _copy_info(corpus_info):
+    """Return a copy of corpus_info without the internal items, so
+    that the caller may modify it."""
+    return {"attrs": dict((attrtype, list(attrs))
+                          for attrtype, attrs in corpus_info["attrs"].iteritems()),
+            "info": dict(corpus_info["info"])}
+
+
+def _get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+
+def _get_stamp(registry_file, filenames):
+    return tuple([_get_mtime(registry_file)]
+                 + [_get_mtime(filename) for filename in filenames])
+
+
+def _find_registry_file(corpus, registry):
+    for registry_dir in _registry_dirs(registry):
+        registry_file = os.path.join(registry_dir, corpus.lower())
+        if os.path.isfile(registry_file):
+            return registry_file
+    raise RegistryError("Corpus ``%s'' is undefined" % corpus)
+
+
+def _read_corpus_info(corpus, registry_file):
+    registry_info = _parse_registry_file(registry_file)
+    home = registry_info.get("HOME")
+    if not home:
+        raise RegistryError("No HOME directory in the registry file of %s"
+                            % corpus)
+    size, size_file = _get_corpus_size(home)
+    info = {"Name": registry_info.get("NAME", ""),
+            "Size": str(size),
+            "Charset": registry_info["properties"].get("charset", "latin1")}
+    info_file = registry_info.get("INFO") or os.path.join(home, ".info")
+    info.update(_read_info_file(info_file))
+    if "Sentences" not in info and "sentence" in registry_info["attrs"]["s"]:
+        # Each region of a structural attribute takes 8 bytes
+        try:
+            info["Sentences"] = str(
+                os.path.getsize(os.path.join(home, "sentence.rng")) // 8)
+        except OSError:
+            pass
+    return {"attrs": dict((attrtype, [_decode(attr) for attr in attrs])
+                          for attrtype, attrs
+                          in registry_info["attrs"].iteritems()),
+            "info": dict((_decode(key), _decode(value))
+                         for key, value in info.iteritems()),
+            "home": home,
+            # The files whose changes invalidate the information
+            "files": [size_file, info_file]}
+
+
+def _decode(s):
+    return s.decode(config.CQP_ENCODING, "ignore")
+
+
+def _parse_registry_file(registry_file):
+    """Parse registry_file and return a dict with the values of the
+    NAME, ID, HOME and INFO declarations, the attributes ("attrs") and
+    the corpus properties ("properties")."""
+    result = {"attrs": {"p": [], "s": [], "a": []},
+              "properties": {}}
+    attrtypes = {"ATTRIBUTE": "p", "STRUCTURE": "s", "ALIGNED": "a"}
+    try:
+        with open(registry_file, "r") as regfile:
+            lines = regfile.readlines()
+    except IOError, e:
+        raise RegistryError(str(e))
+    for line in lines:
+        line = line.strip()
+        if line.startswith("##::"):
+            # Corpus property: ##:: name = "value"
+            if "=" in line:
+                name, value = line[4:].split("=", 1)
+                result["properties"][name.strip()] = value.strip().strip("\"'")
+            continue
+        try:
+            fields = shlex.split(line, comments=True)
+        except ValueError:
+            raise RegistryError("Syntax error in registry file %s: %s"
+                                % (registry_file, line))
+        if not fields:
+            continue
+        keyword = fields[0].upper()
+        if keyword in attrtypes:
+            if len(fields) < 2:
+                raise RegistryError("Syntax error in registry file %s: %s"
+                                    % (registry_file, line))
+            result["attrs"][attrtypes[keyword]].append(fields[1])
+        elif keyword in ("NAME", "ID", "HOME", "INFO") and len(fields) > 1:
+            result[keyword] = fields[1]
+    return result
+
+
+def _get_corpus_size(home):
+    """Return the size of the corpus with data in the directory home
+    and the name of the data file from which it was read.
+
+    The size is read from the Huffman code descriptor of the word
+    attribute of a compressed corpus or computed from the size of the
+    token stream of an uncompressed one.
+    """
+    hcd_file = os.path.join(home, "word.hcd")
+    corpus_file = os.path.join(home, "word.corpus")
+    try:
+        if os.path.exists(hcd_file):
+            with open(hcd_file, "rb") as hcd:
+                # The descriptor begins with the number of tokens as a
+                # 32-bit integer in network byte order
+                return struct.unpack("!i", hcd.read(4))[0], hcd_file
+        return os.path.getsize(corpus_file) // 4, corpus_file
+    except (IOError, OSError, struct.error):
+        raise RegistryError("Missing or invalid data for the word attribute"
+                            " in %s" % home)
+
+
+def _read_info_file(info_file):
+    """Return the "key: value" items of the corpus .info file
+    info_file as a dict (empty if the file does not exist)."""
+    info = {}
+    try:
+        with open(info_file, "r") as infile:
+            for line in infile:
+                line = line.strip()
+                if ":" in line and not line.endswith(":"):
+                    infokey, infoval = (x.strip() for x in line.split(":", 1))
+                    info[infokey] = infoval
+    except IOError:
+        pass
+    return info
@@ -13,8 +13,11 @@ generate downloadable file contents.
 
 from __future__ import absolute_import
 
+import sys
 import os.path
 import time
+import imp
+import codecs
 import pkgutil
 import json
 import urllib, urllib2
@@ -32,6 +35,11 @@ __all__ = ['make_download_file',
            'KorpExporter']
 
 
+# The Korp server scripts loaded as modules for running commands in
+# process, by absolute file name
+_korp_modules = {}
+
+
 def make_download_file(form, korp_server_url, **kwargs):
     """Format Korp query results and return them in a downloadable format.
 
@@ -48,7 +56,9 @@ def make_download_file(form, korp_server_url, **kwargs):
         dict: The downloadable file content and meta information;
             contains the following information (strings):
 
-            - download_content: The actual file content
+            - download_content: The actual file content, or an
+              iterator over its chunks if the keyword argument
+              `stream` is true
             - download_charset: The character encoding of the file
               content
             - download_content_type: MIME type for the content
@@ -96,6 +106,38 @@ def _decode_list_param(str_list, alt_delim=None):
     return result
 
 
+def _load_korp_module(progname):
+    """Load the Korp server script `progname` as a module.
+
+    The script is loaded only once per process. Its directory is added
+    to the module search path, so that it finds its configuration and
+    other modules.
+    """
+    progname = os.path.abspath(progname)
+    if progname not in _korp_modules:
+        progdir = os.path.dirname(progname)
+        if progdir not in sys.path:
+            sys.path.insert(0, progdir)
+        # Do not write a compiled file (korp.cgic) next to the script
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        try:
+            _korp_modules[progname] = imp.load_source("korp_server", progname)
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+    return _korp_modules[progname]
+
+
+def _iter_encode(chunks, encoding):
+    """Generate the unicode chunks in `chunks` encoded in `encoding`."""
+    encoder = codecs.getincrementalencoder(encoding)()
+    for chunk in chunks:
+        yield encoder.encode(chunk)
+    final = encoder.encode(u"", True)
+    if final:
+        yield final
+
+
 class KorpExportError(Exception):
 
     """An exception class for errors in exporting Korp query results."""
@@ -123,7 +165,8 @@ class KorpExporter(object):
     """List-valued query parameters that may have been prefix-encoded"""
 
     def __init__(self, form, options=None, filename_format=None,
-                 filename_encoding="utf-8", **kwargs):
+                 filename_encoding="utf-8", korp_in_process=False,
+                 **kwargs):
         """Construct a KorpExporter.
 
         Arguments:
@@ -136,24 +179,31 @@ class KorpExporter(object):
                 keys: cqpwords, start, end, date, time, ext
             filename_encoding (str): The encoding to use for the
                 filename
+            korp_in_process (bool): Whether to run the Korp server
+                commands in this process if the Korp server is
+                specified as a program name (not an HTTP URL)
         """
         self._form = form
         self._filename_format = (filename_format
                                  or form.get("filename_format")
                                  or self._filename_format_default)
         self._filename_encoding = filename_encoding
+        self._korp_in_process = korp_in_process
         self._opts = options or {}
         self._query_params = {}
         self._query_result = None
         self._formatter = None
 
-    def make_download_file(self, korp_server_url, **kwargs):
+    def make_download_file(self, korp_server_url, stream=False, **kwargs):
         """Format query results and return them in a downloadable format.
 
         Arguments:
             korp_server_url (str): The Korp server to query
 
         Keyword arguments:
+            stream (bool): Whether to return the content as an
+                iterator over its chunks, formatted (and encoded) as
+                the iterator advances, instead of a single string
             form (dict): Use the parameters in here instead of those
                 provided to the constructor
             **kwargs: Passed on to formatter
@@ -172,10 +222,18 @@ class KorpExporter(object):
             return self._query_result
         logging.debug('formatter: %s', self._formatter)
         result["download_charset"] = self._formatter.download_charset
-        content = self._formatter.make_download_content(
-            self._query_result, self._query_params, self._opts, **kwargs)
-        if isinstance(content, unicode) and self._formatter.download_charset:
-            content = content.encode(self._formatter.download_charset)
+        if stream:
+            content = self._formatter.iter_download_content(
+                self._query_result, self._query_params, self._opts, **kwargs)
+            if self._formatter.download_charset:
+                content = _iter_encode(content,
+                                       self._formatter.download_charset)
+        else:
+            content = self._formatter.make_download_content(
+                self._query_result, self._query_params, self._opts, **kwargs)
+            if (isinstance(content, unicode)
+                and self._formatter.download_charset):
+                content = content.encode(self._formatter.download_charset)
         result["download_content"] = content
         result["download_content_type"] = self._formatter.mime_type
         result["download_filename"] = self._get_filename()
@@ -308,10 +366,12 @@ class KorpExporter(object):
         or the form as a whole.
 
         Set a private attribute to contain the result, a dictionary
-        converted from the JSON returned by Korp.
+        converted from the JSON returned by Korp or returned directly
+        by the Korp server command run in process.
         """
         if "query_result" in self._form:
-            query_result_json = self._form.get("query_result", "{}")
+            self._query_result = json.loads(
+                self._form.get("query_result", "{}"))
         else:
             if query_params:
                 self._query_params = query_params
@@ -335,11 +395,10 @@ class KorpExporter(object):
                 else:
                     self._query_params["show"] = self._query_params["show_struct"]
             logging.debug("query_params: %s", self._query_params)
-            query_result_json = self._query_korp_server(korp_server_url)
+            self._query_result = self._get_korp_result(korp_server_url)
             # Support "sort" in format params even if not specified
             if "sort" not in self._query_params:
                 self._query_params["sort"] = "none"
-        self._query_result = json.loads(query_result_json)
         logging.debug("query result: %s", self._query_result)
         if "ERROR" in self._query_result or "kwic" not in self._query_result:
             return
@@ -352,6 +411,46 @@ class KorpExporter(object):
                 self._query_params[paramname] = ",".join(_decode_list_param(
                     self._query_params[paramname]))
 
+    def _get_korp_result(self, url_or_progname, query_params=None):
+        """Query a Korp server and return the result as a dict.
+
+        Arguments:
+            url_or_progname (str): Korp server URL or program name
+            query_params (dict): The query parameters to pass to the
+                Korp server; if not specified or `None`, use
+                self._query_params
+
+        Returns:
+            dict: The result returned by the Korp server
+
+        If in-process querying is enabled and `url_or_progname` is a
+        program name, load the program as a module and call its
+        function `run_command`, so that neither a subprocess nor
+        encoding and decoding the result as JSON is needed. Otherwise
+        call :meth:`_query_korp_server` and decode its output.
+        """
+        if self._korp_in_process and not url_or_progname.startswith("http"):
+            if query_params is None:
+                query_params = self._query_params
+            self._add_loginfo(query_params)
+            logging.debug("Korp server (in process): %s", url_or_progname)
+            logging.debug("Korp query params: %s", query_params)
+            korp_server = _load_korp_module(url_or_progname)
+            return korp_server.run_command(
+                dict((key, val.encode("utf-8"))
+                     for key, val in query_params.iteritems()))
+        return json.loads(self._query_korp_server(url_or_progname,
+                                                  query_params))
+
+    def _add_loginfo(self, query_params):
+        """Add the client information to the parameter loginfo in
+        `query_params`."""
+        loginfo_text = "client=korp_download_kwic"
+        if "loginfo" in query_params:
+            query_params["loginfo"] += " " + loginfo_text
+        else:
+            query_params["loginfo"] = loginfo_text
+
     def _query_korp_server(self, url_or_progname, query_params=None):
         """Query a Korp server, either via HTTP or as a subprocess.
 
@@ -387,11 +486,7 @@ class KorpExporter(object):
 
         if query_params is None:
             query_params = self._query_params
-        loginfo_text = "client=korp_download_kwic"
-        if "loginfo" in query_params:
-            query_params["loginfo"] += " " + loginfo_text
-        else:
-            query_params["loginfo"] = loginfo_text
+        self._add_loginfo(query_params)
         # Encode the query parameters in UTF-8 for Korp server
         logging.debug("Korp server: %s", url_or_progname)
         logging.debug("Korp query params: %s", query_params)
@@ -593,9 +688,8 @@ class KorpExporter(object):
             return
         korp_info_params = {'command': 'info',
                             'corpus': ','.join(corpora)}
-        korp_corpus_info_json = self._query_korp_server(korp_server_url,
-                                                        korp_info_params)
-        korp_corpus_info = json.loads(korp_corpus_info_json)
+        korp_corpus_info = self._get_korp_result(korp_server_url,
+                                                 korp_info_params)
         for corpname, corpdata in (korp_corpus_info.get("corpora", {})
                                    .iteritems()):
             corpname = corpname.lower()
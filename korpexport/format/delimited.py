@@ -206,8 +206,8 @@ class KorpExportFormatterDelimitedSentenceSimple(
         super(KorpExportFormatterDelimitedSentenceSimple, self).__init__(
             **kwargs)
 
-    def _format_sentences(self, **kwargs):
-        """Format the sentences of a query result.
+    def _iter_format_sentences(self, **kwargs):
+        """Generate the formatted sentences of a query result.
 
         Format all the sentences of a query result as a list.
         Individual sentences are separated by ``sentence_sep``.
@@ -216,9 +216,9 @@ class KorpExportFormatterDelimitedSentenceSimple(
         tokens_type_info_all = [
             ("tokens", dict(tokens_type="all"), "tokens|.*_all"),
             ("match", dict(match_mark=self._opts.get("match_marker", "")),
-             ".*_match"),
-            ("left_context", {}, ".*_left_context"),
-            ("right_context", {}, ".*_right_context"),
+             "match|.*_match"),
+            ("left_context", {}, "left_context|.*_left_context"),
+            ("right_context", {}, "right_context|.*_right_context"),
         ]
         tokens_type_info = [
             (tokens_type, opts)
@@ -245,13 +245,14 @@ class KorpExportFormatterDelimitedSentenceSimple(
         # token formatting in _format_sentence.
         if not mark_matches and token_format == "{word}":
             token_format = None
-        return self._opts["sentence_sep"].join(
-            self._format_sentence(
+        sentence_sep = self._opts["sentence_sep"]
+        for sentnum, sent in enumerate(sentences):
+            if sentnum > 0:
+                yield sentence_sep
+            yield self._format_sentence_or_missing(
                 sent, sentence_num=sentnum, tokens_type_info=tokens_type_info,
                 token_format=token_format, match_format=match_format,
                 mark_matches=mark_matches, **kwargs)
-            for sentnum, sent in enumerate(
-                    qr.get_sentences(self._query_result)))
 
     def _format_sentence(self, sentence, sentence_num=None,
                          tokens_type_info=None, token_format="",
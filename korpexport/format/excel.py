@@ -48,13 +48,22 @@ class KorpExportFormatterExcel(delimited.KorpExportFormatterDelimited):
         Assumes that `text` contains rows separated by newlines and
         columns separated by tabs.
         """
+        return "".join(self._iter_postprocess([text]))
+
+    def _iter_postprocess(self, chunks):
+        """Generate an XLS file content of the text in `chunks`.
+
+        The rows are added to the workbook as the chunks are
+        generated, and the complete XLS file is generated as a single
+        chunk.
+        """
         # CHECK: Does the encoding parameter have an effect?
         workbook = xlwt.Workbook(encoding="utf-8")
         worksheet = workbook.add_sheet(self._opts.get("title", ""))
-        for rownum, row in enumerate(text.split("\n")):
+        for rownum, row in enumerate(self._iter_lines(chunks)):
             if row:
                 for colnum, value in enumerate(row.split("\t")):
                     worksheet.write(rownum, colnum, value)
         output = strio.StringIO()
         workbook.save(output)
-        return output.getvalue()
+        yield output.getvalue()
@@ -121,13 +121,28 @@ class KorpExportFormatterHtml(KorpExportFormatter):
                 .replace("\x03", "&"))
 
     def _postprocess(self, text):
-        return self._restore_html_tags(escape(self._format_html_page(text)))
-
-    def _format_html_page(self, text):
+        return "".join(self._iter_postprocess([text]))
+
+    def _iter_postprocess(self, chunks):
+        # Format the page with a marker in place of the lines and split
+        # it at the marker, so that the lines can be formatted as the
+        # chunks are generated
+        lines_marker = u"\x00lines\x00"
+        page_parts = self._format_html_page(lines_marker).split(lines_marker)
+        if len(page_parts) != 2:
+            yield self._restore_html_tags(escape(self._format_html_page(
+                "".join(self._iter_format_html_lines(chunks)))))
+            return
+        yield self._restore_html_tags(escape(page_parts[0]))
+        for lines in self._iter_format_html_lines(chunks):
+            yield self._restore_html_tags(escape(lines))
+        yield self._restore_html_tags(escape(page_parts[1]))
+
+    def _format_html_page(self, lines):
         return self._format_item("html_page",
                                  doctype=self._opts.get("html_doctype_format"),
                                  head=self._format_html_head(),
-                                 body=self._format_html_body(text))
+                                 body=self._format_html_body(lines))
 
     def _format_html_head(self):
         return self._format_item("html_head",
@@ -137,11 +152,11 @@ class KorpExportFormatterHtml(KorpExportFormatter):
     def _format_html_title(self):
         return self._format_item("html_title", **self._infoitems)
 
-    def _format_html_body(self, text):
+    def _format_html_body(self, lines):
         return self._format_item("html_body",
                                  heading=self._format_html_heading(),
                                  korp_link=self._format_html_korp_link(),
-                                 lines=self._format_html_lines(text))
+                                 lines=lines)
 
     def _format_html_heading(self):
         return self._format_item("html_heading", **self._infoitems)
@@ -150,14 +165,32 @@ class KorpExportFormatterHtml(KorpExportFormatter):
         return self._format_item("html_korp_link", **self._infoitems)
 
     def _format_html_lines(self, text):
-        result = []
-        for linenr, line in enumerate(text.rstrip("\n").split("\n")):
+        return "".join(self._iter_format_html_lines([text]))
+
+    def _iter_format_html_lines(self, chunks):
+        # Trailing empty lines are skipped, as are leading lines
+        # according to skip_leading_lines
+        linenr = 0
+        empty_lines = 0
+        for line in self._iter_lines(chunks):
+            if line == "":
+                empty_lines += 1
+                continue
+            for _ in xrange(empty_lines):
+                if linenr >= self._skip_leading_lines:
+                    yield self._format_html_content_line("", linenr)
+                linenr += 1
+            empty_lines = 0
             if linenr >= self._skip_leading_lines:
-                result.append(
-                    self._format_item("html_line",
-                                      line=self._format_html_line(
-                                          line, linenr=linenr)))
-        return "".join(result)
+                yield self._format_html_content_line(line, linenr)
+            linenr += 1
+        if linenr == 0 and self._skip_leading_lines <= 0:
+            # An empty content is formatted as a single empty line
+            yield self._format_html_content_line("", linenr)
+
+    def _format_html_content_line(self, line, linenr):
+        return self._format_item(
+            "html_line", line=self._format_html_line(line, linenr=linenr))
 
     def _format_html_line(self, line, linenr=None):
         return (self._format_html_match(line) if self._match_re else line)
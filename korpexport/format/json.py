@@ -46,13 +46,14 @@ class KorpExportFormatterJSON(KorpExportFormatter):
 
     # This class does not use the formatting methods or
     # `_option_default` values in :class:`KorpExportFormatter`.
-    # Instead, it overrides the method `_format_content`.
+    # Instead, it overrides the method `_iter_format_content`.
 
     # TODO: Add meta information (as an item in the JSON).
 
-    def _format_content(self, **kwargs):
-        """Convert Korp query result directly to JSON."""
-        return (json.dumps(qr.get_sentences(self._query_result),
-                           sort_keys=self.get_option_bool("sort_keys"),
-                           indent=self.get_option_int("indent"))
-                + "\n")
+    def _iter_format_content(self, **kwargs):
+        """Convert Korp query result directly to JSON in chunks."""
+        encoder = json.JSONEncoder(sort_keys=self.get_option_bool("sort_keys"),
+                                   indent=self.get_option_int("indent"))
+        for chunk in encoder.iterencode(qr.get_sentences(self._query_result)):
+            yield chunk
+        yield "\n"
@@ -15,6 +15,7 @@ information.
 
 from __future__ import absolute_import
 
+import logging
 import time
 import string
 import re
@@ -151,10 +152,17 @@ class KorpExportFormatter(object):
     additional arguments to formatting methods overridden or extended
     in a subclass.
 
-    Another approach is to override the method `_format_content` and
-    to implement a formatting machinery independent of the other
+    Another approach is to override the method `_iter_format_content`
+    and to implement a formatting machinery independent of the other
     `_format_*` methods and `_option_defaults`.
 
+    The content is generated in chunks (by default, a chunk per
+    sentence) that are post-processed and returned one at a time by
+    `iter_download_content`, so that the whole content need not be in
+    memory at once. A subclass whose post-processing does not work on
+    whole lines independently of each other should override
+    `_iter_postprocess` in addition to `_postprocess`.
+
     The names of the `_format_*` methods begin with an underscore to
     indicate that they are not public, even though they are intended
     to be used or overridden by subclasses.
@@ -487,14 +495,27 @@ class KorpExportFormatter(object):
         overrides options given when constructing the class. The
         return value has newlines converted if necessary.
         """
+        return "".join(self.iter_download_content(
+            query_result, query_params, options, **kwargs))
+
+    def iter_download_content(self, query_result, query_params=None,
+                              options=None, **kwargs):
+        """Generate downloadable content from a Korp query result in chunks.
+
+        Return an iterator over the chunks of the downloadable file
+        content from Korp query result `query_result`, as for
+        :meth:`make_download_content`. The chunks are formatted and
+        post-processed only as the iterator advances.
+        """
         self._query_result = query_result
         self._query_params = query_params or {}
         self._opts.update(options or {})
         self._adjust_opts()
         self._init_sentence_token_attrs()
         self._init_infoitems()
-        return self._convert_newlines(
-            self._postprocess(self._format_content(**kwargs)))
+        for chunk in self._iter_postprocess(
+                self._iter_format_content(**kwargs)):
+            yield self._convert_newlines(chunk)
 
     def _adjust_opts(self):
         """Adjust formatting options in effect.
@@ -630,6 +651,55 @@ class KorpExportFormatter(object):
         """
         return text
 
+    def _iter_postprocess(self, chunks):
+        """Generate the post-processed chunks of formatted content.
+
+        Apply :meth:`_postprocess` to the formatted content chunks
+        `chunks` regrouped to consist of whole lines. This method
+        needs to be overridden in subclasses whose post-processing
+        depends on more than individual lines.
+        """
+        for text in self._iter_line_groups(chunks):
+            yield self._postprocess(text)
+
+    def _iter_line_groups(self, chunks):
+        """Generate the text in `chunks` regrouped in whole lines.
+
+        Each resulting chunk ends in a newline, except possibly the
+        last one.
+        """
+        pending = []
+        for chunk in chunks:
+            newline_pos = chunk.rfind("\n")
+            if newline_pos == -1:
+                pending.append(chunk)
+            else:
+                pending.append(chunk[:newline_pos + 1])
+                yield "".join(pending)
+                pending = [chunk[newline_pos + 1:]]
+        rest = "".join(pending)
+        if rest:
+            yield rest
+
+    def _iter_lines(self, chunks):
+        """Generate the lines (without newlines) of the text in `chunks`.
+
+        The lines are the same as those returned by
+        ``"".join(chunks).split("\\n")``.
+        """
+        pending = []
+        for chunk in chunks:
+            lines = chunk.split("\n")
+            if len(lines) == 1:
+                pending.append(chunk)
+            else:
+                pending.append(lines[0])
+                yield "".join(pending)
+                for line in lines[1:-1]:
+                    yield line
+                pending = [lines[-1]]
+        yield "".join(pending)
+
     def _get_sentence_structs(self, sentence, all_structs=False):
         """Get the structural attributes of a sentence.
 
@@ -726,22 +796,31 @@ class KorpExportFormatter(object):
         as a whole matches the regular expression, the list item is
         not included in the result.
         """
+        return "".join(self._iter_format_list(item_type, list_, format_fn,
+                                              **kwargs))
 
-        def updated(dict_, values):
-            dict_.update(values)
-            return dict_
+    def _iter_format_list(self, item_type, list_, format_fn=None, **kwargs):
+        """Generate the formatted items of the list `list_`.
 
+        Generate the items of `list_` formatted as in
+        :meth:`_format_list`, each item except the first one preceded
+        by the separator as a chunk of its own.
+        """
         format_fn = format_fn or getattr(self, "_format_" + item_type)
         skip_re = self._opts.get(item_type + "_skip")
         if skip_re:
             skip_re = re.compile(r"^" + skip_re + r"$", re.UNICODE)
-        return self._opts[item_type + "_sep"].join(
-            formatted_elem
-            for elemnum, elem in enumerate(list_)
-            for formatted_elem in [
-                    format_fn(elem, **updated(kwargs, dict([(item_type + "_num",
-                                                             elemnum)])))]
-            if not (skip_re and skip_re.match(formatted_elem)))
+        sep = self._opts[item_type + "_sep"]
+        first = True
+        for elemnum, elem in enumerate(list_):
+            kwargs[item_type + "_num"] = elemnum
+            formatted_elem = format_fn(elem, **kwargs)
+            if skip_re and skip_re.match(formatted_elem):
+                continue
+            if not first:
+                yield sep
+            first = False
+            yield formatted_elem
 
     def _format_label_list_item(self, item_type, key, value, **format_args):
         """Format an item of a list whose items have labels.
@@ -802,15 +881,43 @@ class KorpExportFormatter(object):
         Format keys in ``content_format``: ``info`` (query result meta
         information), ``sentences`` (the sentences in the result).
 
+        The content is formatted with :meth:`_iter_format_content`.
+        """
+        return "".join(self._iter_format_content(**kwargs))
+
+    def _iter_format_content(self, **kwargs):
+        """Generate the content of an exportable file in chunks.
+
+        Format the content as described in :meth:`_format_content`
+        and generate it as chunks: the part preceding the sentences,
+        each sentence (and separator) and the part following the
+        sentences. If the sentences cannot be separated from the rest
+        of ``content_format`` (for example, if the format key has a
+        format specification), the whole content is a single chunk.
+
         This is the main content-formatting method that may be
         overridden in subclasses if they do not need the formatting
         facilities of KorpExportFormatter.
         """
-        return self._format_item(
+        # Format the content with a marker in place of the sentences
+        # and split it at the marker
+        sentences_marker = u"\x00sentences\x00"
+        content_parts = self._format_item(
             "content",
             info=lambda: self._format_infoitems(**kwargs),
-            sentences=lambda: self._format_sentences(**kwargs),
-            **self._infoitems)
+            sentences=sentences_marker,
+            **self._infoitems).split(sentences_marker)
+        if len(content_parts) != 2:
+            yield self._format_item(
+                "content",
+                info=lambda: self._format_infoitems(**kwargs),
+                sentences=lambda: self._format_sentences(**kwargs),
+                **self._infoitems)
+            return
+        yield content_parts[0]
+        for chunk in self._iter_format_sentences(**kwargs):
+            yield chunk
+        yield content_parts[1]
 
     # Formatting methods for query and result information items (meta
     # information)
@@ -940,8 +1047,33 @@ class KorpExportFormatter(object):
         ``sentence_format`` to format the individual sentences and
         ``sentence_sep`` to separate them.
         """
-        return self._format_list(
-            "sentence", qr.get_sentences(self._query_result), **kwargs)
+        return "".join(self._iter_format_sentences(**kwargs))
+
+    def _iter_format_sentences(self, **kwargs):
+        """Generate the formatted sentences of a query result.
+
+        Generate the sentences formatted as in
+        :meth:`_format_sentences`, with the separators as chunks of
+        their own.
+        """
+        return self._iter_format_list(
+            "sentence", qr.get_sentences(self._query_result),
+            self._format_sentence_or_missing, **kwargs)
+
+    def _format_sentence_or_missing(self, sentence, **kwargs):
+        """Format a single sentence, as ``[none]`` if it fails.
+
+        Format `sentence` with :meth:`_format_sentence`. If it raises
+        `KeyError` or `AttributeError`, return the missing value of
+        the string formatter (``[none]``), as the whole sentence list
+        would be shown when formatted lazily as part of the content.
+        """
+        try:
+            return self._format_sentence(sentence, **kwargs)
+        except (KeyError, AttributeError):
+            logging.warning("Error when formatting sentence %s",
+                            kwargs.get("sentence_num"), exc_info=True)
+            return self._formatter.missing
 
     def _format_sentence(self, sentence, **kwargs):
         """Format a single sentence.